@@ -4,11 +4,15 @@ from flask import Flask, render_template, redirect, url_for, request, flash, ses
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from models import (User, Provider, Patient, Appointment, Message, HealthInfo, UserInteraction, Payment, 
-                   Prescription, WalkInPatient, LabTest, LabResult, Bill, db, init_db)
+                   Prescription, WalkInPatient, LabTest, LabResult, Bill, db, init_db,
+                   check_counters, MESSAGE_PAGE_SIZE)
 from forms import (LoginForm, RegistrationForm, MessageForm, HealthInfoForm, HealthTipsForm, HealthEducationForm,
                   PrescriptionForm, WalkInForm, QuickPatientForm, LabTestForm, LabResultForm, 
                   BillItemForm, PaymentRecordForm)
-from ussd_handler import ussd_callback
+from ussd_handler import ussd_callback, sessions as ussd_sessions, replays as ussd_replays
+from catalog import language_name
+from tasks import background
+from notifications import outbox, deliver
 import utils
 import ai_service
 import mock_ai_service  # Import the mock AI service
@@ -28,6 +32,8 @@ def _jinja2_filter_now():
     """Return current datetime for templates"""
     return datetime.now()
 
+app.add_template_filter(language_name, 'language_name')
+
 # Initialize Login Manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -72,6 +78,33 @@ def ussd():
     
     return response
 
+@app.route('/api/ussd/session-stats')
+@login_required
+def ussd_session_stats():
+    """Size and hit, miss and eviction counters of the USSD session and replay stores"""
+    return jsonify({**ussd_sessions.stats(), 'replays': ussd_replays.stats()})
+
+@app.route('/api/tasks/stats')
+@login_required
+def task_stats():
+    """Counters of the background task queue that runs request side effects"""
+    return jsonify(background.stats())
+
+@app.route('/api/notifications/stats')
+@login_required
+def notification_stats():
+    """Counters of the outbox that delivers SMS to patients"""
+    return jsonify(outbox.stats())
+
+@app.route('/api/counters/check')
+@login_required
+def check_dashboard_counters():
+    """Compare the maintained dashboard counts with a full recount"""
+    mismatches = check_counters()
+    if mismatches:
+        logger.warning(f"Dashboard counters disagree with the store: {mismatches}")
+    return jsonify({'consistent': not mismatches, 'mismatches': mismatches})
+
 # Web routes for provider dashboard
 @app.route('/')
 def index():
@@ -276,7 +309,7 @@ def patient_messages(patient_id):
     if request.method == 'POST':
         content = request.form.get('message')
         if content:
-            Message.create(provider.id, patient_id, content, 'provider')
+            deliver(Message.create(provider.id, patient_id, content, 'provider'))
             flash('Message sent.', 'success')
         else:
             flash('Message cannot be empty.', 'warning')
@@ -284,14 +317,53 @@ def patient_messages(patient_id):
     # Mark messages as read
     Message.mark_as_read(patient_id, provider.id)
     
-    messages_list = Message.get_conversation(provider.id, patient_id)
+    # Only the latest page; older messages are loaded from conversation_history
+    messages_list, has_older = Message.get_conversation_page(provider.id, patient_id)
     return render_template('messages.html', 
                           provider=provider,
                           patient=patient,
                           messages=messages_list,
+                          has_older=has_older,
                           active_patient_id=patient_id,
                           conversations=Message.get_conversations(provider.id))
 
+# Largest page of messages conversation_history returns
+MAX_MESSAGE_PAGE_SIZE = 100
+
+@app.route('/api/messages/<int:patient_id>')
+@login_required
+def conversation_history(patient_id):
+    """
+    One page of the conversation with a patient, as JSON
+    
+    Query parameters:
+        before: Message ID; return the messages sent just before it
+        after: Message ID; return the messages sent just after it
+        limit: Messages per page, at most MAX_MESSAGE_PAGE_SIZE
+    
+    The response carries the cursors for the next page in each direction:
+    'before' is None once the oldest message has been returned.
+    """
+    provider = Provider.get_by_user_id(current_user.id)
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', MESSAGE_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    
+    messages_list, more = Message.get_conversation_page(provider.id, patient_id, before, after, limit)
+    return jsonify({
+        'messages': [{
+            'id': message.id,
+            'content': message.content,
+            'sender_type': message.sender_type,
+            'created_at': message.created_at.isoformat(),
+            'time': message.created_at.strftime('%d %b, %H:%M')
+        } for message in messages_list],
+        'before': messages_list[0].id if messages_list and (more or after is not None) else None,
+        'after': messages_list[-1].id if messages_list else after,
+        'has_more': more
+    })
+
 @app.route('/health-info', methods=['GET', 'POST'])
 @login_required
 def health_info():
@@ -546,8 +618,8 @@ def share_health_tips(patient_id):
         if 'follow_up' in tips:
             message += f"Follow-up: {tips['follow_up']}"
         
-        # Save this as a message
-        Message.create(provider.id, patient_id, message, 'provider')
+        # Save this as a message and send it to the patient by SMS
+        deliver(Message.create(provider.id, patient_id, message, 'provider'))
         
         flash('Health tips shared with patient as a message.', 'success')
     else:
@@ -635,14 +707,14 @@ def user_journey_list():
     provider = Provider.get_by_user_id(current_user.id)
     patients = Patient.get_all()
     
-    # For each patient, get a count of their interactions
-    for patient in patients:
-        interactions = UserInteraction.get_by_patient(patient.id)
-        patient.interaction_count = len(interactions)
+    # Count every patient's interactions in one pass
+    counts = UserInteraction.count_by_patient()
+    interaction_counts = {patient.id: counts.get(patient.id, 0) for patient in patients}
     
     return render_template('user_journey_list.html', 
                           provider=provider,
-                          patients=patients)
+                          patients=patients,
+                          interaction_counts=interaction_counts)
 
 
 @app.route('/user-journey/<int:patient_id>')
@@ -983,6 +1055,14 @@ def register_walk_in():
         return redirect(url_for('walk_in_patients'))
     
     elif 'add_patient' in request.form and quick_patient_form.validate_on_submit():
+        # Phone numbers are unique per patient
+        if Patient.get_by_phone(quick_patient_form.phone_number.data):
+            flash('A patient with this phone number already exists.', 'danger')
+            return render_template('register_walk_in.html',
+                                  provider=provider,
+                                  walk_in_form=walk_in_form,
+                                  quick_patient_form=quick_patient_form)
+
         # Quick add new patient
         patient = Patient.create(
             quick_patient_form.phone_number.data,
@@ -1278,10 +1358,9 @@ def record_payment():
             # Update bill status based on payment
             total_paid = float(form.amount.data)  # In real system, sum all payments for this bill
             if total_paid >= bill.total_amount:
-                bill.status = 'paid'
-                bill.paid_at = datetime.now()
+                Bill.update_status(bill.id, 'paid')
             else:
-                bill.status = 'partially_paid'
+                Bill.update_status(bill.id, 'partially_paid')
             
             flash('Payment recorded successfully.', 'success')
             return redirect(url_for('finance'))
@@ -1307,9 +1386,7 @@ def update_bill_status():
             flash('Bill not found.', 'danger')
             return redirect(url_for('finance'))
         
-        bill.status = status
-        if status == 'paid':
-            bill.paid_at = datetime.now()
+        Bill.update_status(bill.id, status)
         
         flash(f'Bill #{bill_id} status updated to {status}.', 'success')
     except ValueError:
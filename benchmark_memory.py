@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for Tujali Telehealth models
+
+Measures the bytes used per row by the high-volume models (patients with
+symptoms, appointments, messages, user interactions and payments) in their
+compact __slots__ form, and compares them with the previous plain-class
+layout: a __dict__ per instance, symptoms as a list of dicts and an empty
+metadata dict on every interaction. User interactions are also measured in
+the columnar EventTable the memory backend keeps them in.
+
+Usage:
+    python benchmark_memory.py [--rows 100000]
+"""
+
+import argparse
+import gc
+import tracemalloc
+from datetime import datetime
+
+from models import (Patient, Symptom, Appointment, Message, UserInteraction, Payment,
+                    EMPTY_METADATA, COLUMNAR_COLLECTIONS)
+
+
+def legacy_class(model):
+    """Plain class with a per-instance __dict__ that shares the model's __init__"""
+    return type(f'Legacy{model.__name__}', (), {'__init__': model.__init__})
+
+
+def make_patient(cls, i, compact):
+    patient = cls(i, f'+2547{i:08d}', f'Patient {i}', 30 + i % 50, 'Female' if i % 2 else 'Male',
+                  'Nairobi, Kenya', 'sw' if i % 3 else 'en', (-1.2921, 36.8219))
+    symptoms = [(f'headache and fever day {i}', 'Moderate', 'pain'),
+                (f'dry cough {i}', 'Mild', 'respiratory')]
+    if compact:
+        patient.symptoms = tuple(Symptom(text, datetime.now(), severity, category)
+                                 for text, severity, category in symptoms)
+    else:
+        patient.symptoms = [{'text': text, 'date': datetime.now(), 'severity': severity,
+                             'category': category} for text, severity, category in symptoms]
+    return patient
+
+
+def make_appointment(cls, i, compact):
+    return cls(i, i % 1000 + 1, i % 50 + 1, '2025-06-01', '10:00', 'pending', 1500.0, 'pending')
+
+
+def make_message(cls, i, compact):
+    return cls(i, i % 50 + 1, i % 1000 + 1, f'Hello doctor, message number {i}', 'patient')
+
+
+def make_interaction(cls, i, compact):
+    interaction = cls(i, i % 1000 + 1, 'ussd', f'Accessed main menu {i}')
+    if not compact:
+        interaction.metadata = {}
+    return interaction
+
+
+def make_payment(cls, i, compact):
+    return cls(i, i + 1, 1500.0, f'+2547{i:08d}')
+
+
+BENCHMARKS = [
+    ('Patient (2 symptoms)', Patient, make_patient),
+    ('Appointment', Appointment, make_appointment),
+    ('Message', Message, make_message),
+    ('UserInteraction', UserInteraction, make_interaction),
+    ('Payment', Payment, make_payment),
+]
+
+
+def make_event(i, sessions):
+    """Interaction as produced by the USSD and messaging hooks: few distinct descriptions"""
+    metadata = {'session_id': f'ATI{i // 5:09d}'} if sessions and i % 2 else None
+    return UserInteraction(i + 1, i % 1000 + 1, ('ussd', 'message', 'symptom')[i % 3],
+                           ('Accessed main menu', 'Sent message to provider', 'Reported symptom')[i % 3],
+                           metadata)
+
+
+def measure_events(rows, columnar, sessions):
+    """
+    Store rows interactions as a list of objects or in an EventTable and
+    return the traced bytes per row
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    if columnar:
+        records = COLUMNAR_COLLECTIONS['user_interactions']()
+        for i in range(rows):
+            records.append(make_event(i, sessions))
+    else:
+        records = [make_event(i, sessions) for i in range(rows)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / rows
+
+
+def measure(factory, cls, rows, compact):
+    """
+    Allocate rows instances and return the traced bytes per row
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [factory(cls, i, compact) for i in range(rows)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure bytes per row of the Tujali models')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows to allocate per model')
+    args = parser.parse_args()
+
+    # Interactions created without metadata share one read-only mapping
+    assert UserInteraction(1, 1, 'ussd', '').metadata is EMPTY_METADATA
+
+    print(f"Bytes per row over {args.rows} rows")
+    print(f"{'Model':<24}{'before':>10}{'after':>10}{'saved':>10}")
+    for name, model, factory in BENCHMARKS:
+        before = measure(factory, legacy_class(model), args.rows, compact=False)
+        after = measure(factory, model, args.rows, compact=True)
+        saved = 100 * (before - after) / before
+        print(f"{name:<24}{before:>10.0f}{after:>10.0f}{saved:>9.0f}%")
+
+    print("\nUser interactions, bytes per row as objects in a list and in an EventTable")
+    print(f"{'Metadata':<24}{'list':>10}{'columns':>10}{'ratio':>10}")
+    for name, sessions in (('none', False), ('session id on half', True)):
+        before = measure_events(args.rows, columnar=False, sessions=sessions)
+        after = measure_events(args.rows, columnar=True, sessions=sessions)
+        print(f"{name:<24}{before:>10.0f}{after:>10.0f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+USSD load generator and latency benchmark for Tujali Telehealth
+
+Replays synthetic USSD sessions concurrently, the way Africa's Talking sends
+them: every request carries the session ID and the '*'-joined history of
+inputs. Each synthetic user registers and then reports symptoms, books an
+appointment or sends a message, each journey in a fresh session.
+
+Targets:
+    direct   Calls ussd_callback in-process, measuring the handler alone
+    client   Posts to /ussd through the Flask test client, in-process
+    http     Posts to a running server over a pooled keep-alive connection
+
+The report gives requests per second and p50/p95/p99 latency per menu
+state, so regressions in ussd_callback show up before deploy. With
+--max-p95 the run fails when the overall p95 exceeds the budget.
+
+Usage:
+    python benchmark_ussd.py --users 2000 --concurrency 50
+    python benchmark_ussd.py --target http --url http://localhost:5000/ussd --users 500
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+SERVICE_CODE = '*384*4255#'
+
+SYMPTOMS = ['Headache and fever', 'Cough for several days', 'Stomach pain after meals',
+            'Rash on both arms', 'Back pain when walking']
+LOCATIONS = ['Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret']
+
+
+# Journeys: lists of (state the input is sent in, input). The first request
+# of every session has an empty input and is labelled 'start'.
+
+def registration(rng, i):
+    return [('select_language', '1'),
+            ('guest_menu', '1'),
+            ('register_name', f"Load Test User {i}"),
+            ('register_age', str(rng.randint(18, 80))),
+            ('register_gender', rng.choice('12')),
+            ('register_location', rng.choice(LOCATIONS)),
+            ('register_coordinates_choice', '2')]
+
+
+def symptom_report(rng, i):
+    return [('select_language', '1'),
+            ('main_menu', '1'),
+            ('symptom_description', rng.choice(SYMPTOMS)),
+            ('symptom_duration', rng.choice('1234')),
+            ('symptom_severity', rng.choice('123'))]
+
+
+def appointment_booking(rng, i):
+    return [('select_language', '1'),
+            ('main_menu', '2'),
+            ('appointment_date', str(rng.randint(1, 7))),
+            ('appointment_time', str(rng.randint(1, 6))),
+            ('appointment_provider', '1')]
+
+
+def messaging(rng, i):
+    return [('select_language', '1'),
+            ('main_menu', '3'),
+            ('message_menu', '1'),
+            ('message_compose', f"Question from user {i}: when should I come in?")]
+
+
+# Journeys after registration, with their relative weights
+JOURNEYS = [(symptom_report, 4), (appointment_booking, 3), (messaging, 3)]
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values), max(1, math.ceil(p / 100 * len(sorted_values)))) - 1
+    return sorted_values[rank]
+
+
+class DirectTarget:
+    """Calls ussd_callback in this process"""
+    def __init__(self):
+        from models import init_db
+        from ussd_handler import ussd_callback
+        init_db()
+        self.callback = ussd_callback
+
+    def send(self, session_id, phone_number, text):
+        return self.callback(session_id, SERVICE_CODE, phone_number, text)
+
+
+class ClientTarget:
+    """Posts to /ussd through the Flask test client, one client per thread"""
+    def __init__(self):
+        from app import app
+        self.app = app
+        self.local = threading.local()
+
+    def send(self, session_id, phone_number, text):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.post('/ussd', data={'sessionId': session_id, 'serviceCode': SERVICE_CODE,
+                                              'phoneNumber': phone_number, 'text': text})
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return response.get_data(as_text=True)
+
+
+class HTTPTarget:
+    """Posts to a running server, reusing keep-alive connections"""
+    def __init__(self, url, pool_size):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, session_id, phone_number, text):
+        response = self.session.post(self.url, data={'sessionId': session_id, 'serviceCode': SERVICE_CODE,
+                                                      'phoneNumber': phone_number, 'text': text},
+                                     timeout=30)
+        response.raise_for_status()
+        return response.text
+
+
+class Recorder:
+    """Latencies per state and error counts, shared by the worker threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # state -> seconds
+        self.errors = defaultdict(int)  # state -> failed requests
+
+    def add(self, state, seconds, ok):
+        with self.lock:
+            self.latencies[state].append(seconds)
+            if not ok:
+                self.errors[state] += 1
+
+
+def run_session(target, recorder, phone_number, steps, think):
+    """Replay one USSD session: an empty first request, then each input"""
+    session_id = f"load-{uuid.uuid4().hex}"
+    history = []
+    for state, value in [('start', None)] + steps:
+        if value is not None:
+            history.append(value)
+        text = '*'.join(history)
+        started = time.perf_counter()
+        try:
+            response = target.send(session_id, phone_number, text)
+            ok = response.startswith(('CON ', 'END ')) and 'error occurred' not in response
+        except Exception:
+            response, ok = '', False
+        recorder.add(state, time.perf_counter() - started, ok)
+        if not ok or response.startswith('END'):
+            break
+        if think:
+            time.sleep(think)
+
+
+def run_user(target, recorder, rng, i, phone_number, journeys, think):
+    """Register a synthetic user, then run their journeys, each in a new session"""
+    run_session(target, recorder, phone_number, registration(rng, i), think)
+    functions, weights = zip(*JOURNEYS)
+    for journey in rng.choices(functions, weights, k=journeys):
+        run_session(target, recorder, phone_number, journey(rng, i), think)
+
+
+def report(recorder, elapsed):
+    """
+    Summarize a run
+
+    Returns:
+        dict: Totals and per-state count, errors and p50/p95/p99/max in milliseconds
+    """
+    def summary(values, errors):
+        values = sorted(values)
+        return {'requests': len(values), 'errors': errors,
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p95_ms': round(percentile(values, 95) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3) if values else 0.0}
+
+    everything = [seconds for values in recorder.latencies.values() for seconds in values]
+    total = summary(everything, sum(recorder.errors.values()))
+    total['seconds'] = round(elapsed, 3)
+    total['requests_per_second'] = round(len(everything) / elapsed, 1) if elapsed else 0.0
+    return {'total': total,
+            'states': {state: summary(values, recorder.errors[state])
+                       for state, values in sorted(recorder.latencies.items())}}
+
+
+def print_report(result):
+    total = result['total']
+    print(f"{total['requests']} requests in {total['seconds']}s: {total['requests_per_second']} req/s, "
+          f"{total['errors']} errors")
+    print(f"{'State':<30}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for state, entry in list(result['states'].items()) + [('all', total)]:
+        print(f"{state:<30}{entry['requests']:>10}{entry['errors']:>8}{entry['p50_ms']:>10.2f}"
+              f"{entry['p95_ms']:>10.2f}{entry['p99_ms']:>10.2f}{entry['max_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay concurrent synthetic USSD sessions')
+    parser.add_argument('--target', choices=['direct', 'client', 'http'], default='direct')
+    parser.add_argument('--url', default='http://localhost:5000/ussd', help='USSD endpoint for --target http')
+    parser.add_argument('--users', type=int, default=1000, help='Synthetic users to run')
+    parser.add_argument('--journeys', type=int, default=2, help='Journeys per user after registering')
+    parser.add_argument('--concurrency', type=int, default=50, help='Users running at the same time')
+    parser.add_argument('--think', type=float, default=0.0, help='Seconds to wait between requests')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic inputs')
+    parser.add_argument('--json', metavar='PATH', help='Also write the report as JSON')
+    parser.add_argument('--max-p95', type=float, metavar='MS',
+                        help='Exit with status 1 if the overall p95 latency exceeds this')
+    args = parser.parse_args()
+
+    if args.target == 'direct':
+        target = DirectTarget()
+    elif args.target == 'client':
+        target = ClientTarget()
+    else:
+        target = HTTPTarget(args.url, args.concurrency)
+
+    recorder = Recorder()
+    # A phone number prefix per run, so repeated runs against one server register new patients
+    prefix = f"+2547{random.randrange(10, 100)}"
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(run_user, target, recorder, random.Random(args.seed * 1000003 + i), i,
+                               f"{prefix}{i:06d}", args.journeys, args.think)
+                   for i in range(args.users)]
+        for future in futures:
+            future.result()
+    result = report(recorder, time.perf_counter() - started)
+
+    print_report(result)
+    if args.target != 'http':
+        # Side effects run on the background task queue; wait for them to land
+        from tasks import background
+        background.join(60)
+        print(f"Background tasks: {background.stats()}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.max_p95 is not None and result['total']['p95_ms'] > args.max_p95:
+        print(f"p95 latency {result['total']['p95_ms']} ms exceeds the budget of {args.max_p95} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
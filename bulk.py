@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Bulk import and export for Tujali Telehealth
+
+Loads patients, appointments and payments from CSV or JSONL files (for example
+when onboarding a county) and writes them back out in the same formats.
+
+Imports stream the file: rows are validated with the same WTForms rules as the
+web forms in forms.py, and every batch of valid rows gets its IDs reserved in
+one step and is written with a single store.insert_many call, so indexes, the
+ID sequence and the write lock are handled once per batch rather than per row.
+Appointments go through Appointment.insert_many, which also keeps the
+dashboard status counts and the slot inventory current.
+Invalid rows are reported with their line number and skipped.
+
+Exports read the collection through store.scan, one batch at a time, so a
+collection is never copied into memory whole.
+
+Both use the storage backend configured for models.py, so run imports against
+a persistent store (TUJALI_STORAGE=sqlite:///... or TUJALI_DATA_DIR). A SQLite
+file can be imported into while the server runs. A TUJALI_DATA_DIR is written
+by a single process, so stop the server before importing into it; bulk.py
+refuses to start while the server holds the directory.
+
+Usage:
+    python bulk.py import patients county_patients.csv [--batch-size 1000]
+    python bulk.py export appointments appointments.jsonl
+"""
+
+import argparse
+import csv
+import json
+import logging
+import time
+from datetime import datetime
+
+from werkzeug.datastructures import MultiDict
+from wtforms import Form, SubmitField
+from wtforms.fields.core import UnboundField
+
+from forms import QuickPatientForm, AppointmentImportForm, PaymentImportForm
+from models import store, normalize_phone, Patient, Provider, Appointment, Payment
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Rows kept in an import report's error list; further rejected rows are only counted
+MAX_REPORTED_ERRORS = 100
+
+# Columns written by an export, in order
+EXPORT_FIELDS = {
+    'patients': ('id', 'phone_number', 'name', 'age', 'gender', 'location', 'language',
+                 'latitude', 'longitude', 'created_at'),
+    'appointments': ('id', 'patient_id', 'provider_id', 'date', 'time', 'status', 'price',
+                     'payment_status', 'notes', 'created_at'),
+    'payments': ('id', 'appointment_id', 'amount', 'phone_number', 'mpesa_reference', 'status',
+                 'payment_method', 'created_at', 'paid_at')
+}
+
+
+def row_form(form_class):
+    """
+    Build a plain WTForms form with the fields of a FlaskForm, minus its submit
+    button, so rows can be validated outside a request and without CSRF
+    """
+    fields = {name: field for name, field in vars(form_class).items()
+              if isinstance(field, UnboundField) and field.field_class is not SubmitField}
+    return type(f'{form_class.__name__}Row', (Form,), fields)
+
+
+def _parse_datetime(value):
+    """Parse an ISO timestamp column, or return None if it is empty"""
+    return datetime.fromisoformat(value) if value else None
+
+
+def _parse_coordinates(row):
+    """Build a (latitude, longitude) tuple from optional columns"""
+    if row.get('latitude') in (None, '') or row.get('longitude') in (None, ''):
+        return None
+    return (float(row['latitude']), float(row['longitude']))
+
+
+def _check_columns(row):
+    """Check the optional timestamp and coordinate columns the forms do not cover"""
+    errors = {}
+    for field in ('created_at', 'paid_at'):
+        try:
+            _parse_datetime(row.get(field))
+        except (TypeError, ValueError):
+            errors[field] = ['Not a valid ISO date and time.']
+    try:
+        _parse_coordinates(row)
+    except (TypeError, ValueError):
+        errors['coordinates'] = ['Latitude and longitude must be numbers.']
+    return errors or None
+
+
+def _check_patient(row, data, seen):
+    """Reject patients whose phone number is already registered or repeated in the file"""
+    phone = normalize_phone(data['phone_number'])
+    if not phone:
+        return {'phone_number': ['Not a valid phone number.']}
+    if phone in seen or Patient.get_by_phone(phone):
+        return {'phone_number': [f"A patient with phone number {data['phone_number']} already exists"]}
+    seen.add(phone)
+    return None
+
+
+def _build_patient(record_id, row, data):
+    return Patient(record_id, data['phone_number'], data['name'], data['age'], data['gender'],
+                   data['location'], data['language'], _parse_coordinates(row),
+                   _parse_datetime(row.get('created_at')))
+
+
+def _check_appointment(row, data, seen):
+    """Reject appointments for unknown patients or providers"""
+    errors = {}
+    if not Patient.get_by_id(data['patient_id']):
+        errors['patient_id'] = [f"Unknown patient {data['patient_id']}"]
+    if not Provider.get_by_id(data['provider_id']):
+        errors['provider_id'] = [f"Unknown provider {data['provider_id']}"]
+    return errors or None
+
+
+def _build_appointment(record_id, row, data):
+    price = float(data['price']) if data['price'] is not None else None
+    return Appointment(record_id, data['patient_id'], data['provider_id'], data['date'], data['time'],
+                       data['status'] or 'pending', price,
+                       data['payment_status'] or ('pending' if price else 'waived'),
+                       data['notes'] or None, _parse_datetime(row.get('created_at')))
+
+
+def _check_payment(row, data, seen):
+    """Reject payments for unknown appointments"""
+    if not Appointment.get_by_id(data['appointment_id']):
+        return {'appointment_id': [f"Unknown appointment {data['appointment_id']}"]}
+    return None
+
+
+def _build_payment(record_id, row, data):
+    return Payment(record_id, data['appointment_id'], float(data['amount']), data['phone_number'],
+                   data['mpesa_reference'] or None, data['status'] or 'pending',
+                   data['payment_method'] or 'mpesa', _parse_datetime(row.get('created_at')),
+                   _parse_datetime(row.get('paid_at')))
+
+
+# collection -> (form rows are validated with, extra checks, record builder)
+IMPORTERS = {
+    'patients': (row_form(QuickPatientForm), _check_patient, _build_patient),
+    'appointments': (row_form(AppointmentImportForm), _check_appointment, _build_appointment),
+    'payments': (row_form(PaymentImportForm), _check_payment, _build_payment)
+}
+
+# Collections whose records are written through their model, to keep its maintained counts current
+WRITERS = {
+    'appointments': Appointment.insert_many
+}
+
+
+def read_rows(path):
+    """
+    Stream rows from a CSV file with a header line or a JSONL file
+
+    Yields:
+        tuple: (line number, dict of column -> value)
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_number, json.loads(line)
+        else:
+            # Line 1 is the header
+            for line_number, row in enumerate(csv.DictReader(f), 2):
+                yield line_number, row
+
+
+def import_records(collection, rows, batch_size=1000):
+    """
+    Validate and insert rows into a collection in batches
+
+    Rows may carry an 'id' column to keep IDs from another system; other rows
+    get newly reserved IDs.
+
+    Args:
+        collection (str): 'patients', 'appointments' or 'payments'
+        rows (iterable): (line number, dict) pairs, e.g. from read_rows
+        batch_size (int): Rows written per insert_many call
+
+    Returns:
+        dict: Counts of rows read, imported and rejected, the first rejected
+            rows with their errors, elapsed seconds and rows per second
+    """
+    form_class, check, build = IMPORTERS[collection]
+    write = WRITERS.get(collection, lambda records: store.insert_many(collection, records))
+    report = {'collection': collection, 'read': 0, 'imported': 0, 'rejected': 0, 'errors': []}
+    seen = set()  # unique values already taken by earlier rows of the file
+    explicit_ids = set()
+    batch = []
+    started = time.perf_counter()
+
+    def reject(line_number, errors):
+        report['rejected'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'line': line_number, 'errors': errors})
+
+    def insert(records):
+        if not records:
+            return
+        try:
+            write([record for _, record in records])
+            report['imported'] += len(records)
+        except ValueError:
+            # Another writer took a unique value meanwhile; find the rows it affects
+            for line_number, record in records:
+                try:
+                    write([record])
+                    report['imported'] += 1
+                except ValueError as e:
+                    reject(line_number, {'record': [str(e)]})
+
+    def flush():
+        # Rows with their own IDs go first, so IDs reserved for the rest start after them
+        insert([(line_number, build(record_id, row, data))
+                for line_number, record_id, row, data in batch if record_id is not None])
+        new_rows = [(line_number, row, data) for line_number, record_id, row, data in batch
+                    if record_id is None]
+        ids = store.next_ids(collection, len(new_rows))
+        insert([(line_number, build(record_id, row, data))
+                for record_id, (line_number, row, data) in zip(ids, new_rows)])
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        logger.info(f"Imported {report['imported']} {collection} ({report['imported'] / elapsed:.0f} rows/s)")
+
+    for line_number, row in rows:
+        report['read'] += 1
+        values = {key: str(value) for key, value in row.items() if value is not None}
+        form = form_class(formdata=MultiDict(values))
+        if not form.validate():
+            reject(line_number, form.errors)
+            continue
+
+        record_id = None
+        if values.get('id'):
+            try:
+                record_id = int(values['id'])
+            except ValueError:
+                reject(line_number, {'id': ['Not a valid integer value.']})
+                continue
+            if record_id in explicit_ids or store.get(collection, record_id):
+                reject(line_number, {'id': [f"{collection} {record_id} already exists"]})
+                continue
+
+        errors = _check_columns(row) or check(row, form.data, seen)
+        if errors:
+            reject(line_number, errors)
+            continue
+
+        if record_id is not None:
+            explicit_ids.add(record_id)
+        batch.append((line_number, record_id, row, form.data))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    report['rows_per_second'] = round(report['read'] / report['seconds']) if report['seconds'] else 0
+    return report
+
+
+def import_file(collection, path, batch_size=1000):
+    """Import a CSV or JSONL file into a collection; see import_records"""
+    return import_records(collection, read_rows(path), batch_size)
+
+
+def _export_row(record, fields):
+    """Column values of a record for export; datetimes become ISO strings"""
+    row = {}
+    for field in fields:
+        if field in ('latitude', 'longitude'):
+            coordinates = getattr(record, 'coordinates', None)
+            value = coordinates[0 if field == 'latitude' else 1] if coordinates else None
+        else:
+            value = getattr(record, field, None)
+        row[field] = value.isoformat() if isinstance(value, datetime) else value
+    return row
+
+
+def export_records(collection, path, batch_size=1000):
+    """
+    Stream a collection to a CSV or JSONL file
+
+    Args:
+        collection (str): 'patients', 'appointments' or 'payments'
+        path (str): Output file; JSONL if it ends in .jsonl or .ndjson, otherwise CSV
+        batch_size (int): Records read from the store at a time
+
+    Returns:
+        int: Number of records written
+    """
+    fields = EXPORT_FIELDS[collection]
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            for record in store.scan(collection, batch_size):
+                f.write(json.dumps(_export_row(record, fields), ensure_ascii=False) + '\n')
+                count += 1
+        else:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for record in store.scan(collection, batch_size):
+                writer.writerow(_export_row(record, fields))
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import and export of Tujali records')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('collection', choices=sorted(IMPORTERS))
+    parser.add_argument('path', help='CSV file, or JSONL if the name ends in .jsonl')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per batch')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == 'export':
+        started = time.perf_counter()
+        count = export_records(args.collection, args.path, args.batch_size)
+        elapsed = time.perf_counter() - started
+        print(f"Exported {count} {args.collection} to {args.path} in {elapsed:.2f}s")
+        return
+
+    report = import_file(args.collection, args.path, args.batch_size)
+    print(f"Read {report['read']} rows: {report['imported']} imported, {report['rejected']} rejected "
+          f"in {report['seconds']}s ({report['rows_per_second']} rows/s)")
+    for error in report['errors']:
+        print(f"  line {error['line']}: {error['errors']}")
+    if report['rejected'] > len(report['errors']):
+        print(f"  ... and {report['rejected'] - len(report['errors'])} more")
+
+
+if __name__ == '__main__':
+    main()
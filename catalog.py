@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+"""
+Multilingual message catalog for Tujali Telehealth
+
+Every text shown to patients over USSD lives in MESSAGES, keyed by message
+name and language code. The catalog is compiled once at import: each message
+gets a template for every supported language (English where a translation is
+missing), templates without placeholders are kept as ready strings, and
+format() is a single dict lookup. The web UI uses the same language table for
+language names.
+
+Messages keyed 'all' are language-neutral (numbering, amounts) and shared by
+every language.
+
+Run this module to print the coverage report:
+    python catalog.py
+"""
+
+import logging
+from string import Formatter
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Supported languages, in the order the USSD language menu offers them
+LANGUAGES = {
+    'en': 'English',
+    'sw': 'Kiswahili',
+    'fr': 'Français',
+    'om': 'Afaan Oromoo',
+    'so': 'Soomaali',
+    'am': 'አማርኛ',
+}
+DEFAULT_LANGUAGE = 'en'
+
+# Other codes seen in stored records; the web forms store Oromo as 'or'
+LANGUAGE_ALIASES = {'or': 'om'}
+
+# Language code -> English name, for staff-facing pages
+LANGUAGE_NAMES = {
+    'en': 'English',
+    'sw': 'Swahili',
+    'fr': 'French',
+    'om': 'Oromo',
+    'so': 'Somali',
+    'am': 'Amharic',
+}
+
+MESSAGES = {
+    'language_menu': {
+        # Languages are named in their own script; the Ge'ez of Amharic needs
+        # UCS-2, so ussd_pages splits the menu over pages
+        'all': "Welcome to Tujali Telehealth\n"
+               "Karibu kwenye Tujali Telehealth\n"
+               "Bienvenue sur Tujali Telehealth\n"
+               "Soo dhawow Tujali Telehealth\n"
+               "1. English\n"
+               "2. Kiswahili\n"
+               "3. Français (French)\n"
+               "4. Afaan Oromoo (Oromo)\n"
+               "5. Soomaali (Somali)\n"
+               "6. Amharic (አማርኛ)",
+    },
+    'main_menu': {
+        'en': "Welcome back, {name}\n1. Report symptoms\n2. Schedule appointment\n3. Messages\n"
+              "4. Health information\n5. My profile\n6. My records\n0. Back to language selection",
+        'sw': "Karibu tena, {name}\n1. Ripoti dalili\n2. Panga miadi\n3. Ujumbe\n"
+              "4. Habari za afya\n5. Wasifu wangu\n6. Kumbukumbu zangu\n0. Rudi kwa uchaguzi wa lugha",
+        'fr': "Bon retour, {name}\n1. Signaler des symptômes\n2. Planifier un rendez-vous\n3. Messages\n"
+              "4. Informations de santé\n5. Mon profil\n6. Mes dossiers\n0. Retour à la sélection de langue",
+        'om': "Baga nagaan dhufte, {name}\n1. Mallattoo gabaasi\n2. Qabsoo walhitti dhufeenyaa karoorsii\n"
+              "3. Ergaawwan\n4. Odeeffannoo fayyaa\n5. Profaayilii koo\n6. Galmee koo\n"
+              "0. Gara filannoo afaaniitti deebi'i",
+        'so': "Ku soo dhawow, {name}\n1. Warbixin calaamadaha\n2. Jadwalka ballanta\n3. Fariimaha\n"
+              "4. Macluumaadka caafimaadka\n5. Astaantayda\n6. Diiwaankayga\n0. Ku noqo xulashada luuqadda",
+        'am': "እንደገና እንኳን ደህና መጡ, {name}\n1. የህመም ምልክቶችን ሪፖርት ያድርጉ\n2. ቀጠሮ ያስይዙ\n3. መልዕክቶች\n"
+              "4. የጤና መረጃ\n5. የግል መገለጫዬ\n6. የእኔ መዝገቦች\n0. ወደ ቋንቋ ምርጫ ይመለሱ",
+    },
+    'guest_menu': {
+        'en': "Welcome to Tujali Telehealth\n1. Register\n2. Health information\n0. Back to language selection",
+        'sw': "Karibu kwenye Tujali Telehealth\n1. Jisajili\n2. Habari za afya\n0. Rudi kwa uchaguzi wa lugha",
+        'fr': "Bienvenue sur Tujali Telehealth\n1. S'inscrire\n2. Informations de santé\n"
+              "0. Retour à la sélection de langue",
+        'om': "Tujali Telehealth dhuferra baga nagaan dhufte\n1. Galmaa'i\n2. Odeeffannoo fayyaa\n"
+              "0. Gara filannoo afaaniitti deebi'i",
+        'so': "Ku soo dhawow Tujali Telehealth\n1. Isdiiwaangeli\n2. Macluumaadka caafimaadka\n"
+              "0. Ku noqo xulashada luuqadda",
+        'am': "ወደ ቱጃሊ ቴሌሄልዝ እንኳን ደህና መጡ\n1. ይመዝገቡ\n2. የጤና መረጃ\n0. ወደ ቋንቋ ምርጫ ይመለሱ",
+    },
+    'invalid_option': {
+        'en': "Invalid option. Please try again.",
+        'sw': "Chaguo batili. Tafadhali jaribu tena.",
+        'fr': "Option invalide. Veuillez réessayer.",
+        'om': "Filannoon sirrii miti. Maaloo irra deebi'ii yaali.",
+        'so': "Doorasho aan shaqeyneyn. Fadlan mar kale isku day.",
+        'am': "ልክ ያልሆነ ምርጫ። እባክዎ እንደገና ይሞክሩ።",
+    },
+    'error': {
+        'en': "Sorry, an error occurred. Please try again.",
+        'sw': "Samahani, kuna hitilafu imetokea. Tafadhali jaribu tena.",
+        'fr': "Désolé, une erreur s'est produite. Veuillez réessayer.",
+        'om': "Dhiifama, dogoggora uumame. Maaloo irra deebi'ii yaali.",
+        'so': "Waan xumaatay, khalad ayaa dhacay. Fadlan isku day mar kale.",
+        'am': "ይቅርታ፣ ስህተት ተከስቷል። እባክዎ እንደገና ይሞክሩ።",
+    },
+    'more': {
+        'en': "98. More",
+        'sw': "98. Zaidi",
+        'fr': "98. Suite",
+        'om': "98. Dabalata",
+        'so': "98. Wax kale",
+        'am': "98. ተጨማሪ",
+    },
+    'weekdays': {
+        'en': "Mon,Tue,Wed,Thu,Fri,Sat,Sun",
+        'sw': "Jtt,Jnn,Jtn,Alh,Ijm,Jms,Jpl",
+        'fr': "Lun,Mar,Mer,Jeu,Ven,Sam,Dim",
+        'om': "Wix,Kib,Rob,Kam,Jim,San,Dil",
+        'so': "Isn,Tal,Arb,Kha,Jim,Sab,Axd",
+        'am': "ሰኞ,ማክሰ,ረቡዕ,ሐሙስ,ዓርብ,ቅዳሜ,እሑድ",
+    },
+
+    # Registration
+    'register_name': {
+        'en': "Please enter your full name:",
+        'sw': "Tafadhali ingiza jina lako kamili:",
+        'fr': "Veuillez entrer votre nom complet:",
+        'om': "Maaloo maqaa guutuu keessan galchaa:",
+        'so': "Fadlan geli magacaaga oo buuxa:",
+        'am': "እባክዎ ሙሉ ስምዎን ያስገቡ:",
+    },
+    'register_age': {
+        'en': "Enter your age:",
+        'sw': "Ingiza umri wako:",
+        'fr': "Entrez votre âge:",
+        'om': "Umurii keessan galchaa:",
+        'so': "Geli da'daada:",
+        'am': "እድሜዎን ያስገቡ:",
+    },
+    'invalid_age': {
+        'en': "Please enter a valid age (numbers only).",
+        'sw': "Tafadhali ingiza umri halali (namba tu).",
+        'fr': "Veuillez entrer un âge valide (chiffres uniquement).",
+        'om': "Maaloo umurii sirrii galchaa (lakkoofsa qofa).",
+        'so': "Fadlan geli da' sax ah (tirooyin kaliya).",
+        'am': "እባክዎ ትክክለኛ እድሜ ያስገቡ (ቁጥሮች ብቻ)።",
+    },
+    'register_gender': {
+        'en': "Select your gender:\n1. Male\n2. Female\n3. Other",
+        'sw': "Chagua jinsia yako:\n1. Mume\n2. Mke\n3. Nyingine",
+        'fr': "Sélectionnez votre sexe:\n1. Homme\n2. Femme\n3. Autre",
+        'om': "Saala keessan filadhaa:\n1. Dhiira\n2. Dubartii\n3. Kan biraa",
+        'so': "Dooro jinsigaaga:\n1. Lab\n2. Dhedig\n3. Kale",
+        'am': "ጾታዎን ይምረጡ:\n1. ወንድ\n2. ሴት\n3. ሌላ",
+    },
+    'register_location': {
+        'en': "Enter your location (county/city):",
+        'sw': "Ingiza eneo lako (kaunti/mji):",
+        'fr': "Entrez votre emplacement (comté/ville):",
+        'om': "Bakka jireenya keessanii galchaa (godina/magaalaa):",
+        'so': "Geli goobtaada (gobolka/magaalada):",
+        'am': "አካባቢዎን ያስገቡ (ካውንቲ/ከተማ):",
+    },
+    'register_coordinates_choice': {
+        'en': "Would you like to provide your location coordinates for better provider matching?\n"
+              "1. Yes\n2. No, complete registration without coordinates",
+        'sw': "Je, ungependa kutoa mahali pa eneo lako kwa uwianishaji bora wa mtoa huduma?\n"
+              "1. Ndio\n2. Hapana, kamilisha usajili bila mahali",
+        'fr': "Souhaitez-vous fournir vos coordonnées de localisation pour une meilleure correspondance "
+              "avec les prestataires?\n1. Oui\n2. Non, terminer l'inscription sans coordonnées",
+        'om': "Ogeessa fayyaa isinitti dhiyaatu argachuuf qindoomina bakka keessanii kennuu barbaaddu?\n"
+              "1. Eeyyee\n2. Lakki, qindoomina malee galmee xumuri",
+        'so': "Ma jeclaan lahayd inaad bixiso isku-duwayaasha goobtaada si loogu helo bixiye kuu dhow?\n"
+              "1. Haa\n2. Maya, dhammee diiwaangelinta adigoon isku-duwayaal bixin",
+        'am': "ለተሻለ የአገልግሎት ሰጪ ተዛማጅነት የአካባቢዎን መጋጠሚያዎች መስጠት ይፈልጋሉ?\n"
+              "1. አዎ\n2. አይ፣ ያለ መጋጠሚያዎች ምዝገባውን ያጠናቅቁ",
+    },
+    'register_coordinates': {
+        'en': "Please enter your latitude and longitude separated by a comma (e.g., -1.2921,36.8219):",
+        'sw': "Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma (mfano, -1.2921,36.8219):",
+        'fr': "Veuillez entrer votre latitude et longitude séparées par une virgule (exemple, -1.2921,36.8219):",
+        'om': "Maaloo latitude fi longitude keessan qoodduu (,) tiin addaan baasaa galchaa "
+              "(fkn, -1.2921,36.8219):",
+        'so': "Fadlan geli latitude iyo longitude oo hakad (,) kala soocayo (tusaale, -1.2921,36.8219):",
+        'am': "እባክዎ ኬክሮስ እና ኬንትሮስዎን በኮማ ለይተው ያስገቡ (ለምሳሌ, -1.2921,36.8219):",
+    },
+    'register_coordinates_invalid': {
+        'en': "Invalid coordinates format. Please enter latitude and longitude separated by a comma "
+              "(e.g., -1.2921,36.8219).\nTry again or press 0 to cancel and complete registration without coordinates.",
+        'sw': "Umbali si sahihi. Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma "
+              "(mfano, -1.2921,36.8219).\nJaribu tena au bonyeza 0 kughairi na kukamilisha usajili bila mahali.",
+        'fr': "Format de coordonnées invalide. Veuillez entrer la latitude et la longitude séparées par une "
+              "virgule (exemple, -1.2921,36.8219).\nRéessayez ou appuyez sur 0 pour annuler et terminer "
+              "l'inscription sans coordonnées.",
+        'om': "Qindoominni sirrii miti. Maaloo latitude fi longitude qoodduu (,) tiin addaan baasaa galchaa "
+              "(fkn, -1.2921,36.8219).\nIrra deebi'ii yaali ykn haquu fi qindoomina malee galmee xumuruuf 0 tuqi.",
+        'so': "Qaabka isku-duwayaashu waa khalad. Fadlan geli latitude iyo longitude oo hakad (,) kala soocayo "
+              "(tusaale, -1.2921,36.8219).\nIsku day mar kale ama riix 0 si aad u joojiso oo aad u dhammaystirto "
+              "diiwaangelinta adigoon isku-duwayaal bixin.",
+        'am': "ልክ ያልሆነ የመጋጠሚያ ቅርጸት። እባክዎ ኬክሮስ እና ኬንትሮስን በኮማ ለይተው ያስገቡ "
+              "(ለምሳሌ, -1.2921,36.8219)።\nእንደገና ይሞክሩ ወይም ለመሰረዝ እና ያለ መጋጠሚያዎች ምዝገባውን "
+              "ለማጠናቀቅ 0 ይጫኑ።",
+    },
+    'registration_complete': {
+        'en': "Registration successful!\nName: {name}\nID: {id}\nSelect 0 to continue to main menu.",
+        'sw': "Usajili umefaulu!\nJina: {name}\nKitambulisho: {id}\nChagua 0 kuendelea kwenye menyu kuu.",
+        'fr': "Inscription réussie!\nNom: {name}\nID: {id}\nSélectionnez 0 pour continuer vers le menu principal.",
+        'om': "Galmeen milkaa'eera!\nMaqaa: {name}\nID: {id}\nGara baafata guddaatti darbuuf 0 filadhaa.",
+        'so': "Diiwaangelintu way guulaysatay!\nMagaca: {name}\nAqoonsi: {id}\nDooro 0 si aad u gasho menuga weyn.",
+        'am': "ምዝገባው ተሳክቷል!\nስም: {name}\nመለያ: {id}\nወደ ዋናው ምናሌ ለመቀጠል 0 ይምረጡ።",
+    },
+    'registration_complete_coordinates': {
+        'en': "Registration successful!\nName: {name}\nLocation: {location}\n"
+              "Coordinates saved for location-based provider matching.\nID: {id}\n"
+              "Select 0 to continue to main menu.",
+        'sw': "Usajili umefaulu!\nJina: {name}\nEneo: {location}\n"
+              "Mahali pamehifadhiwa kwa uwianishaji wa mtoa huduma kulingana na eneo.\nKitambulisho: {id}\n"
+              "Chagua 0 kuendelea kwenye menyu kuu.",
+        'fr': "Inscription réussie!\nNom: {name}\nEmplacement: {location}\n"
+              "Coordonnées enregistrées pour la correspondance des prestataires basée sur la localisation.\n"
+              "ID: {id}\nSélectionnez 0 pour continuer vers le menu principal.",
+        'om': "Galmeen milkaa'eera!\nMaqaa: {name}\nBakka: {location}\n"
+              "Qindoominni ogeessa fayyaa isinitti dhiyaatu argachuuf olkaa'ameera.\nID: {id}\n"
+              "Gara baafata guddaatti darbuuf 0 filadhaa.",
+        'so': "Diiwaangelintu way guulaysatay!\nMagaca: {name}\nGoobta: {location}\n"
+              "Isku-duwayaasha waa la kaydiyay si laguugu helo bixiye kuu dhow.\nAqoonsi: {id}\n"
+              "Dooro 0 si aad u gasho menuga weyn.",
+        'am': "ምዝገባው ተሳክቷል!\nስም: {name}\nአካባቢ: {location}\n"
+              "መጋጠሚያዎች በአካባቢ ላይ ለተመሰረተ የአገልግሎት ሰጪ ተዛማጅነት ተቀምጠዋል።\nመለያ: {id}\n"
+              "ወደ ዋናው ምናሌ ለመቀጠል 0 ይምረጡ።",
+    },
+
+    # Symptoms
+    'symptom_description': {
+        'en': "Please describe your symptoms:",
+        'sw': "Tafadhali eleza dalili zako:",
+        'fr': "Veuillez décrire vos symptômes:",
+        'om': "Maaloo mallattoo keessan ibsaa:",
+        'so': "Fadlan sharax calaamadahaaga:",
+        'am': "እባክዎ የህመም ምልክቶችዎን ይግለጹ:",
+    },
+    'symptom_duration': {
+        'en': "How long have you had these symptoms?\n1. Today only\n2. Few days\n3. A week or more\n"
+              "4. A month or more",
+        'sw': "Umepatwa na dalili hizi kwa muda gani?\n1. Leo tu\n2. Siku chache\n3. Wiki moja au zaidi\n"
+              "4. Mwezi mmoja au zaidi",
+        'fr': "Depuis combien de temps avez-vous ces symptômes?\n1. Aujourd'hui seulement\n2. Quelques jours\n"
+              "3. Une semaine ou plus\n4. Un mois ou plus",
+        'om': "Mallattoowwan kana yeroo hammamiif qabaattan?\n1. Har'a qofa\n2. Guyyoota muraasa\n"
+              "3. Torban tokkoo ol\n4. Ji'a tokkoo ol",
+        'so': "Muddo intee le'eg ayaad calaamadahan qabtay?\n1. Maanta oo keliya\n2. Dhowr maalmood\n"
+              "3. Toddobaad ama ka badan\n4. Bil ama ka badan",
+        'am': "እነዚህ ምልክቶች ለምን ያህል ጊዜ ቆዩ?\n1. ዛሬ ብቻ\n2. ጥቂት ቀናት\n3. አንድ ሳምንት ወይም ከዚያ በላይ\n"
+              "4. አንድ ወር ወይም ከዚያ በላይ",
+    },
+    'symptom_severity': {
+        'en': "How severe are your symptoms?\n1. Mild - I can function normally\n"
+              "2. Moderate - Affecting daily activities\n3. Severe - Cannot function normally",
+        'sw': "Dalili zako ni kali kiasi gani?\n1. Kidogo - Ninaweza kufanya kazi kama kawaida\n"
+              "2. Wastani - Zinaathiri shughuli za kila siku\n3. Kali - Siwezi kufanya kazi kama kawaida",
+        'fr': "Quelle est la gravité de vos symptômes?\n1. Légers - Je fonctionne normalement\n"
+              "2. Modérés - Ils affectent mes activités quotidiennes\n3. Graves - Je ne peux pas fonctionner normalement",
+        'om': "Mallattoon keessan hammam cimaa dha?\n1. Salphaa - Akka idileetti hojjechuu nan danda'a\n"
+              "2. Giddugaleessa - Hojii guyyaa guyyaa irratti dhiibbaa qaba\n3. Cimaa - Akka idileetti hojjechuu hin danda'u",
+        'so': "Calaamadahaagu intee bay darran yihiin?\n1. Fudud - Si caadi ah ayaan u shaqeyn karaa\n"
+              "2. Dhexdhexaad - Waxay saameeyaan hawlaha maalinlaha\n3. Daran - Si caadi ah uma shaqeyn karo",
+        'am': "ምልክቶችዎ ምን ያህል ከባድ ናቸው?\n1. ቀላል - በመደበኛነት መንቀሳቀስ እችላለሁ\n"
+              "2. መካከለኛ - የዕለት ተዕለት እንቅስቃሴን ይጎዳል\n3. ከባድ - በመደበኛነት መንቀሳቀስ አልችልም",
+    },
+    'symptom_next_steps': {
+        'en': "Thank you for reporting your symptoms.\n"
+              "A healthcare provider will review your symptoms and respond shortly.\n"
+              "1. Schedule an appointment\n0. Return to main menu",
+        'sw': "Asante kwa kuripoti dalili zako.\n"
+              "Mtoa huduma ya afya atakagua dalili zako na kujibu hivi karibuni.\n"
+              "1. Panga miadi\n0. Rudi kwenye menyu kuu",
+        'fr': "Merci d'avoir signalé vos symptômes.\n"
+              "Un prestataire de soins examinera vos symptômes et vous répondra sous peu.\n"
+              "1. Planifier un rendez-vous\n0. Retour au menu principal",
+        'om': "Mallattoo keessan gabaasuu keessaniif galatoomaa.\n"
+              "Ogeessi fayyaa mallattoo keessan ilaalee dhiyootti deebii isiniif kenna.\n"
+              "1. Qabsoo karoorsi\n0. Gara baafata guddaatti deebi'i",
+        'so': "Waad ku mahadsan tahay soo sheegidda calaamadahaaga.\n"
+              "Bixiye caafimaad ayaa dib u eegi doona calaamadahaaga oo dhawaan kuu jawaabi doona.\n"
+              "1. Qabso ballan\n0. Ku noqo menuga weyn",
+        'am': "ምልክቶችዎን ስላሳወቁ እናመሰግናለን።\n"
+              "የጤና አገልግሎት ሰጪ ምልክቶችዎን ገምግሞ በቅርቡ ምላሽ ይሰጣል።\n"
+              "1. ቀጠሮ ያስይዙ\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+
+    # Appointments
+    'appointment_date': {
+        'en': "Select preferred date:\n",
+        'sw': "Chagua tarehe unayopendelea:\n",
+        'fr': "Sélectionnez la date souhaitée:\n",
+        'om': "Guyyaa filattan filadhaa:\n",
+        'so': "Dooro taariikhda aad doorbidayso:\n",
+        'am': "የሚመርጡትን ቀን ይምረጡ:\n",
+    },
+    'appointment_time': {
+        'en': "Select preferred time:\n",
+        'sw': "Chagua wakati unaopendelea:\n",
+        'fr': "Sélectionnez l'heure souhaitée:\n",
+        'om': "Sa'aatii filattan filadhaa:\n",
+        'so': "Dooro waqtiga aad doorbidayso:\n",
+        'am': "የሚመርጡትን ሰዓት ይምረጡ:\n",
+    },
+    'no_free_slots': {
+        'en': "No times are free on that date. Choose another date:\n",
+        'sw': "Hakuna nafasi siku hiyo. Chagua tarehe nyingine:\n",
+        'fr': "Aucun créneau libre à cette date. Choisissez une autre date:\n",
+        'om': "Guyyaa sana yeroon duwwaan hin jiru. Guyyaa biraa filadhaa:\n",
+        'so': "Ma jiro waqti bannaan taariikhdaas. Dooro taariikh kale:\n",
+        'am': "በዚያ ቀን ክፍት ሰዓት የለም። ሌላ ቀን ይምረጡ:\n",
+    },
+    'slot_taken': {
+        'en': "That time has just been booked. Choose another time:\n",
+        'sw': "Wakati huo umechukuliwa sasa hivi. Chagua wakati mwingine:\n",
+        'fr': "Ce créneau vient d'être réservé. Choisissez une autre heure:\n",
+        'om': "Yeroon sun amma qabameera. Yeroo biraa filadhaa:\n",
+        'so': "Waqtigaas hadda ayaa la qabsaday. Dooro waqti kale:\n",
+        'am': "ያ ሰዓት አሁን ተይዟል። ሌላ ሰዓት ይምረጡ:\n",
+    },
+    'appointment_provider': {
+        'en': "Select healthcare provider:\n",
+        'sw': "Chagua mtoa huduma ya afya:\n",
+        'fr': "Sélectionnez un prestataire de soins de santé:\n",
+        'om': "Ogeessa fayyaa filadhaa:\n",
+        'so': "Dooro bixiyaha caafimaadka:\n",
+        'am': "የጤና አገልግሎት ሰጪ ይምረጡ:\n",
+    },
+    'appointment_provider_nearby': {
+        'en': "Select healthcare provider (sorted by distance):\n",
+        'sw': "Chagua mtoa huduma ya afya (imepangwa kwa umbali):\n",
+        'fr': "Sélectionnez un prestataire de soins de santé (classé par distance):\n",
+        'om': "Ogeessa fayyaa filadhaa (fageenyaan tartiiban):\n",
+        'so': "Dooro bixiyaha caafimaadka (loo kala horreysiiyay masaafada):\n",
+        'am': "የጤና አገልግሎት ሰጪ ይምረጡ (በርቀት የተደረደረ):\n",
+    },
+    'appointment_complete': {
+        'en': "Appointment scheduled successfully!\nDate: {date}\nTime: {time}\nProvider: {provider}\n"
+              "Appointment ID: {id}\n0. Return to main menu",
+        'sw': "Miadi imepangwa kwa mafanikio!\nTarehe: {date}\nWakati: {time}\nMtoa huduma: {provider}\n"
+              "Kitambulisho cha miadi: {id}\n0. Rudi kwenye menyu kuu",
+        'fr': "Rendez-vous planifié avec succès!\nDate: {date}\nHeure: {time}\nPrestataire: {provider}\n"
+              "ID du rendez-vous: {id}\n0. Retour au menu principal",
+        'om': "Qabsoon milkaa'inaan karoorfameera!\nGuyyaa: {date}\nSa'aatii: {time}\nOgeessa: {provider}\n"
+              "ID qabsoo: {id}\n0. Gara baafata guddaatti deebi'i",
+        'so': "Ballanta si guul leh ayaa loo qabtay!\nTaariikhda: {date}\nWaqtiga: {time}\nBixiyaha: {provider}\n"
+              "Aqoonsiga ballanta: {id}\n0. Ku noqo menuga weyn",
+        'am': "ቀጠሮው በተሳካ ሁኔታ ተይዟል!\nቀን: {date}\nሰዓት: {time}\nአገልግሎት ሰጪ: {provider}\n"
+              "የቀጠሮ መለያ: {id}\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'appointment_reminder': {
+        'en': "Reminder: your appointment with {provider} is on {date} at {time}. Tujali Telehealth",
+        'sw': "Kumbusho: miadi yako na {provider} ni tarehe {date} saa {time}. Tujali Telehealth",
+        'fr': "Rappel : votre rendez-vous avec {provider} est le {date} à {time}. Tujali Telehealth",
+        'om': "Yaadachiisa: beellamni keessan {provider} waliin {date} sa'aatii {time}. Tujali Telehealth",
+        'so': "Xusuusin: ballantaada {provider} waa {date} saacadda {time}. Tujali Telehealth",
+        'am': "ማስታወሻ: ከ{provider} ጋር ያለዎት ቀጠሮ {date} በ{time} ነው። Tujali Telehealth",
+    },
+
+    # Messages
+    'messages_recent': {
+        'en': "Recent messages:\n",
+        'sw': "Ujumbe wa hivi karibuni:\n",
+        'fr': "Messages récents:\n",
+        'om': "Ergaawwan dhiyoo:\n",
+        'so': "Fariimihii ugu dambeeyay:\n",
+        'am': "የቅርብ ጊዜ መልዕክቶች:\n",
+    },
+    'messages_footer': {
+        'en': "\n1. Send new message\n0. Return to main menu",
+        'sw': "\n1. Tuma ujumbe mpya\n0. Rudi kwenye menyu kuu",
+        'fr': "\n1. Envoyer un nouveau message\n0. Retour au menu principal",
+        'om': "\n1. Ergaa haaraa ergi\n0. Gara baafata guddaatti deebi'i",
+        'so': "\n1. Dir fariin cusub\n0. Ku noqo menuga weyn",
+        'am': "\n1. አዲስ መልዕክት ይላኩ\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'messages_none': {
+        'en': "You have no messages yet.\n1. Send new message\n0. Return to main menu",
+        'sw': "Bado huna ujumbe.\n1. Tuma ujumbe mpya\n0. Rudi kwenye menyu kuu",
+        'fr': "Vous n'avez pas encore de messages.\n1. Envoyer un nouveau message\n0. Retour au menu principal",
+        'om': "Hanga ammaatti ergaa hin qabdan.\n1. Ergaa haaraa ergi\n0. Gara baafata guddaatti deebi'i",
+        'so': "Weli fariin ma haysatid.\n1. Dir fariin cusub\n0. Ku noqo menuga weyn",
+        'am': "እስካሁን ምንም መልዕክት የለዎትም።\n1. አዲስ መልዕክት ይላኩ\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'sender_you': {
+        'en': "You",
+        'sw': "Wewe",
+        'fr': "Vous",
+        'om': "Isin",
+        'so': "Adiga",
+        'am': "እርስዎ",
+    },
+    'sender_doctor': {
+        'en': "Doctor",
+        'sw': "Daktari",
+        'fr': "Médecin",
+        'om': "Doktora",
+        'so': "Dhakhtar",
+        'am': "ሐኪም",
+    },
+    'message_compose': {
+        'en': "Type your message:",
+        'sw': "Andika ujumbe wako:",
+        'fr': "Tapez votre message:",
+        'om': "Ergaa keessan barreessaa:",
+        'so': "Qor fariintaada:",
+        'am': "መልዕክትዎን ይጻፉ:",
+    },
+    'message_sent': {
+        'en': "Message sent successfully.\nThe healthcare provider will respond soon.\n0. Return to main menu",
+        'sw': "Ujumbe umetumwa kwa mafanikio.\nMtoa huduma ya afya atajibu hivi karibuni.\n"
+              "0. Rudi kwenye menyu kuu",
+        'fr': "Message envoyé avec succès.\nLe prestataire de soins vous répondra bientôt.\n"
+              "0. Retour au menu principal",
+        'om': "Ergaan milkaa'inaan ergameera.\nOgeessi fayyaa dhiyootti deebii kenna.\n"
+              "0. Gara baafata guddaatti deebi'i",
+        'so': "Fariinta si guul leh ayaa loo diray.\nBixiyaha caafimaadku dhawaan ayuu kuu jawaabi doonaa.\n"
+              "0. Ku noqo menuga weyn",
+        'am': "መልዕክቱ በተሳካ ሁኔታ ተልኳል።\nየጤና አገልግሎት ሰጪው በቅርቡ ምላሽ ይሰጣል።\n"
+              "0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+
+    # Profile
+    'profile_view': {
+        'en': "Your Profile:\nName: {name}\nAge: {age}\nGender: {gender}\nLocation: {location}\n{gps}\n"
+              "ID: {id}\n\n1. Update location coordinates\n0. Return to main menu",
+        'sw': "Wasifu Wako:\nJina: {name}\nUmri: {age}\nJinsia: {gender}\nEneo: {location}\n{gps}\n"
+              "Kitambulisho: {id}\n\n1. Sasisha mahali pa eneo\n0. Rudi kwenye menyu kuu",
+        'fr': "Votre Profil:\nNom: {name}\nÂge: {age}\nSexe: {gender}\nEmplacement: {location}\n{gps}\n"
+              "ID: {id}\n\n1. Mettre à jour les coordonnées de localisation\n0. Retour au menu principal",
+        'om': "Profaayilii Keessan:\nMaqaa: {name}\nUmurii: {age}\nSaala: {gender}\nBakka: {location}\n{gps}\n"
+              "ID: {id}\n\n1. Qindoomina bakkaa haaromsi\n0. Gara baafata guddaatti deebi'i",
+        'so': "Astaantaada:\nMagaca: {name}\nDa'da: {age}\nJinsiga: {gender}\nGoobta: {location}\n{gps}\n"
+              "Aqoonsi: {id}\n\n1. Cusboonaysii isku-duwayaasha goobta\n0. Ku noqo menuga weyn",
+        'am': "የእርስዎ መገለጫ:\nስም: {name}\nእድሜ: {age}\nጾታ: {gender}\nአካባቢ: {location}\n{gps}\n"
+              "መለያ: {id}\n\n1. የአካባቢ መጋጠሚያዎችን ያዘምኑ\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'gps_available': {
+        'en': "GPS Location: Available",
+        'sw': "Eneo la GPS: Linapatikana",
+        'fr': "Localisation GPS: Disponible",
+        'om': "Bakka GPS: Ni jira",
+        'so': "Goobta GPS: Waa la heli karaa",
+        'am': "የGPS አካባቢ: አለ",
+    },
+    'gps_not_set': {
+        'en': "GPS Location: Not set",
+        'sw': "Eneo la GPS: Halijawekwa",
+        'fr': "Localisation GPS: Non définie",
+        'om': "Bakka GPS: Hin galmoofne",
+        'so': "Goobta GPS: Lama dejin",
+        'am': "የGPS አካባቢ: አልተቀመጠም",
+    },
+    'update_coordinates': {
+        'en': "To update your location coordinates, please enter latitude and longitude separated by a "
+              "comma (e.g., -1.2921,36.8219):",
+        'sw': "Kusasisha mahali pako, tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma "
+              "(mfano, -1.2921,36.8219):",
+        'fr': "Pour mettre à jour vos coordonnées de localisation, veuillez entrer la latitude et la "
+              "longitude séparées par une virgule (exemple, -1.2921,36.8219):",
+        'om': "Qindoomina bakka keessanii haaromsuuf, maaloo latitude fi longitude qoodduu (,) tiin "
+              "addaan baasaa galchaa (fkn, -1.2921,36.8219):",
+        'so': "Si aad u cusboonaysiiso isku-duwayaasha goobtaada, fadlan geli latitude iyo longitude oo "
+              "hakad (,) kala soocayo (tusaale, -1.2921,36.8219):",
+        'am': "የአካባቢ መጋጠሚያዎችዎን ለማዘመን፣ እባክዎ ኬክሮስ እና ኬንትሮስን በኮማ ለይተው ያስገቡ "
+              "(ለምሳሌ, -1.2921,36.8219):",
+    },
+    'update_coordinates_invalid': {
+        'en': "Invalid coordinates format. Please enter latitude and longitude separated by a comma "
+              "(e.g., -1.2921,36.8219).\nTry again or press 0 to cancel.",
+        'sw': "Umbali si sahihi. Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma "
+              "(mfano, -1.2921,36.8219).\nJaribu tena au bonyeza 0 kughairi.",
+        'fr': "Format de coordonnées invalide. Veuillez entrer la latitude et la longitude séparées par une "
+              "virgule (exemple, -1.2921,36.8219).\nRéessayez ou appuyez sur 0 pour annuler.",
+        'om': "Qindoominni sirrii miti. Maaloo latitude fi longitude qoodduu (,) tiin addaan baasaa galchaa "
+              "(fkn, -1.2921,36.8219).\nIrra deebi'ii yaali ykn haquuf 0 tuqi.",
+        'so': "Qaabka isku-duwayaashu waa khalad. Fadlan geli latitude iyo longitude oo hakad (,) kala "
+              "soocayo (tusaale, -1.2921,36.8219).\nIsku day mar kale ama riix 0 si aad u joojiso.",
+        'am': "ልክ ያልሆነ የመጋጠሚያ ቅርጸት። እባክዎ ኬክሮስ እና ኬንትሮስን በኮማ ለይተው ያስገቡ "
+              "(ለምሳሌ, -1.2921,36.8219)።\nእንደገና ይሞክሩ ወይም ለመሰረዝ 0 ይጫኑ።",
+    },
+    'coordinates_updated': {
+        'en': "Location coordinates updated successfully!\n"
+              "You will now receive location-based provider recommendations.\n0. Return to main menu",
+        'sw': "Mahali pako pamewekwa kwa mafanikio!\n"
+              "Sasa utapata mapendekezo ya watoa huduma kulingana na eneo lako.\n0. Rudi kwenye menyu kuu",
+        'fr': "Coordonnées de localisation mises à jour avec succès!\n"
+              "Vous recevrez désormais des recommandations de prestataires basées sur la localisation.\n"
+              "0. Retour au menu principal",
+        'om': "Qindoominni bakkaa milkaa'inaan haaromfameera!\n"
+              "Amma ogeessota fayyaa isinitti dhiyoo ta'an ni argattu.\n0. Gara baafata guddaatti deebi'i",
+        'so': "Isku-duwayaasha goobta si guul leh ayaa loo cusboonaysiiyay!\n"
+              "Hadda waxaad heli doontaa talooyin bixiyeyaal kuu dhow.\n0. Ku noqo menuga weyn",
+        'am': "የአካባቢ መጋጠሚያዎች በተሳካ ሁኔታ ተዘምነዋል!\n"
+              "አሁን በአካባቢዎ ላይ የተመሰረቱ የአገልግሎት ሰጪ ምክሮችን ያገኛሉ።\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+
+    # Health information
+    'info_menu': {
+        'en': "Health Information:\n1. COVID-19 Information\n2. Maternal Health\n3. Chronic Diseases\n"
+              "4. First Aid\n0. Return to main menu",
+        'sw': "Habari za Afya:\n1. Habari za COVID-19\n2. Afya ya Uzazi\n3. Magonjwa ya Muda Mrefu\n"
+              "4. Huduma ya Kwanza\n0. Rudi kwenye menyu kuu",
+        'fr': "Informations de santé:\n1. Informations COVID-19\n2. Santé maternelle\n3. Maladies chroniques\n"
+              "4. Premiers secours\n0. Retour au menu principal",
+        'om': "Odeeffannoo Fayyaa:\n1. Odeeffannoo COVID-19\n2. Fayyaa Haadholii\n3. Dhibeewwan Yeroo Dheeraa\n"
+              "4. Gargaarsa Jalqabaa\n0. Gara baafata guddaatti deebi'i",
+        'so': "Macluumaadka Caafimaadka:\n1. Macluumaadka COVID-19\n2. Caafimaadka Hooyada\n"
+              "3. Cudurrada Daba-dheeraada\n4. Gargaarka Degdegga ah\n0. Ku noqo menuga weyn",
+        'am': "የጤና መረጃ:\n1. የኮቪድ-19 መረጃ\n2. የእናቶች ጤና\n3. ሥር የሰደዱ በሽታዎች\n"
+              "4. የመጀመሪያ እርዳታ\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'info_detail': {
+        'en': "{title}:\n{content}\n\n0. Return to health information menu",
+        'sw': "{title}:\n{content}\n\n0. Rudi kwenye menyu ya habari za afya",
+        'fr': "{title}:\n{content}\n\n0. Retour au menu des informations de santé",
+        'om': "{title}:\n{content}\n\n0. Gara baafata odeeffannoo fayyaatti deebi'i",
+        'so': "{title}:\n{content}\n\n0. Ku noqo menuga macluumaadka caafimaadka",
+        'am': "{title}:\n{content}\n\n0. ወደ የጤና መረጃ ምናሌ ይመለሱ",
+    },
+    'info_unavailable': {
+        'en': "Information not available at this time.\n0. Return to health information menu",
+        'sw': "Habari haipatikani kwa sasa.\n0. Rudi kwenye menyu ya habari za afya",
+        'fr': "Information non disponible pour le moment.\n0. Retour au menu des informations de santé",
+        'om': "Odeeffannoon yeroo ammaa hin argamu.\n0. Gara baafata odeeffannoo fayyaatti deebi'i",
+        'so': "Macluumaadku hadda lama heli karo.\n0. Ku noqo menuga macluumaadka caafimaadka",
+        'am': "መረጃው በአሁኑ ጊዜ አይገኝም።\n0. ወደ የጤና መረጃ ምናሌ ይመለሱ",
+    },
+
+    # Records
+    'records_menu': {
+        'en': "My records:\n1. Prescriptions\n2. Lab results\n3. Bills\n0. Return to main menu",
+        'sw': "Kumbukumbu zangu:\n1. Dawa ulizoandikiwa\n2. Majibu ya vipimo\n3. Bili\n0. Rudi kwenye menyu kuu",
+        'fr': "Mes dossiers:\n1. Ordonnances\n2. Résultats d'analyses\n3. Factures\n0. Retour au menu principal",
+        'om': "Galmee koo:\n1. Ajaja qorichaa\n2. Bu'aa laaboraatoorii\n3. Kaffaltii\n"
+              "0. Gara baafata guddaatti deebi'i",
+        'so': "Diiwaankayga:\n1. Warqadaha daawada\n2. Natiijooyinka shaybaarka\n3. Biilasha\n"
+              "0. Ku noqo menuga weyn",
+        'am': "የእኔ መዝገቦች:\n1. የመድኃኒት ማዘዣዎች\n2. የላብራቶሪ ውጤቶች\n3. ሂሳቦች\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'records_footer': {
+        'en': "0. Return to main menu",
+        'sw': "0. Rudi kwenye menyu kuu",
+        'fr': "0. Retour au menu principal",
+        'om': "0. Gara baafata guddaatti deebi'i",
+        'so': "0. Ku noqo menuga weyn",
+        'am': "0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'prescriptions_heading': {
+        'en': "Your prescriptions:\n",
+        'sw': "Dawa ulizoandikiwa:\n",
+        'fr': "Vos ordonnances:\n",
+        'om': "Ajaja qoricha keessanii:\n",
+        'so': "Warqadaha daawadaada:\n",
+        'am': "የእርስዎ የመድኃኒት ማዘዣዎች:\n",
+    },
+    'prescription_item': {
+        'all': "{n}. {date} {medications} ({status})",
+    },
+    'prescriptions_none': {
+        'en': "You have no prescriptions.\n0. Return to main menu",
+        'sw': "Huna dawa ulizoandikiwa.\n0. Rudi kwenye menyu kuu",
+        'fr': "Vous n'avez aucune ordonnance.\n0. Retour au menu principal",
+        'om': "Ajaja qorichaa hin qabdan.\n0. Gara baafata guddaatti deebi'i",
+        'so': "Ma haysatid warqado daawo.\n0. Ku noqo menuga weyn",
+        'am': "ምንም የመድኃኒት ማዘዣ የለዎትም።\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'lab_results_heading': {
+        'en': "Your lab tests:\n",
+        'sw': "Vipimo vyako:\n",
+        'fr': "Vos analyses:\n",
+        'om': "Qorannoo laaboraatoorii keessanii:\n",
+        'so': "Baaritaannadaada shaybaarka:\n",
+        'am': "የእርስዎ የላብራቶሪ ምርመራዎች:\n",
+    },
+    'lab_result_item': {
+        'all': "{n}. {test}: {result}",
+    },
+    'lab_results_none': {
+        'en': "You have no lab tests.\n0. Return to main menu",
+        'sw': "Huna vipimo.\n0. Rudi kwenye menyu kuu",
+        'fr': "Vous n'avez aucune analyse.\n0. Retour au menu principal",
+        'om': "Qorannoo laaboraatoorii hin qabdan.\n0. Gara baafata guddaatti deebi'i",
+        'so': "Ma haysatid baaritaanno shaybaar.\n0. Ku noqo menuga weyn",
+        'am': "ምንም የላብራቶሪ ምርመራ የለዎትም።\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+    'bills_heading': {
+        'en': "Your bills:\n",
+        'sw': "Bili zako:\n",
+        'fr': "Vos factures:\n",
+        'om': "Kaffaltii keessan:\n",
+        'so': "Biilashaada:\n",
+        'am': "የእርስዎ ሂሳቦች:\n",
+    },
+    'bill_item': {
+        'all': "{n}. {date} KSh {amount:.0f} ({status})",
+    },
+    'bills_none': {
+        'en': "You have no bills.\n0. Return to main menu",
+        'sw': "Huna bili.\n0. Rudi kwenye menyu kuu",
+        'fr': "Vous n'avez aucune facture.\n0. Retour au menu principal",
+        'om': "Kaffaltii hin qabdan.\n0. Gara baafata guddaatti deebi'i",
+        'so': "Ma haysatid biilal.\n0. Ku noqo menuga weyn",
+        'am': "ምንም ሂሳብ የለዎትም።\n0. ወደ ዋናው ምናሌ ይመለሱ",
+    },
+}
+
+
+def _fields(template):
+    """Names of the placeholders in a format template"""
+    return {field.split('.')[0].split('[')[0]
+            for _, field, _, _ in Formatter().parse(template) if field is not None}
+
+
+class Catalog:
+    """
+    Message templates compiled for every supported language
+
+    Lookups are keyed by (message, language). A template without placeholders
+    is stored as its text; one with placeholders is stored as its bound
+    str.format, so format() never re-parses a language ladder per request.
+    """
+    def __init__(self, messages, languages=LANGUAGES, default=DEFAULT_LANGUAGE):
+        """
+        Args:
+            messages (dict): message name -> {language code or 'all': template}
+            languages (iterable): Language codes every message is compiled for
+            default (str): Language used where a translation is missing
+
+        Raises:
+            ValueError: If a message has neither a default-language nor an 'all' template
+        """
+        self.languages = tuple(languages)
+        self.default = default
+        self.messages = messages
+        self.templates = {}  # (name, language) -> template text
+        self.formatters = {}  # (name, language) -> str.format of templates with placeholders
+        self.fallbacks = {}  # language -> names compiled from the default language
+        for name, texts in messages.items():
+            shared = texts.get('all')
+            if shared is None and default not in texts:
+                raise ValueError(f"Message {name} has no {default} text")
+            for language in self.languages:
+                template = shared if shared is not None else texts.get(language)
+                if template is None:
+                    template = texts[default]
+                    self.fallbacks.setdefault(language, []).append(name)
+                self.templates[name, language] = template
+                if _fields(template):
+                    self.formatters[name, language] = template.format
+        for language, names in self.fallbacks.items():
+            logger.warning(f"{len(names)} messages fall back to {default} for {language}: {', '.join(names)}")
+
+    def resolve(self, language):
+        """Return the supported language code for a code, or the default language"""
+        language = LANGUAGE_ALIASES.get(language, language)
+        return language if language in self.languages else self.default
+
+    def get(self, message, language):
+        """Return the raw template of a message in a language"""
+        template = self.templates.get((message, language))
+        if template is None:
+            return self.templates[message, self.resolve(language)]
+        return template
+
+    def format(self, message, language, **values):
+        """
+        Return a message in a language with its placeholders filled in
+
+        Raises:
+            KeyError: If the message does not exist or a placeholder has no value
+        """
+        key = (message, language)
+        if key not in self.templates:
+            key = (message, self.resolve(language))
+        formatter = self.formatters.get(key)
+        return formatter(**values) if formatter else self.templates[key]
+
+    def is_static(self, message, language):
+        """Whether a message has no placeholders, so its text never changes"""
+        return (message, self.resolve(language)) not in self.formatters
+
+    def coverage(self):
+        """
+        Report how complete each language is
+
+        A translation is counted as broken when its placeholders differ from
+        the default language's, since filling it in would fail or drop values.
+
+        Returns:
+            dict: language -> {'translated', 'total', 'missing', 'broken'}
+        """
+        report = {}
+        for language in self.languages:
+            missing, broken = [], []
+            for name, texts in self.messages.items():
+                if 'all' in texts:
+                    continue
+                if language not in texts:
+                    missing.append(name)
+                elif _fields(texts[language]) != _fields(texts[self.default]):
+                    broken.append(name)
+            total = sum(1 for texts in self.messages.values() if 'all' not in texts)
+            report[language] = {'translated': total - len(missing), 'total': total,
+                                'missing': missing, 'broken': broken}
+        return report
+
+
+catalog = Catalog(MESSAGES)
+
+
+def language_name(code):
+    """English name of a language code, e.g. for the patient list"""
+    return LANGUAGE_NAMES.get(LANGUAGE_ALIASES.get(code, code), code or 'Unknown')
+
+
+def main():
+    for language, entry in catalog.coverage().items():
+        print(f"{language} ({LANGUAGE_NAMES[language]}): {entry['translated']}/{entry['total']} translated")
+        for name in entry['missing']:
+            print(f"  missing: {name}")
+        for name in entry['broken']:
+            print(f"  placeholders differ from {DEFAULT_LANGUAGE}: {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Columnar event storage for Tujali Telehealth
+
+High-volume, append-mostly collections such as user_interactions are kept by
+MemoryStorage in an EventTable instead of a list of record objects. Each field
+lives in its own typed array (8 bytes per id, patient id and timestamp, 2 bytes
+per type code) and repeated descriptions and metadata are stored once in
+interned side tables, so a row costs a few dozen bytes instead of a full
+object. Records are only materialized when a caller reads them, and counts per
+patient or per type are answered from the arrays without building any records.
+
+Timestamps are stored as microseconds since 1970-01-01 and must be naive
+datetimes, like the datetime.now() values the models use.
+"""
+
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Stored in the key column for records whose key field is None
+NULL_KEY = -(2 ** 63)
+
+
+def _freeze(value):
+    """
+    Hashable stand-in for a metadata value, used to intern equal mappings once
+
+    Types are kept, so {1: x} and {'1': x}, or 1 and True, are interned apart.
+    """
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted(((_freeze(k), _freeze(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (set, frozenset)):
+        return (type(value).__name__,) + tuple(sorted((_freeze(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return ('repr', repr(value))
+    return (type(value).__name__, value)
+
+
+class InternTable:
+    """Append-only table of distinct values addressed by a small integer code"""
+    def __init__(self, key=None):
+        """
+        Args:
+            key (callable, optional): Maps a value to the hashable key it is interned by
+        """
+        self.key = key
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        """Return the code of a value, adding it to the table on first use"""
+        key = self.key(value) if self.key else value
+        code = self.codes.get(key)
+        if code is None:
+            code = len(self.values)
+            self.codes[key] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        """Return the code of a value, or None if the table has never seen it"""
+        return self.codes.get(self.key(value) if self.key else value)
+
+    def __getstate__(self):
+        # The code dict is rebuilt on load, so only the values are pickled
+        return {'key': self.key, 'values': self.values}
+
+    def __setstate__(self, state):
+        self.key = state['key']
+        self.values = state['values']
+        self.codes = {}
+        for code, value in enumerate(self.values):
+            self.codes.setdefault(self.key(value) if self.key else value, code)
+
+
+class EventTable:
+    """
+    Column store for event records with the fields
+    id, <key>, <type>, <text>, <data> and <time>
+
+    For user_interactions these are patient_id, interaction_type, description,
+    metadata and created_at. Rows are appended in ID order; an out-of-order ID
+    switches ID lookups from binary search to a position dict. The caller
+    (MemoryStorage) serializes writes and reads with the collection's lock.
+    """
+    def __init__(self, key, type, text, data, time='created_at'):
+        """
+        Args:
+            key (str): Integer field rows are bucketed by, e.g. 'patient_id'
+            type (str): Low-cardinality string field stored as a 2-byte code
+            text (str): String field stored once per distinct value
+            data (str): Mapping field stored once per distinct value, read-only on records
+            time (str): Naive datetime field
+        """
+        self.fields = {'key': key, 'type': type, 'text': text, 'data': data, 'time': time}
+        self.record_type = None  # set from the first record appended
+        self.ids = array('q')
+        self.keys = array('q')
+        self.types = array('H')
+        self.times = array('q')
+        self.texts = array('I')
+        self.datas = array('I')
+        self.type_table = InternTable()
+        self.text_table = InternTable()
+        self.data_table = InternTable(_freeze)
+        self._build_lookups()
+
+    def _build_lookups(self):
+        """Rebuild the per-key row buckets and the ID lookup from the columns"""
+        self.buckets = {}  # key -> array of row positions in ascending order
+        for position, key in enumerate(self.keys):
+            self.buckets.setdefault(key, array('I')).append(position)
+        self.positions = None  # id -> row position, only once IDs are out of order
+        if any(self.ids[i] >= self.ids[i + 1] for i in range(len(self.ids) - 1)):
+            self.positions = {record_id: position for position, record_id in enumerate(self.ids)}
+
+    def __getstate__(self):
+        # Buckets and ID lookups are derived data, rebuilt on load
+        state = self.__dict__.copy()
+        del state['buckets'], state['positions']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lookups()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for position in range(len(self.ids)):
+            yield self._record(position)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self._record(p) for p in range(len(self.ids))[position]]
+        if position < 0:
+            position += len(self.ids)
+        if not 0 <= position < len(self.ids):
+            raise IndexError('EventTable index out of range')
+        return self._record(position)
+
+    def copy(self):
+        """Return an independent table with the same rows, e.g. for a snapshot"""
+        table = EventTable.__new__(EventTable)
+        table.__dict__.update(self.__getstate__())
+        for column in ('ids', 'keys', 'types', 'times', 'texts', 'datas'):
+            setattr(table, column, array(getattr(self, column).typecode, getattr(self, column)))
+        # Interned values are never changed in place, so shallow copies are enough
+        for name in ('type_table', 'text_table', 'data_table'):
+            source = getattr(self, name)
+            interned = InternTable(source.key)
+            interned.values = list(source.values)
+            interned.codes = dict(source.codes)
+            setattr(table, name, interned)
+        table._build_lookups()
+        return table
+
+    def _columns(self, record):
+        """Encode a record as its column values"""
+        fields = self.fields
+        key = getattr(record, fields['key'])
+        return (record.id,
+                NULL_KEY if key is None else key,
+                self.type_table.code(getattr(record, fields['type'])),
+                (getattr(record, fields['time']) - EPOCH) // MICROSECOND,
+                self.text_table.code(getattr(record, fields['text'])),
+                self.data_table.code(dict(getattr(record, fields['data']) or {})))
+
+    def _record(self, position):
+        """Materialize the record stored at a row position"""
+        fields = self.fields
+        record = self.record_type.__new__(self.record_type)
+        key = self.keys[position]
+        record.id = self.ids[position]
+        setattr(record, fields['key'], None if key == NULL_KEY else key)
+        setattr(record, fields['type'], self.type_table.values[self.types[position]])
+        setattr(record, fields['text'], self.text_table.values[self.texts[position]])
+        # Rows share their interned mapping, so records only get a read-only view of it
+        setattr(record, fields['data'], MappingProxyType(self.data_table.values[self.datas[position]]))
+        setattr(record, fields['time'], EPOCH + self.times[position] * MICROSECOND)
+        return record
+
+    def position(self, record_id):
+        """Return the row position of an ID, or None if it is not stored"""
+        if self.positions is not None:
+            return self.positions.get(record_id)
+        position = bisect_left(self.ids, record_id)
+        if position < len(self.ids) and self.ids[position] == record_id:
+            return position
+        return None
+
+    def append(self, record):
+        """
+        Add a record as a new row
+
+        Raises:
+            ValueError: If a row with the record's ID already exists
+        """
+        if self.position(record.id) is not None:
+            raise ValueError(f"Duplicate id in event table: {record.id}")
+        if self.record_type is None:
+            self.record_type = type(record)
+        record_id, key, type_code, time, text, data = self._columns(record)
+        position = len(self.ids)
+        if self.positions is None and self.ids and record_id < self.ids[-1]:
+            self.positions = {existing: p for p, existing in enumerate(self.ids)}
+        if self.positions is not None:
+            self.positions[record_id] = position
+        self.ids.append(record_id)
+        self.keys.append(key)
+        self.types.append(type_code)
+        self.times.append(time)
+        self.texts.append(text)
+        self.datas.append(data)
+        self.buckets.setdefault(key, array('I')).append(position)
+        return record
+
+    def extend(self, records):
+        """Append several records in ID order"""
+        for record in sorted(records, key=lambda record: record.id):
+            self.append(record)
+
+    def put(self, record):
+        """Insert a record, or overwrite the row that has its ID"""
+        position = self.position(record.id)
+        if position is None:
+            return self.append(record)
+        record_id, key, type_code, time, text, data = self._columns(record)
+        old_key = self.keys[position]
+        if key != old_key:
+            bucket = self.buckets[old_key]
+            del bucket[bisect_left(bucket, position)]
+            insort(self.buckets.setdefault(key, array('I')), position)
+        self.keys[position] = key
+        self.types[position] = type_code
+        self.times[position] = time
+        self.texts[position] = text
+        self.datas[position] = data
+        return record
+
+    def get(self, record_id):
+        """Return the record with an ID, or None"""
+        position = self.position(record_id)
+        return None if position is None else self._record(position)
+
+    def _scan(self, criteria):
+        """
+        Row positions matching criteria, in insertion order
+
+        The key, type and id fields are compared on their columns; any other
+        field is compared on materialized records.
+        """
+        criteria = dict(criteria)
+        fields = self.fields
+        if fields['key'] in criteria:
+            key = criteria.pop(fields['key'])
+            positions = self.buckets.get(NULL_KEY if key is None else key, ())
+        else:
+            positions = range(len(self.ids))
+
+        if 'id' in criteria:
+            position = self.position(criteria.pop('id'))
+            # Buckets are in ascending order, so membership is a binary search
+            i = bisect_left(positions, position) if position is not None else len(positions)
+            positions = [position] if i < len(positions) and positions[i] == position else []
+
+        if fields['type'] in criteria:
+            code = self.type_table.lookup(criteria.pop(fields['type']))
+            if code is None:
+                return []
+            types = self.types
+            positions = [p for p in positions if types[p] == code]
+
+        if criteria:
+            positions = [p for p in positions
+                         if all(getattr(self._record(p), f, None) == v for f, v in criteria.items())]
+        return positions
+
+    def find(self, **criteria):
+        """Return the records matching all the given field values, in insertion order"""
+        return [self._record(position) for position in self._scan(criteria)]
+
+    def count(self, **criteria):
+        """Count the records matching all the given field values without materializing them"""
+        return len(self._scan(criteria))
+
+    def count_by(self, field, **criteria):
+        """
+        Count matching records per value of a field
+
+        Returns:
+            dict: field value -> number of records
+        """
+        positions = self._scan(criteria)
+        fields = self.fields
+        if field == fields['key']:
+            if not criteria:
+                return {(None if key == NULL_KEY else key): len(bucket)
+                        for key, bucket in self.buckets.items() if bucket}
+            keys = self.keys
+            counts = Counter(keys[p] for p in positions)
+            return {(None if key == NULL_KEY else key): n for key, n in counts.items()}
+        if field == fields['type']:
+            types, values = self.types, self.type_table.values
+            return {values[code]: n for code, n in Counter(types[p] for p in positions).items()}
+        return dict(Counter(getattr(self._record(p), field, None) for p in positions))
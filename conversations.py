@@ -0,0 +1,184 @@
+"""
+Conversation index for Tujali Telehealth
+
+The messages between a provider and a patient form a conversation. The index
+keeps one Conversation per provider and patient, holding its latest message,
+the provider's read watermark (the last message they have read; see
+models.ReadMark) and the number of patient messages after it. Each provider
+also has an inbox that keeps their conversations in order of their latest
+message, and a total of their unread messages for the dashboard badge. A
+provider's conversations are loaded from the store the first time they are
+asked for. After that, Message.create and Message.mark_as_read keep them
+current, so listing an inbox or counting unread messages never scans the
+messages again. verify() recounts loaded inboxes to check that they agree
+with the store.
+
+The index is kept per process. When several worker processes share the
+store, each of them can add messages, so the index is built with keep=False
+and loads the inbox afresh on every call instead.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class Conversation:
+    """Latest message and unread count of a provider's conversation with a patient"""
+    __slots__ = ('provider_id', 'patient_id', 'latest', 'read_to', 'unread')
+
+    def __init__(self, provider_id, patient_id, read_to=0):
+        self.provider_id = provider_id
+        self.patient_id = patient_id
+        self.latest = None  # Message
+        self.read_to = read_to  # ID of the last message the provider has read
+        self.unread = 0  # patient messages after read_to
+
+    @property
+    def last_at(self):
+        """Time of the latest message"""
+        return self.latest.created_at if self.latest else None
+
+    def add(self, message):
+        """Count a message into the conversation"""
+        # Messages are stored in ID order, so the highest ID is the latest message
+        if self.latest is None or message.id > self.latest.id:
+            self.latest = message
+        # is_read is only set on messages read before read watermarks were kept
+        if message.sender_type == 'patient' and message.id > self.read_to and not message.is_read:
+            self.unread += 1
+
+
+class ConversationIndex:
+    """Conversations of each provider, most recent first"""
+    def __init__(self, load, load_marks, keep=True):
+        """
+        Args:
+            load (callable): load(provider_id) returns every message of a provider
+            load_marks (callable): load_marks(provider_id) returns the provider's read
+                watermarks as a dict of patient_id -> last read message ID
+            keep (bool): Keep loaded inboxes; False when other processes add messages too
+        """
+        self.load = load
+        self.load_marks = load_marks
+        self.keep = keep
+        self.inboxes = {}  # provider_id -> OrderedDict of patient_id -> Conversation, oldest first
+        self.unread = {}  # provider_id -> unread messages in all of the provider's conversations
+        # Reentrant, so a caller can hold it across storing a message and added()
+        self.lock = threading.RLock()
+
+    def _build(self, provider_id):
+        """Build a provider's inbox from the store"""
+        marks = self.load_marks(provider_id)
+        conversations = {}
+        for message in self.load(provider_id):
+            conversation = conversations.get(message.patient_id)
+            if conversation is None:
+                conversation = conversations[message.patient_id] = Conversation(
+                    provider_id, message.patient_id, marks.get(message.patient_id, 0))
+            conversation.add(message)
+        return OrderedDict((conversation.patient_id, conversation)
+                           for conversation in sorted(conversations.values(), key=lambda c: c.last_at))
+
+    def _inbox(self, provider_id):
+        """A provider's inbox, loading it on first use; the caller holds the lock"""
+        inbox = self.inboxes.get(provider_id)
+        if inbox is None:
+            inbox = self._build(provider_id)
+            if self.keep:
+                self.inboxes[provider_id] = inbox
+                self.unread[provider_id] = sum(c.unread for c in inbox.values())
+        return inbox
+
+    def inbox(self, provider_id):
+        """
+        Returns:
+            list: The provider's Conversations, most recent first
+        """
+        with self.lock:
+            return list(reversed(self._inbox(provider_id).values()))
+
+    def unread_count(self, provider_id):
+        """Number of patient messages the provider has not read"""
+        with self.lock:
+            inbox = self._inbox(provider_id)
+            if not self.keep:
+                return sum(c.unread for c in inbox.values())
+            return self.unread[provider_id]
+
+    def get(self, provider_id, patient_id):
+        """Return a conversation, or None if the patient and provider have no messages"""
+        with self.lock:
+            return self._inbox(provider_id).get(patient_id)
+
+    def added(self, message):
+        """
+        Count a stored message into its conversation and move the conversation
+        to the top of the inbox. Hold the lock while storing the message, so an
+        inbox loaded in between does not count it twice.
+        """
+        with self.lock:
+            inbox = self.inboxes.get(message.provider_id)
+            if inbox is None:
+                return  # the message is counted when the inbox is loaded
+            conversation = inbox.get(message.patient_id)
+            if conversation is None:
+                conversation = inbox[message.patient_id] = Conversation(message.provider_id,
+                                                                        message.patient_id)
+            unread = conversation.unread
+            conversation.add(message)
+            inbox.move_to_end(message.patient_id)
+            self.unread[message.provider_id] += conversation.unread - unread
+
+    def read(self, provider_id, patient_id, message_id):
+        """
+        Record that the provider has read a conversation up to its latest
+        message; hold the lock from looking up that message until this call
+        """
+        with self.lock:
+            conversation = self.inboxes.get(provider_id, {}).get(patient_id)
+            if conversation is not None:
+                self.unread[provider_id] -= conversation.unread
+                conversation.read_to = message_id
+                conversation.unread = 0
+
+    def verify(self, repair=False):
+        """
+        Recount every loaded inbox from the store
+
+        Args:
+            repair (bool): Replace inboxes that disagree with their recount
+
+        Returns:
+            list: A dict per count that disagrees, with the kept and the recounted value
+        """
+        mismatches = []
+        with self.lock:
+            for provider_id, inbox in list(self.inboxes.items()):
+                recount = self._build(provider_id)
+                found = len(mismatches)
+                for patient_id in inbox.keys() | recount.keys():
+                    kept = inbox[patient_id].unread if patient_id in inbox else None
+                    actual = recount[patient_id].unread if patient_id in recount else None
+                    if kept != actual:
+                        mismatches.append({'counter': 'conversation_unread', 'provider_id': provider_id,
+                                           'patient_id': patient_id, 'kept': kept, 'recounted': actual})
+                total = sum(c.unread for c in recount.values())
+                if self.unread[provider_id] != total:
+                    mismatches.append({'counter': 'provider_unread', 'provider_id': provider_id,
+                                       'kept': self.unread[provider_id], 'recounted': total})
+                if repair and len(mismatches) > found:
+                    self.inboxes[provider_id] = recount
+                    self.unread[provider_id] = total
+        return mismatches
+
+    def forget(self, provider_id):
+        """Forget a provider's inbox, so it is loaded from the store again"""
+        with self.lock:
+            self.inboxes.pop(provider_id, None)
+            self.unread.pop(provider_id, None)
+
+    def clear(self):
+        """Forget every loaded inbox"""
+        with self.lock:
+            self.inboxes.clear()
+            self.unread.clear()
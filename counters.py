@@ -0,0 +1,97 @@
+"""
+Maintained record counts for Tujali Telehealth dashboards
+
+Dashboard badges count a provider's records by status (pending appointments,
+for example) on every page load. StatusCounts keeps those counts per provider
+and updates them when a record is created or changes status. A provider's
+counts are loaded from the store the first time they are asked for.
+verify() recounts loaded providers to check that the counts agree with the
+store.
+
+Like the conversation index, counts are only kept when no other process
+writes to the store; with keep=False every count is taken from the store.
+"""
+
+import threading
+from collections import Counter
+
+
+class StatusCounts:
+    """Counts of each provider's records per status"""
+    def __init__(self, load, field='status', keep=True):
+        """
+        Args:
+            load (callable): load(provider_id, **criteria) returns a provider's records matching criteria
+            field (str): Record field holding the status
+            keep (bool): Keep loaded counts; False when other processes write records too
+        """
+        self.load = load
+        self.field = field
+        self.keep = keep
+        self.counts = {}  # provider_id -> Counter of status -> records
+        # Reentrant, so a caller can hold it across writing a record and updating its count
+        self.lock = threading.RLock()
+
+    def _recount(self, provider_id):
+        """Count a provider's records in the store"""
+        return Counter(getattr(record, self.field) for record in self.load(provider_id))
+
+    def _counts(self, provider_id):
+        """A provider's counts, loading them on first use; the caller holds the lock"""
+        counts = self.counts.get(provider_id)
+        if counts is None:
+            counts = self.counts[provider_id] = self._recount(provider_id)
+        return counts
+
+    def count(self, provider_id, status):
+        """Number of a provider's records with a status"""
+        if not self.keep:
+            return len(self.load(provider_id, **{self.field: status}))
+        with self.lock:
+            return self._counts(provider_id)[status]
+
+    def added(self, provider_id, status):
+        """Count a stored record; hold the lock while storing it"""
+        with self.lock:
+            counts = self.counts.get(provider_id)
+            if counts is not None:  # otherwise the record is counted when the counts are loaded
+                counts[status] += 1
+
+    def changed(self, provider_id, old, new):
+        """Move a record from one status to another; hold the lock while saving it"""
+        if old == new:
+            return
+        with self.lock:
+            counts = self.counts.get(provider_id)
+            if counts is not None:
+                counts[old] -= 1
+                counts[new] += 1
+
+    def verify(self, repair=False):
+        """
+        Recount every loaded provider from the store
+
+        Args:
+            repair (bool): Replace counts that disagree with their recount
+
+        Returns:
+            list: A dict per count that disagrees, with the kept and the recounted value
+        """
+        mismatches = []
+        with self.lock:
+            for provider_id, counts in list(self.counts.items()):
+                recount = self._recount(provider_id)
+                found = len(mismatches)
+                for status in counts.keys() | recount.keys():
+                    if counts[status] != recount[status]:
+                        mismatches.append({'counter': f'{self.field}_count', 'provider_id': provider_id,
+                                           'status': status, 'kept': counts[status],
+                                           'recounted': recount[status]})
+                if repair and len(mismatches) > found:
+                    self.counts[provider_id] = recount
+        return mismatches
+
+    def clear(self):
+        """Forget every loaded count"""
+        with self.lock:
+            self.counts.clear()
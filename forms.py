@@ -175,3 +175,42 @@ class PaymentRecordForm(FlaskForm):
                                 validators=[DataRequired()])
     reference = StringField('Reference/Transaction ID', validators=[Optional()])
     submit = SubmitField('Record Payment')
+
+
+class AppointmentImportForm(FlaskForm):
+    """Row of a bulk appointment import (see bulk.py)"""
+    patient_id = IntegerField('Patient ID', validators=[DataRequired(), NumberRange(min=1)])
+    provider_id = IntegerField('Provider ID', validators=[DataRequired(), NumberRange(min=1)])
+    date = StringField('Date', validators=[DataRequired()])
+    time = StringField('Time', validators=[DataRequired()])
+    status = SelectField('Status', 
+                        choices=[('pending', 'Pending'),
+                                ('confirmed', 'Confirmed'),
+                                ('completed', 'Completed'),
+                                ('cancelled', 'Cancelled')], 
+                        validators=[Optional()])
+    price = DecimalField('Price (KSh)', validators=[Optional(), NumberRange(min=0)])
+    payment_status = SelectField('Payment Status', 
+                                choices=[('pending', 'Pending'),
+                                        ('completed', 'Completed'),
+                                        ('waived', 'Waived')], 
+                                validators=[Optional()])
+    notes = TextAreaField('Notes', validators=[Optional()])
+
+
+class PaymentImportForm(FlaskForm):
+    """Row of a bulk payment import (see bulk.py)"""
+    appointment_id = IntegerField('Appointment ID', validators=[DataRequired(), NumberRange(min=1)])
+    amount = DecimalField('Amount (KSh)', validators=[DataRequired(), NumberRange(min=0)])
+    phone_number = StringField('Phone Number', validators=[DataRequired()])
+    mpesa_reference = StringField('M-Pesa Reference', validators=[Optional()])
+    status = SelectField('Status', 
+                        choices=[('pending', 'Pending'),
+                                ('completed', 'Completed'),
+                                ('failed', 'Failed')], 
+                        validators=[Optional()])
+    payment_method = SelectField('Payment Method', 
+                                choices=[('mpesa', 'M-Pesa'),
+                                        ('cash', 'Cash'),
+                                        ('insurance', 'Insurance')], 
+                                validators=[Optional()])
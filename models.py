@@ -1,40 +1,165 @@
 from flask_login import UserMixin
 from datetime import datetime, timedelta
 from math import radians, cos, sin, asin, sqrt
+import os
+import sys
+import copy
 import uuid
+from types import MappingProxyType
+from storage import create_storage, MemoryStorage, SQLiteStorage
+from columnar import EventTable
+from catalog import language_name
+from persistence import enable_persistence
+from slots import SlotInventory, RELEASED_STATUSES
+from conversations import ConversationIndex
+from counters import StatusCounts
 
-# In-memory database for prototype
-db = {
-    'users': [],
-    'providers': [],
-    'patients': [],
-    'appointments': [],
-    'messages': [],
-    'health_info': [],
-    'user_interactions': [],
-    'payments': []
+# Collections held by the storage backend
+COLLECTIONS = (
+    'users', 'providers', 'patients', 'appointments', 'messages', 'health_info',
+    'user_interactions', 'payments', 'prescriptions', 'walkin_patients',
+    'lab_tests', 'lab_results', 'bills', 'read_marks', 'notifications'
+)
+
+# Secondary (foreign-key) indexes to maintain per collection. Each entry is a
+# tuple of field names; records are bucketed by the values of those fields.
+SECONDARY_INDEXES = {
+    'users': [('username',)],
+    'providers': [('user_id',)],
+    'appointments': [('patient_id',), ('provider_id',), ('provider_id', 'status')],
+    'messages': [('provider_id',), ('provider_id', 'patient_id')],
+    'health_info': [('language',)],
+    'user_interactions': [('patient_id',)],
+    'payments': [('appointment_id',)],
+    'prescriptions': [('patient_id',), ('provider_id',)],
+    'walkin_patients': [('provider_id',), ('provider_id', 'status')],
+    'lab_tests': [('patient_id',), ('provider_id',)],
+    'lab_results': [('lab_test_id',)],
+    'bills': [('patient_id',), ('provider_id',)],
+    'read_marks': [('provider_id',), ('provider_id', 'patient_id')],
+    'notifications': [('status',), ('patient_id',)]
 }
 
-def init_db():
-    """Initialize demo data for the in-memory database"""
-    # Always reset users to have consistent state
-    db['users'] = []
-    db['providers'] = []
+# Country code assumed for local numbers such as 0711001122
+DEFAULT_COUNTRY_CODE = '254'
+
+# Messages per page of a conversation's history
+MESSAGE_PAGE_SIZE = 20
+
+def normalize_phone(phone_number):
+    """
+    Normalize a phone number to E.164 form so that '0711 001 122',
+    '254711001122' and '+254711001122' all map to the same key
+    
+    Args:
+        phone_number (str): Phone number as entered or sent by the gateway
+        
+    Returns:
+        str: Normalized phone number, or '' if there are no digits
+    """
+    if not phone_number:
+        return ''
+    digits = ''.join(ch for ch in str(phone_number) if ch.isdigit())
+    if not digits:
+        return ''
+    if digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = DEFAULT_COUNTRY_CODE + digits[1:]
+    return '+' + digits
+
+# Unique fields per collection, with the normalizer applied before comparing
+UNIQUE_INDEXES = {
+    'patients': {'phone_number': normalize_phone}
+}
+
+# Fields unique together among the rows matching a condition. SQLite enforces
+# these, so two worker processes cannot book the same slot; in memory the slot
+# inventory's lock does (see slots.py)
+UNIQUE_WHERE = {
+    'appointments': [(('provider_id', 'date', 'time'),
+                      f"status NOT IN ({', '.join(repr(s) for s in sorted(RELEASED_STATUSES))})")]
+}
+
+# Append-mostly event collections the memory backend keeps in typed columns
+# (see columnar.py) instead of one object per record
+COLUMNAR_COLLECTIONS = {
+    'user_interactions': lambda: EventTable(key='patient_id', type='interaction_type',
+                                            text='description', data='metadata')
+}
+
+# Storage backend (see storage.py); in-memory unless TUJALI_STORAGE says otherwise
+store = create_storage(os.environ.get('TUJALI_STORAGE', 'memory'),
+                       COLLECTIONS, SECONDARY_INDEXES, UNIQUE_INDEXES, COLUMNAR_COLLECTIONS, UNIQUE_WHERE)
+
+# Collection name -> records. A live dict of lists (and EventTables for the
+# columnar collections) for the in-memory backend, a read-only view for SQLite.
+db = store.collections()
+
+# Taken appointment slots per provider and day (see slots.py)
+slots = SlotInventory(lambda provider_id, date: store.find('appointments', provider_id=provider_id, date=date))
+
+# Latest message and unread count of each conversation (see conversations.py)
+conversations = ConversationIndex(lambda provider_id: store.find('messages', provider_id=provider_id),
+                                  lambda provider_id: ReadMark.get_by_provider(provider_id),
+                                  keep=isinstance(store, MemoryStorage))
+
+# Appointments per provider and status, for dashboard badges (see counters.py)
+appointment_counts = StatusCounts(
+    lambda provider_id, **criteria: store.find('appointments', provider_id=provider_id, **criteria),
+    keep=isinstance(store, MemoryStorage))
+
+def check_counters(repair=False):
+    """
+    Compare the maintained unread and appointment counts with a full recount
+    
+    Args:
+        repair (bool): Replace counts that disagree with their recount
+    
+    Returns:
+        list: A dict per count that disagrees, with the kept and the recounted value
+    """
+    return conversations.verify(repair) + appointment_counts.verify(repair)
+
+def init_db(force=False):
+    """
+    Initialize demo data in the database
+    
+    Seeding only happens while the database has no users (or when force is
+    True), so records kept by a persistent storage backend survive restarts
+    and repeated calls keep the admin user without wiping other data.
+    
+    Args:
+        force (bool): Clear every collection and reseed even if data exists
+    """
+    # One transaction, so workers starting together against the same SQLite
+    # file wait for the first one's seed instead of seeding twice
+    with store.transaction():
+        if store.count('users') and not force:
+            return
+        _seed()
+
+def _seed():
+    """Clear the store and create the demo records"""
+    store.clear()
+    slots.clear()
+    conversations.clear()
+    appointment_counts.clear()
     
     # Create a default super admin user
     user = User(1, 'admin', 'admin@tujali.com', 'hashed_admin123', 'super_admin', 'administration', 
                ['clinical', 'finance', 'laboratory', 'pharmacy', 'administration'])
-    db['users'].append(user)
+    store.insert('users', user)
     print(f"Super admin created: {user.username}, role: {user.role}")
     
     # Create department-specific users
     finance_user = User(2, 'finance_user', 'finance@tujali.com', 'hashed_finance123', 
                        'finance', 'finance', ['billing', 'payments'])
-    db['users'].append(finance_user)
+    store.insert('users', finance_user)
     
     lab_user = User(3, 'lab_user', 'lab@tujali.com', 'hashed_lab123', 
                    'lab_tech', 'laboratory', ['lab_tests', 'results'])
-    db['users'].append(lab_user)
+    store.insert('users', lab_user)
     
     # Create providers with locations and coordinates
     provider1 = Provider(
@@ -72,14 +197,13 @@ def init_db():
         'Eldoret, Kenya',
         (0.5143, 35.2698)  # Eldoret coordinates
     )
-    db['providers'].append(provider1)
-    db['providers'].append(provider2)
-    db['providers'].append(provider3)
-    db['providers'].append(provider4)
-    db['providers'].append(provider5)
-    
-    # Clear and add health information
-    db['health_info'] = []
+    store.insert('providers', provider1)
+    store.insert('providers', provider2)
+    store.insert('providers', provider3)
+    store.insert('providers', provider4)
+    store.insert('providers', provider5)
+    
+    # Add health information
     info1 = HealthInfo(1, 'COVID-19 Prevention', 
                      'Wash hands regularly, wear masks in public, maintain social distance.', 
                      'en')
@@ -92,13 +216,12 @@ def init_db():
     info4 = HealthInfo(4, 'Ushauri wa Afya ya Uzazi', 
                      'Uchunguzi wa mara kwa mara, lishe bora, na kupumzika kwa kutosha ni muhimu wakati wa ujauzito.', 
                      'sw')
-    db['health_info'].append(info1)
-    db['health_info'].append(info2)
-    db['health_info'].append(info3)
-    db['health_info'].append(info4)
+    store.insert('health_info', info1)
+    store.insert('health_info', info2)
+    store.insert('health_info', info3)
+    store.insert('health_info', info4)
     
     # Add sample patients with locations and coordinates
-    db['patients'] = []
     patient1 = Patient(
         1, '+254711001122', 'Jane Wanjiku', 32, 'Female', 
         'Nairobi', 'en', 
@@ -124,11 +247,11 @@ def init_db():
         'Eldoret', 'en',
         (0.5200, 35.2650)  # Eldoret coordinates (slight variation)
     )
-    db['patients'].append(patient1)
-    db['patients'].append(patient2)
-    db['patients'].append(patient3)
-    db['patients'].append(patient4)
-    db['patients'].append(patient5)
+    store.insert('patients', patient1)
+    store.insert('patients', patient2)
+    store.insert('patients', patient3)
+    store.insert('patients', patient4)
+    store.insert('patients', patient5)
     
     # Add symptoms to patients with varied types
     patient1.add_symptom('Persistent headache and fever for 3 days')
@@ -151,35 +274,32 @@ def init_db():
     patient5.add_symptom('Respiratory difficulty when exercising')
     
     # Add sample appointments
-    db['appointments'] = []
     appt1 = Appointment(1, 1, 1, '25-03-2025', '10:00 AM', 'confirmed', 500.00, 'completed')
     appt2 = Appointment(2, 2, 1, '26-03-2025', '2:30 PM', 'pending', 500.00, 'pending')
     appt3 = Appointment(3, 3, 1, '24-03-2025', '11:15 AM', 'completed', 750.00, 'pending')
     appt4 = Appointment(4, 4, 1, '27-03-2025', '9:00 AM', 'pending', 350.00, 'completed')
     appt5 = Appointment(5, 5, 1, '23-03-2025', '3:45 PM', 'cancelled', 400.00, 'pending')
-    db['appointments'].append(appt1)
-    db['appointments'].append(appt2)
-    db['appointments'].append(appt3)
-    db['appointments'].append(appt4)
-    db['appointments'].append(appt5)
+    store.insert('appointments', appt1)
+    store.insert('appointments', appt2)
+    store.insert('appointments', appt3)
+    store.insert('appointments', appt4)
+    store.insert('appointments', appt5)
     
     # Add sample messages
-    db['messages'] = []
     msg1 = Message(1, 1, 1, 'Hello Dr. Doe, I have been experiencing severe headaches.', 'patient')
     msg2 = Message(2, 1, 1, 'Hi Jane, I recommend you come in for a check-up. When are you available?', 'provider')
     msg3 = Message(3, 1, 1, 'I can come tomorrow morning if that works.', 'patient')
     msg4 = Message(4, 1, 1, 'Perfect. I have scheduled you for 10 AM tomorrow.', 'provider')
     msg5 = Message(5, 1, 2, 'Habari daktari, nina maumivu ya kifua.', 'patient', is_read=False)
     msg6 = Message(6, 1, 3, 'Doctor, the rash on my arms is getting worse.', 'patient', is_read=False)
-    db['messages'].append(msg1)
-    db['messages'].append(msg2)
-    db['messages'].append(msg3)
-    db['messages'].append(msg4)
-    db['messages'].append(msg5)
-    db['messages'].append(msg6)
+    store.insert('messages', msg1)
+    store.insert('messages', msg2)
+    store.insert('messages', msg3)
+    store.insert('messages', msg4)
+    store.insert('messages', msg5)
+    store.insert('messages', msg6)
     
     # Add sample user interactions for journey tracking
-    db['user_interactions'] = []
     
     # Sample interactions for Patient 1 (Jane Wanjiku)
     # USSD interactions
@@ -216,16 +336,8 @@ def init_db():
     
     # Add the interactions to the database
     for i in range(1, 19):
-        db['user_interactions'].append(eval(f"interaction{i}"))
+        store.insert('user_interactions', eval(f"interaction{i}"))
         
-    # Initialize all collections
-    db['payments'] = []
-    db['prescriptions'] = []
-    db['walkin_patients'] = []
-    db['lab_tests'] = []
-    db['lab_results'] = []
-    db['bills'] = []
-    
     # Add some sample payments
     payment1 = Payment(
         1,
@@ -262,9 +374,9 @@ def init_db():
         datetime.now() - timedelta(days=7)  # paid_at
     )
     
-    db['payments'].append(payment1)
-    db['payments'].append(payment2)
-    db['payments'].append(payment3)
+    store.insert('payments', payment1)
+    store.insert('payments', payment2)
+    store.insert('payments', payment3)
 
 def generate_password_hash(password):
     """Mock password hashing for prototype"""
@@ -277,6 +389,25 @@ def check_password_hash(hashed_password, password):
     expected = f"hashed_{password}"
     return hashed_password == expected
 
+class CompactModel:
+    """
+    Base for models kept in large numbers (patients, messages, interactions...)
+
+    Subclasses list their fields in __slots__, so instances have no per-row
+    __dict__ and extra attributes cannot be attached to shared records.
+    """
+    __slots__ = ()
+    
+    def __setstate__(self, state):
+        """Restore from slot state, or from a __dict__ pickled before the model used __slots__"""
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for field, value in state.items():
+            setattr(self, field, value)
+
+# Shared read-only metadata for interactions that carry none
+EMPTY_METADATA = MappingProxyType({})
+
 class User(UserMixin):
     """User model for authentication"""
     def __init__(self, id, username, email, password_hash, role='provider', department=None, permissions=None):
@@ -302,46 +433,41 @@ class User(UserMixin):
     @staticmethod
     def get_by_role(role):
         """Get all users by role"""
-        return [user for user in db['users'] if user.role == role]
+        return store.find('users', role=role)
     
     @staticmethod
     def get_by_department(department):
         """Get all users by department"""
-        return [user for user in db['users'] if user.department == department]
+        return store.find('users', department=department)
     
     @staticmethod
     def get_by_id(user_id):
         """Get user by ID"""
-        for user in db['users']:
-            if user.id == user_id:
-                return user
-        return None
+        return store.get('users', user_id)
     
     @staticmethod
     def get_by_username(username):
         """Get user by username"""
-        for user in db['users']:
-            if user.username == username:
-                return user
-        return None
+        users = store.find('users', username=username)
+        return users[0] if users else None
     
     @staticmethod
     def create(username, email, password_hash, role='provider', department=None, permissions=None):
         """Create a new user"""
-        user_id = len(db['users']) + 1
+        user_id = store.next_id('users')
         user = User(user_id, username, email, password_hash, role, department, permissions)
-        db['users'].append(user)
+        store.insert('users', user)
         return user
     
     @staticmethod
     def username_exists(username):
         """Check if username already exists"""
-        return any(user.username == username for user in db['users'])
+        return bool(store.find('users', username=username))
     
     @staticmethod
     def email_exists(email):
         """Check if email already exists"""
-        return any(hasattr(user, 'email') and user.email == email for user in db['users'])
+        return any(hasattr(user, 'email') and user.email == email for user in store.all('users'))
 
 def haversine(lat1, lon1, lat2, lon2):
     """
@@ -373,28 +499,23 @@ class Provider:
     @staticmethod
     def get_by_user_id(user_id):
         """Get provider by user ID"""
-        for provider in db['providers']:
-            if provider.user_id == user_id:
-                return provider
-        return None
+        providers = store.find('providers', user_id=user_id)
+        return providers[0] if providers else None
     
     @staticmethod
     def get_by_id(provider_id):
         """Get provider by ID"""
-        for provider in db['providers']:
-            if provider.id == provider_id:
-                return provider
-        return None
+        return store.get('providers', provider_id)
     
     @staticmethod
     def get_all():
         """Get all providers"""
-        return db['providers']
+        return store.all('providers')
     
     @staticmethod
     def create(user_id, full_name, specialization, license_number, phone_number, location, years_experience):
         """Create a new provider"""
-        provider_id = len(db['providers']) + 1
+        provider_id = store.next_id('providers')
         provider = Provider(
             provider_id, 
             user_id, 
@@ -408,7 +529,7 @@ class Provider:
         provider.license_number = license_number
         provider.phone_number = phone_number
         provider.years_experience = years_experience
-        db['providers'].append(provider)
+        store.insert('providers', provider)
         return provider
     
     @staticmethod
@@ -430,7 +551,7 @@ class Provider:
             
         nearby_providers = []
         
-        for provider in db['providers']:
+        for provider in store.all('providers'):
             if not provider.coordinates:
                 continue  # Skip providers without coordinates
                 
@@ -448,15 +569,44 @@ class Provider:
                 if languages and not any(lang in provider.languages for lang in languages.split(',')):
                     continue
                     
-                # Add distance to provider object for sorting
+                # Add distance to a copy of the provider for sorting; the stored
+                # provider is shared with requests for other patients
+                provider = copy.copy(provider)
                 provider.distance = distance
                 nearby_providers.append(provider)
         
         # Sort by distance
         return sorted(nearby_providers, key=lambda p: p.distance)
 
-class Patient:
+class Symptom(CompactModel):
+    """
+    A symptom reported by a patient
+    
+    Supports symptom['text'] style access like the dicts used previously.
+    """
+    __slots__ = ('text', 'date', 'severity', 'category')
+    
+    def __init__(self, text, date, severity=None, category=None):
+        self.text = text
+        self.date = date
+        # Severities and categories come from a small vocabulary; share the strings
+        self.severity = sys.intern(severity) if isinstance(severity, str) else severity
+        self.category = sys.intern(category) if isinstance(category, str) else category
+    
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def get(self, key, default=None):
+        """Dict-style access with a default"""
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+class Patient(CompactModel):
     """Patient model"""
+    __slots__ = ('id', 'phone_number', 'name', 'age', 'gender', 'location', 'coordinates',
+                 'language', 'created_at', 'symptoms')
+    
     def __init__(self, id, phone_number, name, age, gender, location, language, coordinates=None, created_at=None):
         self.id = id
         self.phone_number = phone_number
@@ -467,7 +617,7 @@ class Patient:
         self.coordinates = coordinates  # Tuple (latitude, longitude) for distance calculations
         self.language = language
         self.created_at = created_at or datetime.now()
-        self.symptoms = []
+        self.symptoms = ()  # Tuple of Symptom records, oldest first
     
     @staticmethod
     def create(phone_number, name, age, gender, location, language, coordinates=None):
@@ -485,45 +635,45 @@ class Patient:
             
         Returns:
             Patient: Newly created patient object
+            
+        Raises:
+            ValueError: If a patient with the same phone number already exists
         """
-        patient_id = len(db['patients']) + 1
+        if Patient.get_by_phone(phone_number):
+            raise ValueError(f"A patient with phone number {phone_number} already exists")
+        
+        patient_id = store.next_id('patients')
         patient = Patient(patient_id, phone_number, name, age, gender, location, language, coordinates)
-        db['patients'].append(patient)
+        store.insert('patients', patient)
         return patient
     
     @staticmethod
     def get_by_phone(phone_number):
         """Get patient by phone number"""
-        for patient in db['patients']:
-            if patient.phone_number == phone_number:
-                return patient
-        return None
+        return store.get_unique('patients', 'phone_number', phone_number)
     
     @staticmethod
     def get_by_id(patient_id):
         """Get patient by ID"""
-        for patient in db['patients']:
-            if patient.id == patient_id:
-                return patient
-        return None
+        return store.get('patients', patient_id)
     
     @staticmethod
     def get_all():
         """Get all patients"""
-        return sorted(db['patients'], key=lambda p: p.created_at, reverse=True)
+        return sorted(store.all('patients'), key=lambda p: p.created_at, reverse=True)
     
     @staticmethod
     def get_recent(limit=5):
         """Get recently registered patients"""
-        patients = sorted(db['patients'], key=lambda p: p.created_at, reverse=True)
+        patients = sorted(store.all('patients'), key=lambda p: p.created_at, reverse=True)
         return patients[:limit]
     
     @staticmethod
     def get_count():
         """Get total number of patients"""
-        return len(db['patients'])
+        return store.count('patients')
     
-    def add_symptom(self, symptom, severity=None, category=None):
+    def add_symptom(self, symptom, severity=None, category=None, reported_at=None):
         """
         Add a symptom to patient record
         
@@ -531,6 +681,8 @@ class Patient:
             symptom (str): The symptom description text
             severity (str, optional): The severity of the symptom ('Mild', 'Moderate', or 'Severe')
             category (str, optional): The category of the symptom (e.g., 'respiratory', 'digestive')
+            reported_at (datetime, optional): When the symptom was reported; a
+                report already recorded with the same text and time is not added again
         """
         # Auto-detect severity if not provided
         if not severity:
@@ -562,16 +714,21 @@ class Patient:
             if not category:
                 category = 'other'
         
-        self.symptoms.append({
-            'text': symptom, 
-            'date': datetime.now(),
-            'severity': severity,
-            'category': category
-        })
+        entry = Symptom(symptom, reported_at or datetime.now(), severity, category)
+        
+        def append(patient):
+            if reported_at and any(s['text'] == symptom and s['date'] == reported_at for s in patient.symptoms):
+                return {}
+            return {'symptoms': tuple(patient.symptoms) + (entry,)}
+        
+        # Build a new tuple under the store's write lock rather than appending
+        # in place, so concurrent reports are not lost and readers never see
+        # the symptoms change under them
+        store.update('patients', self, append)
         
     def update_coordinates(self, latitude, longitude):
         """Update patient's geographical coordinates"""
-        self.coordinates = (latitude, longitude)
+        store.save('patients', self, coordinates=(latitude, longitude))
         return True
         
     def find_nearby_providers(self, max_distance=50, specialization=None):
@@ -587,16 +744,23 @@ class Patient:
         """
         if not self.coordinates:
             return Provider.get_all()
-            
-        return Provider.get_by_location(
+        
+        # Providers list the languages they speak by name, e.g. 'English, Swahili'
+        providers = Provider.get_by_location(
             self.coordinates, 
             max_distance=max_distance,
             specialization=specialization,
-            languages=self.language
+            languages=language_name(self.language)
         )
+        # Offer nearby providers in any language rather than none at all
+        return providers or Provider.get_by_location(self.coordinates, max_distance=max_distance,
+                                                     specialization=specialization)
 
-class Appointment:
+class Appointment(CompactModel):
     """Appointment model"""
+    __slots__ = ('id', 'patient_id', 'provider_id', 'date', 'time', 'status', 'price',
+                 'payment_status', 'notes', 'created_at', 'reminder_sent')
+    
     def __init__(self, id, patient_id, provider_id, date, time, status, price=None, payment_status=None, notes=None, created_at=None, reminder_sent=False):
         self.id = id
         self.patient_id = patient_id
@@ -613,7 +777,7 @@ class Appointment:
     @staticmethod
     def create(patient_id, provider_id, date, time, price=None, notes=None):
         """Create a new appointment"""
-        appointment_id = len(db['appointments']) + 1
+        appointment_id = store.next_id('appointments')
         appointment = Appointment(
             appointment_id, 
             patient_id, 
@@ -625,39 +789,68 @@ class Appointment:
             payment_status='pending' if price else 'waived',
             notes=notes
         )
-        db['appointments'].append(appointment)
+        with appointment_counts.lock:
+            store.insert('appointments', appointment)
+            appointment_counts.added(provider_id, appointment.status)
+        slots.booked(appointment)
         return appointment
     
+    @staticmethod
+    def insert_many(appointments):
+        """
+        Store a batch of appointments, e.g. from a bulk import, keeping the
+        status counts and slot inventory current like create() does
+        
+        Raises:
+            ValueError: If an appointment duplicates an ID; nothing is stored
+        """
+        with appointment_counts.lock:
+            store.insert_many('appointments', appointments)
+            for appointment in appointments:
+                appointment_counts.added(appointment.provider_id, appointment.status)
+        for appointment in appointments:
+            slots.booked(appointment)
+        return appointments
+    
     @staticmethod
     def get_by_id(appointment_id):
         """Get appointment by ID"""
-        for appointment in db['appointments']:
-            if appointment.id == appointment_id:
-                return appointment
-        return None
+        return store.get('appointments', appointment_id)
     
     @staticmethod
     def get_by_patient(patient_id):
         """Get all appointments for a patient"""
-        return [a for a in db['appointments'] if a.patient_id == patient_id]
+        return store.find('appointments', patient_id=patient_id)
     
     @staticmethod
     def get_by_provider(provider_id):
         """Get all appointments for a provider"""
-        appointments = [a for a in db['appointments'] if a.provider_id == provider_id]
+        appointments = store.find('appointments', provider_id=provider_id)
         return sorted(appointments, key=lambda a: a.created_at, reverse=True)
     
     @staticmethod
     def get_recent_by_provider(provider_id, limit=5):
         """Get recent appointments for a provider"""
-        appointments = [a for a in db['appointments'] if a.provider_id == provider_id]
+        appointments = store.find('appointments', provider_id=provider_id)
         appointments = sorted(appointments, key=lambda a: a.created_at, reverse=True)
         return appointments[:limit]
     
     @staticmethod
     def get_count_by_status(provider_id, status):
         """Get count of appointments by status"""
-        return len([a for a in db['appointments'] if a.provider_id == provider_id and a.status == status])
+        return appointment_counts.count(provider_id, status)
+    
+    @staticmethod
+    def get_to_remind(date):
+        """Get the confirmed appointments on a dd-mm-YYYY date whose patients were not reminded yet"""
+        return [a for a in store.find('appointments', date=date, status='confirmed') if not a.reminder_sent]
+    
+    @staticmethod
+    def mark_reminder_sent(appointment_id):
+        """Record that the patient of an appointment was reminded of it"""
+        appointment = store.get('appointments', appointment_id)
+        if appointment is not None:
+            store.save('appointments', appointment, reminder_sent=True)
     
     @staticmethod
     def update_status(appointment_id, status, payment_status=None):
@@ -670,93 +863,267 @@ class Appointment:
             payment_status (str, optional): New payment status (pending, completed, waived)
             
         Returns:
-            bool: True if updated, False if not found
+            bool: True if updated, False if not found or its slot was booked
+                again after it was cancelled
         """
-        for appointment in db['appointments']:
-            if appointment.id == appointment_id:
-                appointment.status = status
-                if payment_status:
-                    appointment.payment_status = payment_status
-                return True
-        return False
-
-class Message:
+        appointment = store.get('appointments', appointment_id)
+        if appointment is None:
+            return False
+        changes = {'status': status}
+        if payment_status:
+            changes['payment_status'] = payment_status
+        with appointment_counts.lock:
+            old_status = appointment.status
+            try:
+                store.save('appointments', appointment, **changes)
+            except ValueError:
+                return False
+            appointment_counts.changed(appointment.provider_id, old_status, status)
+        slots.changed(appointment)
+        return True
+
+class Message(CompactModel):
     """Message model for communication between patients and providers"""
+    __slots__ = ('id', 'provider_id', 'patient_id', 'content', 'sender_type', 'is_read', 'created_at')
+    
     def __init__(self, id, provider_id, patient_id, content, sender_type, is_read=False, created_at=None):
         self.id = id
         self.provider_id = provider_id
         self.patient_id = patient_id
         self.content = content
         self.sender_type = sender_type  # 'patient' or 'provider'
-        self.is_read = is_read
+        self.is_read = is_read  # only set before read watermarks (ReadMark) were kept
         self.created_at = created_at or datetime.now()
     
     @staticmethod
-    def create(provider_id, patient_id, content, sender_type):
-        """Create a new message"""
-        message_id = len(db['messages']) + 1
-        message = Message(message_id, provider_id, patient_id, content, sender_type)
-        db['messages'].append(message)
+    def reserve_id():
+        """Reserve the ID of a message created later, e.g. by a background task that may be retried"""
+        return store.next_id('messages')
+    
+    @staticmethod
+    def create(provider_id, patient_id, content, sender_type, message_id=None):
+        """
+        Create a new message
+        
+        Args:
+            message_id (int, optional): ID from reserve_id(); if a message with
+                this ID is already stored, it is returned instead of a duplicate
+        """
+        with conversations.lock:
+            if message_id is None:
+                # Take the ID under the lock, so messages are stored in ID order
+                message_id = store.next_id('messages')
+                rewind = None
+            else:
+                existing = store.get('messages', message_id)
+                if existing is not None:
+                    return existing
+                # The provider may have read the conversation past the reserved
+                # ID meanwhile; move the watermark back so the message is unread
+                rewind = ReadMark.get(provider_id, patient_id) if sender_type == 'patient' else None
+                if rewind is not None and rewind.last_read_id >= message_id:
+                    store.save('read_marks', rewind, last_read_id=message_id - 1)
+                else:
+                    rewind = None
+            message = Message(message_id, provider_id, patient_id, content, sender_type)
+            store.insert('messages', message)
+            if rewind is not None:
+                conversations.forget(provider_id)
+            else:
+                conversations.added(message)
         return message
     
     @staticmethod
     def get_conversation(provider_id, patient_id):
         """Get conversation between provider and patient"""
-        messages = [m for m in db['messages'] 
-                   if m.provider_id == provider_id and m.patient_id == patient_id]
+        messages = store.find('messages', provider_id=provider_id, patient_id=patient_id)
         return sorted(messages, key=lambda m: m.created_at)
     
     @staticmethod
-    def get_conversations(provider_id):
-        """Get all conversations for a provider"""
-        # Get unique patient IDs from messages
-        patient_ids = set()
-        for message in db['messages']:
-            if message.provider_id == provider_id:
-                patient_ids.add(message.patient_id)
+    def get_conversation_page(provider_id, patient_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+        """
+        Get one page of a conversation, for paging through its history
         
-        # Get latest message for each patient
-        conversations = []
-        for patient_id in patient_ids:
-            patient = Patient.get_by_id(patient_id)
-            messages = [m for m in db['messages'] 
-                       if m.provider_id == provider_id and m.patient_id == patient_id]
-            latest_message = sorted(messages, key=lambda m: m.created_at, reverse=True)[0]
-            unread_count = len([m for m in messages 
-                               if m.sender_type == 'patient' and not m.is_read])
-            
-            conversations.append({
-                'patient': patient,
-                'latest_message': latest_message,
-                'unread_count': unread_count
-            })
+        Messages are kept per conversation in ID order, which is the order
+        they were sent in, so a page costs O(limit) however long the
+        conversation is.
         
-        # Sort by latest message timestamp
-        return sorted(conversations, key=lambda c: c['latest_message'].created_at, reverse=True)
+        Args:
+            provider_id (int): ID of the provider
+            patient_id (int): ID of the patient
+            before (int, optional): Return the messages sent just before this message ID
+            after (int, optional): Return the messages sent just after this message ID;
+                the latest messages are returned if neither is given
+            limit (int): Messages per page
+            
+        Returns:
+            tuple: (messages oldest first, whether more messages lie beyond the page)
+        """
+        messages = store.page('messages', limit + 1, before=before, after=after,
+                              provider_id=provider_id, patient_id=patient_id)
+        more = len(messages) > limit
+        if more:
+            messages = messages[:-1] if after is not None else messages[1:]
+        return messages, more
+    
+    @staticmethod
+    def get_conversations(provider_id):
+        """Get all conversations for a provider, most recent first"""
+        return [{
+            'patient': Patient.get_by_id(conversation.patient_id),
+            'latest_message': conversation.latest,
+            'unread_count': conversation.unread
+        } for conversation in conversations.inbox(provider_id)]
     
     @staticmethod
     def mark_as_read(patient_id, provider_id):
-        """Mark all messages from a patient as read"""
-        for message in db['messages']:
-            if (message.patient_id == patient_id and 
-                message.provider_id == provider_id and 
-                message.sender_type == 'patient'):
-                message.is_read = True
+        """
+        Mark all messages from a patient as read, by moving the conversation's
+        read watermark to its latest message in a single write
+        
+        Message.create takes IDs under the same lock, so the highest ID found
+        here is the newest message and every message after the watermark
+        gets a higher ID.
+        """
+        with conversations.lock:
+            latest = store.page('messages', 1, provider_id=provider_id, patient_id=patient_id)
+            if latest and ReadMark.advance(provider_id, patient_id, latest[0].id):
+                conversations.read(provider_id, patient_id, latest[0].id)
     
     @staticmethod
     def get_recent_by_provider(provider_id, limit=5):
         """Get recent messages for a provider"""
-        messages = [m for m in db['messages'] if m.provider_id == provider_id]
+        messages = store.find('messages', provider_id=provider_id)
         messages = sorted(messages, key=lambda m: m.created_at, reverse=True)
         return messages[:limit]
     
     @staticmethod
     def get_unread_count(provider_id):
         """Get count of unread messages for a provider"""
-        return len([m for m in db['messages'] 
-                   if m.provider_id == provider_id and 
-                   m.sender_type == 'patient' and 
-                   not m.is_read])
+        return conversations.unread_count(provider_id)
+
+class ReadMark(CompactModel):
+    """
+    Read watermark of a conversation: the last message the provider has read
+    
+    Every message up to last_read_id counts as read, so reading a
+    conversation moves one watermark instead of flagging each message.
+    """
+    __slots__ = ('id', 'provider_id', 'patient_id', 'last_read_id', 'read_at')
+    
+    def __init__(self, id, provider_id, patient_id, last_read_id, read_at=None):
+        self.id = id
+        self.provider_id = provider_id
+        self.patient_id = patient_id
+        self.last_read_id = last_read_id
+        self.read_at = read_at or datetime.now()
+    
+    @staticmethod
+    def get(provider_id, patient_id):
+        """Get the watermark of a conversation, or None if it was never read"""
+        marks = store.find('read_marks', provider_id=provider_id, patient_id=patient_id)
+        return marks[0] if marks else None
+    
+    @staticmethod
+    def get_by_provider(provider_id):
+        """
+        Get the watermarks of a provider's conversations
+        
+        Returns:
+            dict: patient_id -> ID of the last message read
+        """
+        return {mark.patient_id: mark.last_read_id
+                for mark in store.find('read_marks', provider_id=provider_id)}
+    
+    @staticmethod
+    def advance(provider_id, patient_id, message_id):
+        """
+        Move a conversation's watermark forward to a message
+        
+        Returns:
+            bool: True if the watermark moved, False if it was already there
+        """
+        mark = ReadMark.get(provider_id, patient_id)
+        if mark is None:
+            store.insert('read_marks', ReadMark(store.next_id('read_marks'), provider_id, patient_id, message_id))
+        elif mark.last_read_id < message_id:
+            store.save('read_marks', mark, last_read_id=message_id, read_at=datetime.now())
+        else:
+            return False
+        return True
+
+class Notification(CompactModel):
+    """SMS to a patient, kept until it is delivered (see notifications.py)"""
+    __slots__ = ('id', 'patient_id', 'provider_id', 'message_id', 'phone_number', 'content', 'status',
+                 'attempts', 'next_attempt_at', 'error', 'created_at', 'sent_at')
+    
+    def __init__(self, id, patient_id, provider_id, phone_number, content, message_id=None, status='queued',
+                 attempts=0, next_attempt_at=None, error=None, created_at=None, sent_at=None):
+        self.id = id
+        self.patient_id = patient_id
+        self.provider_id = provider_id
+        self.message_id = message_id  # Message delivered, if any
+        self.phone_number = phone_number
+        self.content = content
+        self.status = status  # queued, sent, failed
+        self.attempts = attempts
+        self.created_at = created_at or datetime.now()
+        self.next_attempt_at = next_attempt_at or self.created_at
+        self.error = error  # gateway error of the last attempt
+        self.sent_at = sent_at
+    
+    @staticmethod
+    def create(patient_id, provider_id, phone_number, content, message_id=None):
+        """Queue a new notification"""
+        notification_id = store.next_id('notifications')
+        notification = Notification(notification_id, patient_id, provider_id, phone_number, content,
+                                    message_id=message_id)
+        store.insert('notifications', notification)
+        return notification
+    
+    @staticmethod
+    def get_by_id(notification_id):
+        """Get notification by ID"""
+        return store.get('notifications', notification_id)
+    
+    @staticmethod
+    def get_by_patient(patient_id):
+        """Get all notifications sent or queued for a patient"""
+        return store.find('notifications', patient_id=patient_id)
+    
+    @staticmethod
+    def get_due(now=None):
+        """Get queued notifications whose next attempt is due"""
+        now = now or datetime.now()
+        return [n for n in store.find('notifications', status='queued') if n.next_attempt_at <= now]
+    
+    @staticmethod
+    def mark_sent(notification_id):
+        """Record a delivery to the gateway"""
+        notification = store.get('notifications', notification_id)
+        if notification is not None:
+            store.save('notifications', notification, status='sent', attempts=notification.attempts + 1,
+                       error=None, sent_at=datetime.now())
+    
+    @staticmethod
+    def mark_failed(notification_id, error, retry_at=None):
+        """
+        Record a failed attempt
+        
+        Args:
+            notification_id (int): ID of the notification
+            error (str): Gateway error
+            retry_at (datetime, optional): When to try again; the notification is given up if omitted
+        """
+        notification = store.get('notifications', notification_id)
+        if notification is None:
+            return
+        changes = {'attempts': notification.attempts + 1, 'error': error}
+        if retry_at is None:
+            changes['status'] = 'failed'
+        else:
+            changes['next_attempt_at'] = retry_at
+        store.save('notifications', notification, **changes)
 
 class HealthInfo:
     """Health information model"""
@@ -770,34 +1137,46 @@ class HealthInfo:
     @staticmethod
     def create(title, content, language):
         """Create new health information"""
-        info_id = len(db['health_info']) + 1
+        info_id = store.next_id('health_info')
         info = HealthInfo(info_id, title, content, language)
-        db['health_info'].append(info)
+        store.insert('health_info', info)
         return info
     
     @staticmethod
     def get_by_language(language):
         """Get health information by language"""
-        return [i for i in db['health_info'] if i.language == language]
+        return store.find('health_info', language=language)
     
     @staticmethod
     def get_all():
         """Get all health information"""
-        return sorted(db['health_info'], key=lambda i: i.created_at, reverse=True)
+        return sorted(store.all('health_info'), key=lambda i: i.created_at, reverse=True)
 
 
-class UserInteraction:
+class UserInteraction(CompactModel):
     """User interaction model for tracking patient journey"""
+    __slots__ = ('id', 'patient_id', 'interaction_type', 'description', 'metadata', 'created_at')
+    
     def __init__(self, id, patient_id, interaction_type, description, metadata=None, created_at=None):
         self.id = id
         self.patient_id = patient_id
-        self.interaction_type = interaction_type  # 'ussd', 'appointment', 'message', 'symptom', 'health_tip'
+        self.interaction_type = sys.intern(interaction_type)  # 'ussd', 'appointment', 'message', 'symptom', 'health_tip'
         self.description = description
-        self.metadata = metadata or {}  # Additional data specific to interaction type
+        self.metadata = metadata or EMPTY_METADATA  # Additional data specific to interaction type
         self.created_at = created_at or datetime.now()
     
+    def __getstate__(self):
+        """Pickle metadata as a plain dict, since read-only mappings cannot be pickled"""
+        state = {field: getattr(self, field) for field in self.__slots__}
+        state['metadata'] = dict(state['metadata'])
+        return state
+    
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.metadata = self.metadata or EMPTY_METADATA
+    
     @staticmethod
-    def create(patient_id, interaction_type, description, metadata=None):
+    def create(patient_id, interaction_type, description, metadata=None, interaction_id=None):
         """
         Create a new user interaction
         
@@ -806,26 +1185,43 @@ class UserInteraction:
             interaction_type (str): Type of interaction ('ussd', 'appointment', 'message', 'symptom', 'health_tip')
             description (str): Description of the interaction
             metadata (dict, optional): Additional data specific to interaction type
+            interaction_id (int, optional): ID from reserve_id(); if an interaction
+                with this ID is already stored, it is returned instead of a duplicate
             
         Returns:
             UserInteraction: Newly created interaction object
         """
-        if 'user_interactions' not in db:
-            db['user_interactions'] = []
-            
-        interaction_id = len(db['user_interactions']) + 1
+        if interaction_id is None:
+            interaction_id = store.next_id('user_interactions')
+        else:
+            existing = store.get('user_interactions', interaction_id)
+            if existing is not None:
+                return existing
         interaction = UserInteraction(interaction_id, patient_id, interaction_type, description, metadata)
-        db['user_interactions'].append(interaction)
+        store.insert('user_interactions', interaction)
         return interaction
     
+    @staticmethod
+    def reserve_id():
+        """Reserve the ID of an interaction recorded later, e.g. by a background task that may be retried"""
+        return store.next_id('user_interactions')
+    
     @staticmethod
     def get_by_patient(patient_id):
         """Get all interactions for a patient"""
-        if 'user_interactions' not in db:
-            db['user_interactions'] = []
-        return sorted([i for i in db['user_interactions'] if i.patient_id == patient_id], 
+        return sorted(store.find('user_interactions', patient_id=patient_id),
                       key=lambda i: i.created_at)
     
+    @staticmethod
+    def count_by_patient():
+        """
+        Count interactions per patient in one pass, without loading them
+        
+        Returns:
+            dict: patient_id -> number of interactions
+        """
+        return store.count_by('user_interactions', 'patient_id')
+    
     @staticmethod
     def get_patient_journey(patient_id):
         """
@@ -885,7 +1281,7 @@ class UserInteraction:
                     'description': interaction.description,
                     'date': interaction.created_at.strftime('%Y-%m-%d'),
                     'time': interaction.created_at.strftime('%H:%M'),
-                    'metadata': interaction.metadata
+                    'metadata': dict(interaction.metadata)
                 })
             
             # Add to timeline
@@ -896,7 +1292,7 @@ class UserInteraction:
                 'date': interaction.created_at.strftime('%Y-%m-%d'),
                 'time': interaction.created_at.strftime('%H:%M'),
                 'timestamp': interaction.created_at.timestamp(),
-                'metadata': interaction.metadata
+                'metadata': dict(interaction.metadata)
             })
             
             # Count interaction types
@@ -916,8 +1312,11 @@ class UserInteraction:
         
         return journey
 
-class Payment:
+class Payment(CompactModel):
     """Payment model for M-Pesa transactions"""
+    __slots__ = ('id', 'appointment_id', 'amount', 'phone_number', 'mpesa_reference', 'status',
+                 'payment_method', 'created_at', 'paid_at')
+    
     def __init__(self, id, appointment_id, amount, phone_number, mpesa_reference=None, status="pending", payment_method="mpesa", created_at=None, paid_at=None):
         self.id = id
         self.appointment_id = appointment_id
@@ -943,44 +1342,33 @@ class Payment:
         Returns:
             Payment: Newly created payment object
         """
-        payment_id = len(db['payments']) + 1
+        payment_id = store.next_id('payments')
         payment = Payment(payment_id, appointment_id, amount, phone_number, payment_method=payment_method)
-        db['payments'].append(payment)
+        store.insert('payments', payment)
         return payment
     
     @staticmethod
     def get_by_id(payment_id):
         """Get payment by ID"""
-        for payment in db['payments']:
-            if payment.id == payment_id:
-                return payment
-        return None
+        return store.get('payments', payment_id)
     
     @staticmethod
     def get_by_appointment(appointment_id):
         """Get payment for an appointment"""
-        for payment in db['payments']:
-            if payment.appointment_id == appointment_id:
-                return payment
-        return None
+        payments = store.find('payments', appointment_id=appointment_id)
+        return payments[0] if payments else None
     
     @staticmethod
     def get_all():
         """Get all payments"""
-        return sorted(db['payments'], key=lambda p: p.created_at, reverse=True)
+        return sorted(store.all('payments'), key=lambda p: p.created_at, reverse=True)
     
     @staticmethod
     def get_by_provider(provider_id):
         """Get all payments for a specific provider"""
         provider_payments = []
-        for payment in db['payments']:
-            # Get the appointment associated with this payment
-            appointment = Appointment.get_by_id(payment.appointment_id)
-            if appointment and appointment.provider_id == provider_id:
-                # Enhance payment with patient and appointment data
-                payment.appointment = appointment
-                payment.patient = Patient.get_by_id(appointment.patient_id)
-                provider_payments.append(payment)
+        for appointment in store.find('appointments', provider_id=provider_id):
+            provider_payments.extend(store.find('payments', appointment_id=appointment.id))
         return sorted(provider_payments, key=lambda p: p.created_at, reverse=True)
     
     @staticmethod
@@ -996,15 +1384,16 @@ class Payment:
         Returns:
             bool: True if updated, False if not found
         """
-        for payment in db['payments']:
-            if payment.id == payment_id:
-                payment.status = status
-                if mpesa_reference:
-                    payment.mpesa_reference = mpesa_reference
-                if status == "completed":
-                    payment.paid_at = datetime.now()
-                return True
-        return False
+        payment = store.get('payments', payment_id)
+        if payment is None:
+            return False
+        changes = {'status': status}
+        if mpesa_reference:
+            changes['mpesa_reference'] = mpesa_reference
+        if status == "completed":
+            changes['paid_at'] = datetime.now()
+        store.save('payments', payment, **changes)
+        return True
     
     @staticmethod
     def generate_payment_summary():
@@ -1014,7 +1403,7 @@ class Payment:
         Returns:
             dict: Summary statistics
         """
-        payments = db['payments']
+        payments = store.all('payments')
         total_amount = sum(p.amount for p in payments)
         pending_amount = sum(p.amount for p in payments if p.status == "pending")
         completed_amount = sum(p.amount for p in payments if p.status == "completed")
@@ -1055,6 +1444,17 @@ class Payment:
                 }
             }
         }
+    
+    @property
+    def appointment(self):
+        """Get associated appointment, or None for direct bill payments"""
+        return Appointment.get_by_id(self.appointment_id) if self.appointment_id else None
+    
+    @property
+    def patient(self):
+        """Get the patient of the associated appointment"""
+        appointment = self.appointment
+        return Patient.get_by_id(appointment.patient_id) if appointment else None
 
 
 class Prescription:
@@ -1079,42 +1479,40 @@ class Prescription:
     def create(patient_id, provider_id, appointment_id, medications, instructions, 
                delivery_method="pickup", delivery_address=None, delivery_fee=0.0):
         """Create a new prescription"""
-        prescription_id = len(db['prescriptions']) + 1
+        prescription_id = store.next_id('prescriptions')
         prescription = Prescription(
             prescription_id, patient_id, provider_id, appointment_id,
             medications, instructions, delivery_method, delivery_address, delivery_fee
         )
-        db['prescriptions'].append(prescription)
+        store.insert('prescriptions', prescription)
         return prescription
 
     @staticmethod
     def get_by_id(prescription_id):
         """Get prescription by ID"""
-        for prescription in db['prescriptions']:
-            if prescription.id == prescription_id:
-                return prescription
-        return None
+        return store.get('prescriptions', prescription_id)
 
     @staticmethod
     def get_by_patient(patient_id):
         """Get all prescriptions for a patient"""
-        return [p for p in db['prescriptions'] if p.patient_id == patient_id]
+        return store.find('prescriptions', patient_id=patient_id)
 
     @staticmethod
     def get_by_provider(provider_id):
         """Get all prescriptions by a provider"""
-        return [p for p in db['prescriptions'] if p.provider_id == provider_id]
+        return store.find('prescriptions', provider_id=provider_id)
 
     @staticmethod
     def update_status(prescription_id, status, dispensed_at=None):
         """Update prescription status"""
-        for prescription in db['prescriptions']:
-            if prescription.id == prescription_id:
-                prescription.status = status
-                if status == "dispensed" and dispensed_at:
-                    prescription.dispensed_at = dispensed_at
-                return True
-        return False
+        prescription = store.get('prescriptions', prescription_id)
+        if prescription is None:
+            return False
+        changes = {'status': status}
+        if status == "dispensed" and dispensed_at:
+            changes['dispensed_at'] = dispensed_at
+        store.save('prescriptions', prescription, **changes)
+        return True
 
     @property
     def patient(self):
@@ -1144,42 +1542,41 @@ class WalkInPatient:
     @staticmethod
     def create(patient_id, provider_id, priority="normal", notes=None):
         """Create a new walk-in patient entry"""
-        walkin_id = len(db['walkin_patients']) + 1
+        walkin_id = store.next_id('walkin_patients')
         walkin = WalkInPatient(
             walkin_id, patient_id, provider_id, datetime.now(), 
             priority=priority, notes=notes
         )
-        db['walkin_patients'].append(walkin)
+        store.insert('walkin_patients', walkin)
         return walkin
 
     @staticmethod
     def get_by_provider(provider_id, status=None):
         """Get walk-in patients for a provider"""
-        walkings = [w for w in db['walkin_patients'] if w.provider_id == provider_id]
         if status:
-            walkings = [w for w in walkings if w.status == status]
+            walkings = store.find('walkin_patients', provider_id=provider_id, status=status)
+        else:
+            walkings = store.find('walkin_patients', provider_id=provider_id)
         return sorted(walkings, key=lambda x: (x.priority != "urgent", x.arrival_time))
 
     @staticmethod
     def get_by_id(walkin_id):
         """Get walk-in patient by ID"""
-        for walkin in db['walkin_patients']:
-            if walkin.id == walkin_id:
-                return walkin
-        return None
+        return store.get('walkin_patients', walkin_id)
 
     @staticmethod
     def update_status(walkin_id, status):
         """Update walk-in patient status"""
-        for walkin in db['walkin_patients']:
-            if walkin.id == walkin_id:
-                walkin.status = status
-                if status == "in_consultation":
-                    walkin.consultation_start = datetime.now()
-                elif status == "completed":
-                    walkin.consultation_end = datetime.now()
-                return True
-        return False
+        walkin = store.get('walkin_patients', walkin_id)
+        if walkin is None:
+            return False
+        changes = {'status': status}
+        if status == "in_consultation":
+            changes['consultation_start'] = datetime.now()
+        elif status == "completed":
+            changes['consultation_end'] = datetime.now()
+        store.save('walkin_patients', walkin, **changes)
+        return True
 
     @property
     def patient(self):
@@ -1215,44 +1612,42 @@ class LabTest:
     @staticmethod
     def create(patient_id, provider_id, appointment_id, test_name, test_type, cost=0.0, instructions=None):
         """Create a new lab test order"""
-        test_id = len(db['lab_tests']) + 1
+        test_id = store.next_id('lab_tests')
         lab_test = LabTest(
             test_id, patient_id, provider_id, appointment_id,
             test_name, test_type, cost=cost, instructions=instructions
         )
-        db['lab_tests'].append(lab_test)
+        store.insert('lab_tests', lab_test)
         return lab_test
 
     @staticmethod
     def get_by_id(test_id):
         """Get lab test by ID"""
-        for test in db['lab_tests']:
-            if test.id == test_id:
-                return test
-        return None
+        return store.get('lab_tests', test_id)
 
     @staticmethod
     def get_by_patient(patient_id):
         """Get all lab tests for a patient"""
-        return [t for t in db['lab_tests'] if t.patient_id == patient_id]
+        return store.find('lab_tests', patient_id=patient_id)
 
     @staticmethod
     def get_by_provider(provider_id):
         """Get all lab tests ordered by a provider"""
-        return [t for t in db['lab_tests'] if t.provider_id == provider_id]
+        return store.find('lab_tests', provider_id=provider_id)
 
     @staticmethod
     def update_status(test_id, status):
         """Update lab test status"""
-        for test in db['lab_tests']:
-            if test.id == test_id:
-                test.status = status
-                if status == "sample_collected":
-                    test.sample_collected_at = datetime.now()
-                elif status == "completed":
-                    test.completed_at = datetime.now()
-                return True
-        return False
+        test = store.get('lab_tests', test_id)
+        if test is None:
+            return False
+        changes = {'status': status}
+        if status == "sample_collected":
+            changes['sample_collected_at'] = datetime.now()
+        elif status == "completed":
+            changes['completed_at'] = datetime.now()
+        store.save('lab_tests', test, **changes)
+        return True
 
     @property
     def patient(self):
@@ -1276,12 +1671,12 @@ class LabResult:
     @staticmethod
     def create(lab_test_id, results, normal_ranges=None, notes=None, technician_name=None):
         """Create a new lab result"""
-        result_id = len(db['lab_results']) + 1
+        result_id = store.next_id('lab_results')
         lab_result = LabResult(
             result_id, lab_test_id, results, normal_ranges, 
             notes, technician_name
         )
-        db['lab_results'].append(lab_result)
+        store.insert('lab_results', lab_result)
         
         # Update the lab test status to completed
         LabTest.update_status(lab_test_id, "completed")
@@ -1291,20 +1686,16 @@ class LabResult:
     @staticmethod
     def get_by_lab_test(lab_test_id):
         """Get lab result by lab test ID"""
-        for result in db['lab_results']:
-            if result.lab_test_id == lab_test_id:
-                return result
-        return None
+        results = store.find('lab_results', lab_test_id=lab_test_id)
+        return results[0] if results else None
 
     @staticmethod
     def get_by_patient(patient_id):
         """Get all lab results for a patient"""
         patient_results = []
-        for result in db['lab_results']:
-            lab_test = LabTest.get_by_id(result.lab_test_id)
-            if lab_test and lab_test.patient_id == patient_id:
-                patient_results.append(result)
-        return patient_results
+        for lab_test in store.find('lab_tests', patient_id=patient_id):
+            patient_results.extend(store.find('lab_results', lab_test_id=lab_test.id))
+        return sorted(patient_results, key=lambda r: r.id)
 
     @property
     def lab_test(self):
@@ -1313,7 +1704,7 @@ class LabResult:
 
     def mark_reviewed(self):
         """Mark result as reviewed by provider"""
-        self.reviewed_by_provider = True
+        store.save('lab_results', self, reviewed_by_provider=True)
 
 
 class Bill:
@@ -1333,9 +1724,9 @@ class Bill:
     @staticmethod
     def create(patient_id, provider_id, appointment_id=None):
         """Create a new bill"""
-        bill_id = len(db['bills']) + 1
+        bill_id = store.next_id('bills')
         bill = Bill(bill_id, patient_id, provider_id, appointment_id)
-        db['bills'].append(bill)
+        store.insert('bills', bill)
         return bill
 
     def add_item(self, item_type, description, amount, quantity=1):
@@ -1347,32 +1738,55 @@ class Bill:
             'quantity': quantity,
             'total': amount * quantity
         }
-        self.items.append(item)
-        self.calculate_total()
+        def add(bill):
+            items = bill.items + [item]
+            return {'items': items, 'total_amount': sum(i['total'] for i in items)}
+        store.update('bills', self, add)
 
     def calculate_total(self):
         """Calculate total bill amount"""
         self.total_amount = sum(item['total'] for item in self.items)
 
+    @staticmethod
+    def update_status(bill_id, status):
+        """Update bill status, recording when it was paid"""
+        bill = store.get('bills', bill_id)
+        if bill is None:
+            return False
+        changes = {'status': status}
+        if status == 'paid':
+            changes['paid_at'] = datetime.now()
+        store.save('bills', bill, **changes)
+        return True
+
     @staticmethod
     def get_by_id(bill_id):
         """Get bill by ID"""
-        for bill in db['bills']:
-            if bill.id == bill_id:
-                return bill
-        return None
+        return store.get('bills', bill_id)
 
     @staticmethod
     def get_by_patient(patient_id):
         """Get all bills for a patient"""
-        return [b for b in db['bills'] if b.patient_id == patient_id]
+        return store.find('bills', patient_id=patient_id)
 
     @staticmethod
     def get_by_provider(provider_id):
         """Get all bills by a provider"""
-        return [b for b in db['bills'] if b.provider_id == provider_id]
+        return store.find('bills', provider_id=provider_id)
 
     @property
     def patient(self):
         """Get associated patient"""
         return Patient.get_by_id(self.patient_id)
+
+# Durable in-memory deployments recover from and log writes to TUJALI_DATA_DIR
+# (see persistence.py); init_db() then only seeds when nothing was recovered.
+# This runs last so recovered records can be unpickled into the classes above.
+persistence = None
+if os.environ.get('TUJALI_DATA_DIR') and isinstance(store, MemoryStorage):
+    persistence = enable_persistence(store, os.environ['TUJALI_DATA_DIR'])
+
+# SQLite databases created by an earlier version get their new index columns
+# filled in, which also needs the classes above to unpickle records
+if isinstance(store, SQLiteStorage):
+    store.migrate()
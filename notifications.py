@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""
+Outbound SMS notifications for Tujali Telehealth
+
+Messages for patients (provider replies, shared health tips, appointment
+reminders) are stored as Notification records, so queued messages survive a
+restart, and are delivered by an Outbox:
+
+- Worker threads take batches of up to batch_size notifications of one
+  provider at a time. Providers take turns, so one provider sending
+  thousands of tips does not hold up another's replies.
+- A token bucket keeps the outbox under the gateway's rate limit.
+- A failed attempt is retried with exponential backoff until max_attempts.
+  The next attempt time is stored on the notification. A poller picks up
+  notifications that are due, including any left queued by an earlier run.
+
+Transports are selected with the TUJALI_SMS_TRANSPORT environment variable:
+    fake            Records the latest messages in memory (for development and
+                    tests); used with a warning when the variable is not set, as
+                    patients then receive no SMS
+    africastalking  Africa's Talking SMS API, using AT_USERNAME, AT_API_KEY
+                    and optionally AT_SENDER_ID
+
+TUJALI_SMS_WORKERS sets the number of worker threads (default 2) and
+TUJALI_SMS_RATE the messages per second allowed (default 50). Notifications
+are read from the shared store, so with several worker processes run the
+workers in one of them and set TUJALI_SMS_WORKERS=0 in the others.
+
+Appointment reminders for the next day are queued by the process that sends
+SMS once TUJALI_REMINDER_HOUR (0-23, e.g. 18) has passed each day; leave it
+unset to not send reminders. The command below queues them by hand. It opens
+the store in a process of its own, so it needs SQLite storage
+(TUJALI_STORAGE=sqlite:///...): the default memory store holds no
+appointments there, and a TUJALI_DATA_DIR is locked by the running server.
+
+Usage:
+    python notifications.py reminders   Queue and send reminders for tomorrow's appointments
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, timedelta
+
+from models import Notification, Patient, Provider, Appointment, store
+from storage import MemoryStorage
+from catalog import catalog
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Messages a FakeGateway keeps for inspection
+FAKE_GATEWAY_HISTORY = 1000
+
+
+class FakeGateway:
+    """
+    In-memory SMS gateway for development and tests
+
+    The latest messages handed to it are kept in sent. With fail_every set,
+    every nth message fails, to exercise retries.
+    """
+    def __init__(self, fail_every=0, latency=0.0, history=FAKE_GATEWAY_HISTORY):
+        """
+        Args:
+            fail_every (int): Fail every nth message; 0 never fails
+            latency (float): Seconds each request takes
+            history (int): Messages kept in sent; older ones are dropped
+        """
+        self.fail_every = fail_every
+        self.latency = latency
+        self.sent = deque(maxlen=history)  # (phone_number, content, sent_at)
+        self.requests = 0
+        self.attempts = 0
+        self.lock = threading.Lock()
+
+    def send(self, messages):
+        """
+        Send a batch of SMS
+
+        Args:
+            messages (list): (phone_number, content) pairs
+
+        Returns:
+            list: None for each message accepted, or the error for one that was not
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        results = []
+        with self.lock:
+            self.requests += 1
+            for phone_number, content in messages:
+                self.attempts += 1
+                if self.fail_every and self.attempts % self.fail_every == 0:
+                    results.append('Fake gateway failure')
+                    continue
+                self.sent.append((phone_number, content, datetime.now()))
+                results.append(None)
+        return results
+
+
+class AfricasTalkingTransport:
+    """Africa's Talking SMS API; one request per distinct text in a batch"""
+    def __init__(self, username, api_key, sender_id=None):
+        """
+        Args:
+            username (str): Africa's Talking application username
+            api_key (str): API key of the application
+            sender_id (str, optional): Short code or alphanumeric sender ID
+        """
+        import africastalking
+        africastalking.initialize(username, api_key)
+        self.sms = africastalking.SMS
+        self.sender_id = sender_id
+
+    def send(self, messages):
+        """
+        Send a batch of SMS, sending identical texts (such as reminders of the
+        same kind) to all of their recipients in one request
+
+        Returns:
+            list: None for each message accepted, or the error for one that was not
+        """
+        by_content = defaultdict(list)
+        for i, (phone_number, content) in enumerate(messages):
+            by_content[content].append(i)
+        results = [None] * len(messages)
+        for content, indexes in by_content.items():
+            response = self.sms.send(content, [messages[i][0] for i in indexes], self.sender_id)
+            recipients = {r['number']: r for r in response['SMSMessageData']['Recipients']}
+            for i in indexes:
+                status = recipients.get(messages[i][0], {}).get('status', 'No response for recipient')
+                results[i] = None if status == 'Success' else status
+        return results
+
+
+def create_transport(name):
+    """
+    Create an SMS transport by name
+
+    Args:
+        name (str): 'fake' or 'africastalking'; None warns and uses the fake gateway
+
+    Returns:
+        FakeGateway or AfricasTalkingTransport
+    """
+    if not name:
+        logger.warning("TUJALI_SMS_TRANSPORT is not set; SMS to patients are recorded "
+                       "by a fake gateway and not delivered")
+        return FakeGateway()
+    if name == 'fake':
+        return FakeGateway()
+    if name == 'africastalking':
+        logger.info("Sending SMS through Africa's Talking")
+        return AfricasTalkingTransport(os.environ['AT_USERNAME'], os.environ['AT_API_KEY'],
+                                       os.environ.get('AT_SENDER_ID'))
+    raise ValueError(f"Unsupported SMS transport: {name}")
+
+
+class RateLimiter:
+    """Token bucket allowing rate messages per second, in bursts of up to burst"""
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): Messages per second; 0 for no limit
+            burst (float, optional): Messages that may go at once; one second's worth by default
+        """
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Wait until count messages may be sent"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the tokens now, going into debt if needed, so callers are served in order
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Outbox:
+    """Delivers queued notifications through a transport with worker threads"""
+    def __init__(self, transport, workers=2, rate=50, batch_size=100, max_attempts=5, retry_delay=30,
+                 poll_interval=5):
+        """
+        Args:
+            transport: Object whose send(messages) delivers (phone_number, content) pairs
+            workers (int): Worker threads; 0 only stores notifications for another process to send
+            rate (float): Messages per second allowed by the gateway; 0 for no limit
+            batch_size (int): Notifications handed to the transport at once
+            max_attempts (int): Attempts before a notification is given up
+            retry_delay (float): Seconds before the first retry, doubled for each further one
+            poll_interval (float): Seconds between looks for due notifications in the store
+        """
+        self.transport = transport
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)  # notified when notifications are queued
+        self.idle = threading.Condition(self.lock)  # notified when nothing is queued or in flight
+        self.pending = OrderedDict()  # provider_id -> deque of notification IDs, in turn order
+        self.tracked = set()  # IDs queued or being sent by this outbox
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.closed = False
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._run, name=f'sms-worker-{i}', daemon=True)
+                        for i in range(workers)]
+        if workers:
+            self.threads.append(threading.Thread(target=self._poll, name='sms-poller', daemon=True))
+            atexit.register(self.close)
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, phone_number, content, patient_id=None, provider_id=None, message_id=None):
+        """
+        Store a notification and queue it for delivery
+
+        Returns:
+            Notification: The stored notification
+        """
+        notification = Notification.create(patient_id, provider_id, phone_number, content, message_id)
+        if self.workers:
+            self._push([notification])
+        return notification
+
+    def _push(self, notifications):
+        """Queue notifications not already queued or in flight"""
+        with self.lock:
+            for notification in notifications:
+                if notification.id in self.tracked:
+                    continue
+                self.tracked.add(notification.id)
+                self.pending.setdefault(notification.provider_id, deque()).append(notification.id)
+            self.ready.notify_all()
+
+    def _take(self):
+        """
+        Wait for the next batch: notifications of the provider first in turn,
+        who then goes to the back of the line
+
+        Returns:
+            list: Notification IDs, empty once the outbox is closed
+        """
+        with self.lock:
+            while not self.pending and not self.closed:
+                self.ready.wait()
+            if not self.pending:
+                return []
+            provider_id, queued = self.pending.popitem(last=False)
+            batch = [queued.popleft() for _ in range(min(self.batch_size, len(queued)))]
+            if queued:
+                self.pending[provider_id] = queued
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            try:
+                self._send(batch)
+            except Exception as e:
+                # Left queued in the store; the poller offers them again
+                logger.error(f"Error sending SMS batch: {e}")
+            finally:
+                with self.lock:
+                    self.tracked.difference_update(batch)
+                    if not self.tracked:
+                        self.idle.notify_all()
+
+    def _send(self, batch):
+        """Hand a batch to the transport and record the outcome of each notification"""
+        notifications = [n for n in map(Notification.get_by_id, batch) if n and n.status == 'queued']
+        if not notifications:
+            return
+        self.limiter.acquire(len(notifications))
+        try:
+            results = self.transport.send([(n.phone_number, n.content) for n in notifications])
+        except Exception as e:
+            logger.warning(f"SMS gateway request failed: {e}")
+            results = [str(e)] * len(notifications)
+
+        sent = failed = retried = 0
+        for notification, error in zip(notifications, results):
+            if error is None:
+                Notification.mark_sent(notification.id)
+                sent += 1
+            elif notification.attempts + 1 < self.max_attempts:
+                delay = self.retry_delay * 2 ** notification.attempts
+                Notification.mark_failed(notification.id, error, datetime.now() + timedelta(seconds=delay))
+                retried += 1
+            else:
+                logger.error(f"SMS {notification.id} to {notification.phone_number} failed after "
+                             f"{notification.attempts + 1} attempts: {error}")
+                Notification.mark_failed(notification.id, error)
+                failed += 1
+        with self.lock:
+            self.batches += 1
+            self.sent += sent
+            self.failed += failed
+            self.retried += retried
+
+    def _poll(self):
+        """Queue due notifications from the store: retries, and those left by an earlier run"""
+        while not self.stopped.is_set():
+            try:
+                self.recover()
+            except Exception as e:
+                logger.error(f"Error looking up due SMS: {e}")
+            self.stopped.wait(self.poll_interval)
+
+    def recover(self):
+        """
+        Queue the notifications in the store that are due
+
+        Returns:
+            int: Notifications found due
+        """
+        due = Notification.get_due()
+        if due:
+            self._push(due)
+        return len(due)
+
+    def join(self, timeout=None):
+        """
+        Wait until nothing is queued or in flight; retries scheduled for later
+        are not waited for
+
+        Returns:
+            bool: False if notifications were still queued when the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.tracked:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        """Send what is queued, waiting up to timeout seconds, then stop the workers"""
+        if self.closed:
+            return
+        self.join(timeout)
+        self.stopped.set()
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Worker count, notifications queued here and delivery counters
+        """
+        with self.lock:
+            return {'workers': self.workers, 'queued': sum(len(q) for q in self.pending.values()),
+                    'in_flight': len(self.tracked) - sum(len(q) for q in self.pending.values()),
+                    'sent': self.sent, 'failed': self.failed, 'retried': self.retried,
+                    'batches': self.batches}
+
+
+# Shared outbox for patient notifications
+outbox = Outbox(create_transport(os.environ.get('TUJALI_SMS_TRANSPORT')),
+                workers=int(os.environ.get('TUJALI_SMS_WORKERS', 2)),
+                rate=float(os.environ.get('TUJALI_SMS_RATE', 50)))
+
+
+def deliver(message):
+    """
+    Queue a provider's message to a patient for delivery by SMS
+
+    Returns:
+        Notification or None: None if the patient has no phone number
+    """
+    patient = Patient.get_by_id(message.patient_id)
+    if patient is None or not patient.phone_number:
+        return None
+    return outbox.enqueue(patient.phone_number, message.content, patient_id=patient.id,
+                          provider_id=message.provider_id, message_id=message.id)
+
+
+def queue_reminders(day=None):
+    """
+    Queue SMS reminders for the confirmed appointments of a day whose patients
+    were not reminded yet, in each patient's language
+
+    Args:
+        day (date, optional): Day of the appointments; tomorrow by default
+
+    Returns:
+        int: Reminders queued
+    """
+    date = (day or datetime.now().date() + timedelta(days=1)).strftime('%d-%m-%Y')
+    queued = 0
+    for appointment in Appointment.get_to_remind(date):
+        patient = Patient.get_by_id(appointment.patient_id)
+        provider = Provider.get_by_id(appointment.provider_id)
+        if patient is None or provider is None or not patient.phone_number:
+            continue
+        content = catalog.format('appointment_reminder', patient.language,
+                                 provider=provider.name, date=appointment.date, time=appointment.time)
+        outbox.enqueue(patient.phone_number, content, patient_id=patient.id, provider_id=provider.id)
+        Appointment.mark_reminder_sent(appointment.id)
+        queued += 1
+    return queued
+
+
+def send_reminders(hour, stopped):
+    """
+    Queue the next day's reminders every day once the hour has passed; run
+    in a thread of the process that sends SMS
+
+    Args:
+        hour (int): Hour of the day (0-23) after which reminders are queued
+        stopped (threading.Event): Set to stop
+    """
+    done = None  # day reminders were last queued on
+    while True:
+        now = datetime.now()
+        if now.hour >= hour and done != now.date():
+            try:
+                queued = queue_reminders()
+                logger.info(f"Queued {queued} appointment reminders")
+                done = now.date()
+            except Exception as e:
+                logger.error(f"Error queueing appointment reminders: {e}")
+        if stopped.wait(60):
+            return
+
+
+if outbox.workers and os.environ.get('TUJALI_REMINDER_HOUR'):
+    threading.Thread(target=send_reminders, args=(int(os.environ['TUJALI_REMINDER_HOUR']), outbox.stopped),
+                     name='sms-reminders', daemon=True).start()
+
+
+def main():
+    if sys.argv[1:] != ['reminders']:
+        print(__doc__.strip().split('Usage:')[1].strip())
+        sys.exit(2)
+    if isinstance(store, MemoryStorage):
+        print("Reminders can only be queued from here with SQLite storage (TUJALI_STORAGE=sqlite:///...); "
+              "with memory storage set TUJALI_REMINDER_HOUR for the server to queue them", file=sys.stderr)
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    queued = queue_reminders()
+    outbox.join()
+    print(f"Queued {queued} reminders: {outbox.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+Snapshot and write-ahead log persistence for the in-memory storage backend
+
+Every write made through MemoryStorage is appended to a write-ahead log (WAL).
+Appending only touches memory: a background thread writes all pending entries
+in one batch and fsyncs once per batch (group commit), so requests never wait
+on the disk. Periodic snapshots store the whole database in one compact file,
+after which the WAL segments they cover are deleted. On startup the latest
+snapshot is loaded and the WAL entries written after it are replayed.
+
+Enable it by setting TUJALI_DATA_DIR to a directory for these files. The WAL
+is written by one process, so use it with a single worker; use the SQLite
+backend to share data between several workers. The process holds a lock on
+the directory while it runs, and a second process (a second worker, or
+bulk.py run next to the server) refuses to open it.
+"""
+
+import os
+import glob
+import time
+import zlib
+import atexit
+import pickle
+import struct
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows; the data directory is not locked there
+    fcntl = None
+
+from columnar import EventTable
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+LOCK_FILE = 'lock'
+WAL_PREFIX = 'wal-'
+WAL_SUFFIX = '.log'
+
+# Each WAL entry is: payload length, CRC32 of payload, log sequence number (LSN)
+ENTRY_HEADER = struct.Struct('>IIQ')
+
+
+def _segment_path(directory, start_lsn):
+    """Path of the WAL segment whose first entry has the given LSN"""
+    return os.path.join(directory, f"{WAL_PREFIX}{start_lsn:020d}{WAL_SUFFIX}")
+
+
+def _segments(directory):
+    """WAL segment paths in LSN order"""
+    return sorted(glob.glob(os.path.join(directory, f"{WAL_PREFIX}*{WAL_SUFFIX}")))
+
+
+def _encode(lsn, payload):
+    """Frame a pickled WAL entry with its header"""
+    return ENTRY_HEADER.pack(len(payload), zlib.crc32(payload), lsn) + payload
+
+
+def read_segment(path):
+    """
+    Read the entries of a WAL segment, stopping at a torn or corrupt tail
+
+    Yields:
+        tuple: (lsn, op, collection, record)
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(ENTRY_HEADER.size)
+            if not header:
+                return
+            if len(header) < ENTRY_HEADER.size:
+                logger.warning(f"Ignoring torn entry at end of {path}")
+                return
+            length, crc, lsn = ENTRY_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning(f"Ignoring corrupt entry {lsn} at end of {path}")
+                return
+            op, collection, record = pickle.loads(payload)
+            yield lsn, op, collection, record
+
+
+def _put(records, record):
+    """Upsert a recovered record into a collection's id -> record dict or EventTable"""
+    if isinstance(records, EventTable):
+        records.put(record)
+    else:
+        records[record.id] = record
+
+
+def recover(directory):
+    """
+    Rebuild the database from the latest snapshot plus the WAL tail
+
+    Args:
+        directory (str): Directory holding the snapshot and WAL segments
+
+    Returns:
+        tuple: (collections dict or None if there is nothing to recover,
+                ID sequences from the snapshot, last LSN)
+    """
+    data = None
+    sequences = {}
+    snapshot_lsn = 0
+    snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+        snapshot_lsn = snapshot['lsn']
+        # Records replayed from the WAL move the sequences past their own IDs
+        sequences = snapshot.get('sequences', {})
+        # Columnar collections are snapshotted as EventTables and stay columnar
+        data = {collection: records if isinstance(records, EventTable)
+                else {record.id: record for record in records}
+                for collection, records in snapshot['collections'].items()}
+
+    last_lsn = snapshot_lsn
+    replayed = 0
+    for path in _segments(directory):
+        for lsn, op, collection, record in read_segment(path):
+            last_lsn = max(last_lsn, lsn)
+            if lsn <= snapshot_lsn:
+                continue
+            if data is None:
+                data = {}
+            # Entries carry the full record, so replaying is an idempotent upsert
+            if op == 'put':
+                _put(data.setdefault(collection, {}), record)
+            elif op == 'clear':
+                data = {collection: {} for collection in data}
+            replayed += 1
+
+    if data is None:
+        return None, sequences, last_lsn
+
+    logger.info(f"Recovered snapshot at LSN {snapshot_lsn} and replayed {replayed} WAL entries")
+    collections = {collection: records if isinstance(records, EventTable) else list(records.values())
+                   for collection, records in data.items()}
+    return collections, sequences, last_lsn
+
+
+class WriteAheadLog:
+    """Append-only log of storage writes with group commit"""
+    def __init__(self, directory, start_lsn=0, flush_interval=0.05, max_batch=1000):
+        """
+        Args:
+            directory (str): Directory for WAL segments
+            start_lsn (int): Last LSN already on disk
+            flush_interval (float): Longest time in seconds an entry waits before being written
+            max_batch (int): Number of pending entries that triggers an early write
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.lsn = start_lsn
+        self.flushed_lsn = start_lsn
+        self.pending = []
+        self.lock = threading.Lock()  # guards lsn and pending
+        self.wakeup = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()  # serializes disk writes and segment rotation
+        self.closed = False
+        # A segment starting after the last durable LSN holds no valid entries
+        self.file = open(_segment_path(directory, start_lsn + 1), 'wb')
+        self.thread = threading.Thread(target=self._run, name='wal-writer', daemon=True)
+        self.thread.start()
+
+    def append(self, op, collection, record):
+        """
+        Queue a write for the log; it reaches disk with the next group commit
+
+        Returns:
+            int: LSN assigned to the entry
+        """
+        # Pickle now, since the record may change before the batch is written
+        payload = pickle.dumps((op, collection, record), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.lsn += 1
+            self.pending.append(_encode(self.lsn, payload))
+            if len(self.pending) >= self.max_batch:
+                self.wakeup.notify()
+            return self.lsn
+
+    # A WriteAheadLog can be registered directly as a storage listener
+    __call__ = append
+
+    def _write_pending(self):
+        """Write and fsync the pending batch; the caller holds write_lock"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+            lsn = self.lsn
+        if batch:
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.flushed_lsn = lsn
+        return lsn
+
+    def flush(self):
+        """
+        Write and fsync every pending entry now
+
+        Returns:
+            int: Highest LSN that is durable on disk
+        """
+        with self.write_lock:
+            return self._write_pending()
+
+    def rotate(self):
+        """
+        Flush and start a new segment
+
+        Returns:
+            int: Last LSN in the segments written before the rotation
+        """
+        with self.write_lock:
+            lsn = self._write_pending()
+            self.file.close()
+            self.file = open(_segment_path(self.directory, lsn + 1), 'wb')
+            return lsn
+
+    def remove_segments_before(self, lsn):
+        """Delete segments that only hold entries up to and including lsn"""
+        current = os.path.abspath(self.file.name)
+        for path in _segments(self.directory):
+            start = int(os.path.basename(path)[len(WAL_PREFIX):-len(WAL_SUFFIX)])
+            if start <= lsn and os.path.abspath(path) != current:
+                os.remove(path)
+
+    def _run(self):
+        """Background group commit loop"""
+        while not self.closed:
+            with self.lock:
+                if not self.closed and len(self.pending) < self.max_batch:
+                    self.wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing WAL batch: {e}")
+
+    def close(self):
+        """Flush pending entries and stop the writer thread"""
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join(timeout=5)
+        with self.write_lock:
+            self._write_pending()
+            self.file.close()
+
+
+class Persistence:
+    """Keeps a MemoryStorage durable with a WAL and periodic snapshots"""
+    def __init__(self, store, directory, snapshot_interval=300, snapshot_every=10000,
+                 flush_interval=0.05):
+        """
+        Args:
+            store (MemoryStorage): Store to recover and log
+            directory (str): Directory for the snapshot and WAL segments
+            snapshot_interval (float): Seconds between snapshots while there are new writes
+            snapshot_every (int): Number of WAL entries that triggers a snapshot early
+            flush_interval (float): Group commit interval of the WAL in seconds
+        """
+        self.store = store
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.snapshot_lsn = 0
+        self.wal = None
+        self.stopped = threading.Event()
+        self.snapshot_lock = threading.Lock()
+        self.lock_file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _lock_directory(self):
+        """
+        Take an exclusive lock on the data directory, held until the process exits
+
+        Raises:
+            RuntimeError: If another process is using the directory
+        """
+        if fcntl is None:
+            return
+        self.lock_file = open(os.path.join(self.directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RuntimeError(f"Data directory {self.directory} is in use by another process; "
+                               f"stop it before opening the directory here")
+
+    def start(self):
+        """
+        Recover the store from disk and start logging its writes
+
+        Returns:
+            bool: True if existing data was recovered
+
+        Raises:
+            RuntimeError: If another process is using the data directory
+        """
+        self._lock_directory()
+        collections, sequences, last_lsn = recover(self.directory)
+        if collections is not None:
+            self.store.restore(collections, sequences)
+        self.snapshot_lsn = last_lsn
+
+        self.wal = WriteAheadLog(self.directory, last_lsn, self.flush_interval)
+        self.store.add_listener(self.wal)
+
+        threading.Thread(target=self._run, name='snapshot-writer', daemon=True).start()
+        atexit.register(self.close)
+        return collections is not None
+
+    def snapshot(self):
+        """
+        Write a compact snapshot of the whole store and drop the WAL segments it covers
+
+        Returns:
+            int: LSN covered by the snapshot
+        """
+        with self.snapshot_lock:
+            lsn = self.wal.rotate()
+            # Writes made while copying may also land in the snapshot; replaying
+            # them again on recovery is harmless because WAL entries are upserts
+            collections = self.store.snapshot()
+            sequences = self.store.sequence_values()
+            path = os.path.join(self.directory, SNAPSHOT_FILE)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'lsn': lsn, 'created_at': time.time(), 'collections': collections,
+                             'sequences': sequences},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.wal.remove_segments_before(lsn)
+            self.snapshot_lsn = lsn
+            logger.info(f"Wrote snapshot at LSN {lsn}")
+            return lsn
+
+    def _run(self):
+        """Background loop taking snapshots by time or WAL volume"""
+        last_snapshot = time.monotonic()
+        while not self.stopped.wait(1):
+            backlog = self.wal.lsn - self.snapshot_lsn
+            elapsed = time.monotonic() - last_snapshot
+            if backlog >= self.snapshot_every or (backlog and elapsed >= self.snapshot_interval):
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    logger.error(f"Error writing snapshot: {e}")
+                last_snapshot = time.monotonic()
+
+    def close(self):
+        """Stop taking snapshots and flush the WAL"""
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.wal.close()
+        if self.lock_file is not None:
+            self.lock_file.close()  # releases the lock
+
+
+def enable_persistence(store, directory, **kwargs):
+    """
+    Recover a MemoryStorage from a data directory and keep it durable there
+
+    Args:
+        store (MemoryStorage): Store to persist
+        directory (str): Directory for the snapshot and WAL segments
+        **kwargs: Options passed to Persistence
+
+    Returns:
+        Persistence: The running persistence manager
+    """
+    persistence = Persistence(store, directory, **kwargs)
+    persistence.start()
+    return persistence
@@ -0,0 +1,247 @@
+"""
+USSD session stores for Tujali Telehealth
+
+A USSD session is a small dict (phone number, menu state, language and the
+answers collected so far) that must survive between the requests of one dial.
+Gateways drop a session after a few minutes of inactivity, so stores expire
+sessions that have not been touched for ttl seconds.
+
+Stores are selected with the TUJALI_SESSION_STORE environment variable:
+    memory                       Per-process LRU dict with TTL (default)
+    sqlite:///path/to/sessions.db  SQLite file shared by every gunicorn worker
+
+Both count hits, misses and evictions; stats() returns the counters.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Seconds a session lives after its last request; Africa's Talking ends
+# sessions after about three minutes
+DEFAULT_TTL = 180
+
+
+class MemorySessionStore:
+    """
+    In-process session store: an OrderedDict kept in least-recently-used order
+
+    Every read or write moves a session to the end, so the sessions at the
+    front are both the least recently used and the first to expire. Expired
+    sessions are swept from the front on each write, and the least recently
+    used session is evicted when the store is full, so memory stays bounded
+    however many sessions are abandoned.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=100000):
+        """
+        Args:
+            ttl (float): Seconds a session lives after its last use
+            max_sessions (int): Sessions kept before the least recently used is evicted
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session_id -> (expires_at, session)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, session_id):
+        """Return a live session and refresh its TTL, or None"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.sessions[session_id]
+                    self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.sessions[session_id] = (now + self.ttl, entry[1])
+            self.sessions.move_to_end(session_id)
+            return entry[1]
+
+    def put(self, session_id, session):
+        """Store a session and refresh its TTL"""
+        now = time.monotonic()
+        with self.lock:
+            self.sessions[session_id] = (now + self.ttl, session)
+            self.sessions.move_to_end(session_id)
+            self._sweep(now)
+
+    def _sweep(self, now):
+        """Drop expired sessions and evict beyond max_sessions; the caller holds the lock"""
+        while self.sessions:
+            session_id, (expires_at, _) = next(iter(self.sessions.items()))
+            if expires_at > now:
+                break
+            del self.sessions[session_id]
+            self.expired += 1
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evicted += 1
+
+    def delete(self, session_id):
+        """Forget a session, e.g. once it has ended"""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def clear(self):
+        """Forget every session"""
+        with self.lock:
+            self.sessions.clear()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Session count and hit, miss, expiry and eviction counters
+        """
+        with self.lock:
+            return {'backend': 'memory', 'sessions': len(self.sessions), 'hits': self.hits,
+                    'misses': self.misses, 'expired': self.expired, 'evicted': self.evicted}
+
+
+class SQLiteSessionStore:
+    """
+    Session store in a SQLite file, so every worker process sees every session
+
+    Sessions are pickled into one row each with their expiry time. Expired
+    rows are ignored on read and deleted in batches every purge_every writes.
+    Counters are kept per process. Stores with different tables can share a
+    database file.
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, purge_every=1000, table='ussd_sessions'):
+        """
+        Args:
+            path (str): Path to the SQLite database file
+            ttl (float): Seconds a session lives after its last use
+            purge_every (int): Writes between deletions of expired rows
+            table (str): Table the sessions are kept in
+        """
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.local = threading.local()
+        self.lock = threading.Lock()  # guards the counters
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        conn = self.connection()
+        with conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                         '(session_id TEXT PRIMARY KEY, expires_at REAL NOT NULL, data BLOB NOT NULL)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_expires_at '
+                         f'ON {table} (expires_at)')
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def get(self, session_id):
+        """Return a live session and refresh its TTL, or None"""
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            row = conn.execute(f'SELECT data FROM {self.table} WHERE session_id = ? AND expires_at > ?',
+                               (session_id, now)).fetchone()
+            if row:
+                conn.execute(f'UPDATE {self.table} SET expires_at = ? WHERE session_id = ?',
+                             (now + self.ttl, session_id))
+        with self.lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return pickle.loads(row[0]) if row else None
+
+    def put(self, session_id, session):
+        """Store a session and refresh its TTL"""
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute(f'INSERT OR REPLACE INTO {self.table} (session_id, expires_at, data) '
+                         'VALUES (?, ?, ?)',
+                         (session_id, now + self.ttl, pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL)))
+        with self.lock:
+            self.writes += 1
+            purge = self.writes % self.purge_every == 0
+        if purge:
+            self.purge(now)
+
+    def purge(self, now=None):
+        """
+        Delete expired sessions
+
+        Returns:
+            int: Number of sessions deleted
+        """
+        conn = self.connection()
+        with conn:
+            deleted = conn.execute(f'DELETE FROM {self.table} WHERE expires_at <= ?',
+                                   (now or time.time(),)).rowcount
+        with self.lock:
+            self.expired += deleted
+        return deleted
+
+    def delete(self, session_id):
+        """Forget a session, e.g. once it has ended"""
+        conn = self.connection()
+        with conn:
+            conn.execute(f'DELETE FROM {self.table} WHERE session_id = ?', (session_id,))
+
+    def clear(self):
+        """Forget every session"""
+        conn = self.connection()
+        with conn:
+            conn.execute(f'DELETE FROM {self.table}')
+
+    def stats(self):
+        """
+        Returns:
+            dict: Session count and this process's hit, miss and expiry counters
+        """
+        count = self.connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        with self.lock:
+            return {'backend': 'sqlite', 'sessions': count, 'hits': self.hits,
+                    'misses': self.misses, 'expired': self.expired, 'evicted': 0}
+
+
+def create_session_store(url, ttl=DEFAULT_TTL, table='ussd_sessions'):
+    """
+    Create a session store from a URL
+
+    Args:
+        url (str): 'memory' or 'sqlite:///path/to/file.db'
+        ttl (float): Seconds a session lives after its last use
+        table (str): Table of a SQLite store
+
+    Returns:
+        MemorySessionStore or SQLiteSessionStore
+    """
+    if not url or url == 'memory':
+        return MemorySessionStore(ttl)
+    if url.startswith('sqlite:///'):
+        path = url[len('sqlite:///'):]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        logger.info(f"Using SQLite USSD session store at {path} ({table})")
+        return SQLiteSessionStore(path, ttl, table=table)
+    raise ValueError(f"Unsupported session store URL: {url}")
@@ -0,0 +1,168 @@
+"""
+Appointment slot inventory for Tujali Telehealth
+
+Appointments are booked in a fixed set of daily time slots (TIME_SLOTS). The
+inventory keeps a bitmap per provider and day of the slots held by
+appointments that are not cancelled, where bit i stands for TIME_SLOTS[i]. A
+day is loaded from the store the first time it is asked for and then kept
+current by Appointment.create and Appointment.update_status, so looking up
+the free slots of a provider costs one dict access.
+
+Bitmaps are kept per process. reserve() reloads the day from the store
+before taking a slot, and with SQLite storage a unique index on active
+appointments refuses a slot another worker booked in between.
+Slots reserved in this process whose appointment is not stored yet are kept
+apart as pending, so a reload does not give them away. Days before today are
+dropped once a day.
+"""
+
+import threading
+from datetime import date as calendar_date, datetime
+
+# Times offered for appointments every day
+TIME_SLOTS = ('09:00', '10:00', '11:00', '14:00', '15:00', '16:00')
+
+# Appointment statuses that give their slot back
+RELEASED_STATUSES = frozenset({'cancelled'})
+
+# Format of appointment dates
+DATE_FORMAT = '%d-%m-%Y'
+
+
+class SlotInventory:
+    """Bitmaps of the taken time slots of each provider and day"""
+    def __init__(self, load, slots=TIME_SLOTS):
+        """
+        Args:
+            load (callable): load(provider_id, date) returns the provider's appointments on that day
+            slots (tuple): Daily time slots, in menu order
+        """
+        self.load = load
+        self.slots = tuple(slots)
+        self.bits = {time: 1 << i for i, time in enumerate(self.slots)}
+        self.all = (1 << len(self.slots)) - 1
+        self.taken = {}  # (provider_id, date) -> bitmap of taken slots, pending ones included
+        self.pending = {}  # (provider_id, date) -> bitmap of reserved slots not stored yet
+        self.pruned = None  # day past days were last dropped
+        self.lock = threading.Lock()
+
+    def _prune(self):
+        """Drop the bitmaps of days before today; the caller holds the lock"""
+        today = calendar_date.today()
+        if self.pruned == today:
+            return
+        self.pruned = today
+        for key in list(self.taken):
+            try:
+                past = datetime.strptime(key[1], DATE_FORMAT).date() < today
+            except (TypeError, ValueError):
+                continue
+            if past and key not in self.pending:
+                del self.taken[key]
+
+    def _load(self, provider_id, date):
+        """Read a day's taken slots from the store; the caller holds the lock"""
+        taken = self.pending.get((provider_id, date), 0)
+        for appointment in self.load(provider_id, date):
+            if appointment.status not in RELEASED_STATUSES:
+                taken |= self.bits.get(appointment.time, 0)
+        self.taken[provider_id, date] = taken
+        return taken
+
+    def _taken(self, provider_id, date):
+        """Taken slots of a day, loading it on first use; the caller holds the lock"""
+        self._prune()
+        taken = self.taken.get((provider_id, date))
+        return self._load(provider_id, date) if taken is None else taken
+
+    def free(self, provider_id, date):
+        """
+        Returns:
+            int: Bitmap of the provider's free slots on a day
+        """
+        with self.lock:
+            return self.all & ~self._taken(provider_id, date)
+
+    def free_any(self, provider_ids, date):
+        """
+        Returns:
+            int: Bitmap of the slots on a day at which any of the providers is free
+        """
+        free = 0
+        with self.lock:
+            for provider_id in provider_ids:
+                free |= self.all & ~self._taken(provider_id, date)
+                if free == self.all:
+                    break
+        return free
+
+    def is_free(self, provider_id, date, time):
+        """Whether a provider's slot is free"""
+        return bool(self.free(provider_id, date) & self.bits.get(time, 0))
+
+    def times(self, bitmap):
+        """
+        Returns:
+            tuple: Times of the slots set in a bitmap, in menu order
+        """
+        return tuple(time for time, bit in self.bits.items() if bitmap & bit)
+
+    def reserve(self, provider_id, date, time):
+        """
+        Take a slot if it is still free, checking the store first
+
+        Returns:
+            bool: True if the slot was free and is now taken
+        """
+        bit = self.bits.get(time, 0)
+        key = (provider_id, date)
+        with self.lock:
+            self._prune()
+            taken = self._load(provider_id, date)
+            if not bit or taken & bit:
+                return False
+            self.pending[key] = self.pending.get(key, 0) | bit
+            self.taken[key] = taken | bit
+            return True
+
+    def _settle(self, key, bit):
+        """Clear a pending reservation; the caller holds the lock"""
+        pending = self.pending.get(key, 0) & ~bit
+        if pending:
+            self.pending[key] = pending
+        else:
+            self.pending.pop(key, None)
+
+    def release(self, provider_id, date, time):
+        """Give back a slot taken by reserve() for a booking that was not made"""
+        key = (provider_id, date)
+        bit = self.bits.get(time, 0)
+        with self.lock:
+            self._settle(key, bit)
+            if key in self.taken:
+                self.taken[key] &= ~bit
+
+    def booked(self, appointment):
+        """Mark the slot of a new appointment as taken"""
+        key = (appointment.provider_id, appointment.date)
+        with self.lock:
+            # A reservation is no longer pending once its appointment is stored
+            self._settle(key, self.bits.get(appointment.time, 0))
+            # Days not loaded yet will include the appointment when they are
+            if key in self.taken and appointment.status not in RELEASED_STATUSES:
+                self.taken[key] |= self.bits.get(appointment.time, 0)
+
+    def forget(self, provider_id, date):
+        """Forget a provider's day, so it is reloaded from the store"""
+        with self.lock:
+            self.taken.pop((provider_id, date), None)
+
+    def changed(self, appointment):
+        """Forget the day of an appointment whose status changed, so it is reloaded"""
+        self.forget(appointment.provider_id, appointment.date)
+
+    def clear(self):
+        """Forget every loaded day and pending reservation"""
+        with self.lock:
+            self.taken.clear()
+            self.pending.clear()
@@ -68,6 +68,55 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // Load older messages of the conversation, one page at a time
+    const loadOlderButton = document.getElementById('loadOlderButton');
+
+    if (loadOlderButton && messageContainer) {
+        const loadOlder = document.getElementById('loadOlder');
+        const scroller = messageContainer.parentElement;
+
+        loadOlderButton.addEventListener('click', function() {
+            loadOlderButton.disabled = true;
+
+            fetch(`${loadOlderButton.dataset.url}?before=${loadOlderButton.dataset.before}`)
+                .then(response => response.json())
+                .then(page => {
+                    // Keep the messages on screen in place while older ones are added above
+                    const previousHeight = scroller.scrollHeight;
+
+                    page.messages.forEach(message => {
+                        const element = document.createElement('div');
+                        element.className = `message ${message.sender_type === 'patient' ? 'message-patient' : 'message-provider'}`;
+
+                        const content = document.createElement('div');
+                        content.className = 'message-content';
+                        content.textContent = message.content;
+
+                        const meta = document.createElement('div');
+                        meta.className = 'message-meta';
+                        meta.textContent = message.time;
+
+                        element.append(content, meta);
+                        loadOlder.before(element);
+                    });
+                    // Move the button back above the messages just added
+                    messageContainer.prepend(loadOlder);
+                    scroller.scrollTop += scroller.scrollHeight - previousHeight;
+
+                    if (page.before === null) {
+                        loadOlder.remove();
+                    } else {
+                        loadOlderButton.dataset.before = page.before;
+                        loadOlderButton.disabled = false;
+                    }
+                })
+                .catch(error => {
+                    console.error('Error loading older messages:', error);
+                    loadOlderButton.disabled = false;
+                });
+        });
+    }
+
     // Real-time message checking (polling)
     function checkForNewMessages() {
         // In a real application, this would be an AJAX call to check for new messages
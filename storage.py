@@ -0,0 +1,1055 @@
+"""
+Storage backends for Tujali Telehealth
+
+The models in models.py read and write records through a storage backend, so
+the same static methods (create, get_by_*, update_status) work against process
+memory or against a SQLite file shared by several gunicorn workers.
+
+Backends are selected with the TUJALI_STORAGE environment variable:
+    memory                       In-process lists with hash indexes (default);
+                                 event collections are kept in columnar tables
+    sqlite:///path/to/tujali.db  SQLite file with one table per collection
+
+Both backends are safe to use from a threaded server (Flask threaded=True or
+gunicorn --threads). The memory backend guards each collection with its own
+reader/writer lock, so requests touching different collections never wait on
+each other and readers of one collection only wait while it is written.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import logging
+from bisect import bisect_left, bisect_right, insort
+from operator import attrgetter
+from contextlib import contextmanager, ExitStack
+from collections import Counter
+from collections.abc import Mapping
+from columnar import EventTable
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def _index_key(record, fields):
+    """Build the bucket key for a record under an index on the given fields"""
+    if len(fields) == 1:
+        return getattr(record, fields[0], None)
+    return tuple(getattr(record, field, None) for field in fields)
+
+
+class ReadWriteLock:
+    """
+    Lock allowing many readers or one writer at a time
+
+    Waiting writers block new readers, so a steady stream of reads cannot
+    starve writes. The lock is not reentrant.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """Hold the lock shared for the duration of a with block"""
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock exclusively for the duration of a with block"""
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+class IdSequence:
+    """
+    Thread-safe monotonic ID counter for one collection
+
+    IDs are handed out under a lock, so concurrent creates never receive the
+    same ID, and an ID is never reused even if its record is later removed.
+    """
+    def __init__(self, value=0):
+        """
+        Args:
+            value (int): Last ID already in use
+        """
+        self.value = value
+        self.lock = threading.Lock()
+
+    def next(self):
+        """Reserve and return the next ID"""
+        with self.lock:
+            self.value += 1
+            return self.value
+
+    def reserve(self, count):
+        """Reserve count consecutive IDs in one step and return them as a range"""
+        with self.lock:
+            first = self.value + 1
+            self.value += count
+            return range(first, self.value + 1)
+
+    def advance_to(self, value):
+        """Make sure IDs up to value are never handed out, e.g. after an explicit insert"""
+        with self.lock:
+            if value > self.value:
+                self.value = value
+
+    def current(self):
+        """Return the last ID handed out"""
+        with self.lock:
+            return self.value
+
+
+class MemoryStorage:
+    """
+    In-process storage: one list per collection plus a primary-key index,
+    secondary (foreign-key) indexes and unique indexes kept next to it
+
+    Collections listed as columnar are held in an EventTable (see columnar.py)
+    instead of a list. The table keeps its own per-key buckets and ID lookup,
+    so it gets no primary-key, secondary or unique index here, and records
+    read from it are materialized copies that must be written back with save.
+
+    Every collection has its own ReadWriteLock. Public methods take it, so a
+    write (insert or save, including its field changes, index updates and
+    listener calls) is never seen half done by a reader of that collection.
+    Private helpers expect the caller to hold the lock.
+    """
+    def __init__(self, collections, indexes=None, unique=None, columnar=None):
+        """
+        Args:
+            collections (iterable): Names of the collections to create
+            indexes (dict, optional): collection -> list of field tuples to index
+            unique (dict, optional): collection -> {field: normalizer} for unique fields
+            columnar (dict, optional): collection -> callable returning an empty EventTable
+        """
+        self.indexes = indexes or {}
+        self.unique = unique or {}
+        self.columnar = columnar or {}
+        self.db = {name: self._empty(name) for name in collections}
+        self.locks = {name: ReadWriteLock() for name in self.db}
+        self.pk_index = {}  # collection -> {id: record}
+        self.secondary_index = {}  # collection -> fields -> {key: [records]}
+        self.unique_index = {}  # collection -> field -> {normalized value: record}
+        self.listeners = []  # callables notified as listener(op, collection, record)
+        self.sequences = {}  # collection -> IdSequence
+        self.sequence_lock = threading.Lock()  # guards creating sequences
+        self.transaction_lock = threading.RLock()
+
+    def collections(self):
+        """Return the mapping of collection name to record list (or EventTable)"""
+        return self.db
+
+    def _empty(self, collection):
+        """Return a new empty container for a collection"""
+        factory = self.columnar.get(collection)
+        return factory() if factory else []
+
+    def _load(self, collection, records):
+        """Return a collection's container holding the given records"""
+        if collection not in self.columnar:
+            return list(records)
+        if isinstance(records, EventTable):
+            return records
+        table = self._empty(collection)
+        table.extend(records)
+        return table
+
+    def add_listener(self, listener):
+        """
+        Register a callable notified after every write, e.g. a write-ahead log
+
+        The listener is called as listener(op, collection, record) where op is
+        'put' for inserts and saves, or 'clear' (with collection and record
+        set to None) when every collection is emptied.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, op, collection, record):
+        """Pass a write on to the registered listeners"""
+        for listener in self.listeners:
+            listener(op, collection, record)
+
+    def restore(self, collections, sequences=None):
+        """
+        Replace the contents of the store, e.g. with recovered data
+
+        Args:
+            collections (dict): collection -> list of records, or an EventTable
+                for columnar collections
+            sequences (dict, optional): collection -> last ID handed out, so IDs
+                of records removed before the restore are not reused
+        """
+        with self._write_all():
+            for collection, records in collections.items():
+                self.db[collection] = self._load(collection, records)
+            self.rebuild_indexes()
+            with self.sequence_lock:
+                self.sequences = {}
+        for collection, value in (sequences or {}).items():
+            self._sequence(collection).advance_to(value)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a with block as one transaction against other transactions. The
+        memory store is written by one process, so this only keeps threads
+        of that process from interleaving transactions; writes are not
+        rolled back if the block raises.
+        """
+        with self.transaction_lock:
+            yield
+
+    def _lock(self, collection):
+        """Return the reader/writer lock of a collection"""
+        lock = self.locks.get(collection)
+        if lock is None:
+            lock = self.locks.setdefault(collection, ReadWriteLock())
+        return lock
+
+    @contextmanager
+    def _write_all(self):
+        """Hold every collection's write lock, always taken in the same order"""
+        with ExitStack() as stack:
+            for collection in sorted(self.db):
+                stack.enter_context(self._lock(collection).write())
+            yield
+
+    def _read(self, collection):
+        """
+        Take a collection's read lock, first rebuilding its indexes under the
+        write lock if they are stale
+        """
+        if self._stale(collection):
+            with self._lock(collection).write():
+                self._ensure_indexed(collection)
+        return self._lock(collection).read()
+
+    def snapshot(self):
+        """
+        Copy every collection's record list, each one taken under its read lock
+
+        Returns:
+            dict: collection -> list of records, or a copied EventTable for
+                columnar collections
+        """
+        copies = {}
+        for collection in list(self.db):
+            with self._read(collection):
+                if collection in self.columnar:
+                    copies[collection] = self.db[collection].copy()
+                else:
+                    copies[collection] = list(self.db[collection])
+        return copies
+
+    def _sequence(self, collection):
+        """Return the ID sequence of a collection, starting it after the highest existing ID"""
+        sequence = self.sequences.get(collection)
+        if sequence is None:
+            with self.sequence_lock:
+                sequence = self.sequences.get(collection)
+                if sequence is None:
+                    records = self.db.get(collection, [])
+                    if collection in self.columnar:
+                        ids = records.ids
+                    else:
+                        ids = (record.id for record in records)
+                    sequence = IdSequence(max(ids, default=0))
+                    self.sequences[collection] = sequence
+        return sequence
+
+    def sequence_values(self):
+        """Return collection -> last ID handed out, e.g. for a snapshot"""
+        return {collection: sequence.current() for collection, sequence in list(self.sequences.items())}
+
+    def _bucket_record(self, collection, record):
+        """
+        Add a record to every secondary index bucket of its collection,
+        keeping each bucket in ID order. IDs are reserved before the write
+        lock is taken, so a thread can insert a record after one with a
+        higher ID; such a record is placed by bisection instead of appended.
+        """
+        for fields, buckets in self.secondary_index.get(collection, {}).items():
+            bucket = buckets.setdefault(_index_key(record, fields), [])
+            if bucket and bucket[-1].id > record.id:
+                insort(bucket, record, key=attrgetter('id'))
+            else:
+                bucket.append(record)
+
+    def index_collection(self, collection):
+        """Rebuild all indexes for a collection from its list"""
+        if collection in self.columnar:
+            return None
+        records = self.db.setdefault(collection, [])
+        self.pk_index[collection] = {record.id: record for record in records}
+        self.secondary_index[collection] = {
+            tuple(fields): {} for fields in self.indexes.get(collection, [])
+        }
+        self.unique_index[collection] = {field: {} for field in self.unique.get(collection, {})}
+        for record in records:
+            self._bucket_record(collection, record)
+            for field, normalize in self.unique.get(collection, {}).items():
+                key = normalize(getattr(record, field, None))
+                self.unique_index[collection][field].setdefault(key, record)
+        return self.pk_index[collection]
+
+    def rebuild_indexes(self):
+        """Rebuild the indexes for every collection"""
+        for collection in self.db:
+            self.index_collection(collection)
+
+    def _stale(self, collection):
+        """True if a collection's list was replaced or appended to directly"""
+        if collection in self.columnar:
+            return False
+        index = self.pk_index.get(collection)
+        return index is None or len(index) != len(self.db.get(collection, []))
+
+    def _ensure_indexed(self, collection):
+        """Rebuild a collection's indexes if they are stale"""
+        if self._stale(collection):
+            return self.index_collection(collection)
+        return self.pk_index[collection]
+
+    def next_id(self, collection):
+        """Reserve the ID for the next record in a collection; safe to call from any thread"""
+        return self._sequence(collection).next()
+
+    def next_ids(self, collection, count):
+        """Reserve IDs for a batch of records; returns a range of count consecutive IDs"""
+        return self._sequence(collection).reserve(count)
+
+    def insert(self, collection, record):
+        """
+        Add a record to a collection and to the collection's indexes
+
+        Raises:
+            ValueError: If the record duplicates a unique field
+        """
+        with self._lock(collection).write():
+            if collection in self.columnar:
+                self.db[collection].append(record)
+                self._sequence(collection).advance_to(record.id)
+                self._notify('put', collection, record)
+                return record
+
+            index = self._ensure_indexed(collection)
+            for field, normalize in self.unique.get(collection, {}).items():
+                key = normalize(getattr(record, field, None))
+                if key in self.unique_index[collection][field]:
+                    raise ValueError(f"Duplicate {field} in {collection}: {getattr(record, field, None)}")
+
+            self.db[collection].append(record)
+            index[record.id] = record
+            self._sequence(collection).advance_to(record.id)
+            self._bucket_record(collection, record)
+            for field, normalize in self.unique.get(collection, {}).items():
+                key = normalize(getattr(record, field, None))
+                self.unique_index[collection][field][key] = record
+            self._notify('put', collection, record)
+        return record
+
+    def insert_many(self, collection, records):
+        """
+        Add a batch of records under one write lock. Unique fields are checked
+        for the whole batch first, then the list, indexes and ID sequence are
+        updated together, so readers see either none or all of the batch.
+
+        Raises:
+            ValueError: If a record duplicates a unique field or ID; nothing is inserted
+        """
+        records = list(records)
+        with self._lock(collection).write():
+            if collection in self.columnar:
+                table = self.db[collection]
+                ids = {record.id for record in records}
+                if len(ids) < len(records) or any(table.position(i) is not None for i in ids):
+                    raise ValueError(f"Duplicate id in {collection}")
+                table.extend(records)
+            else:
+                index = self._ensure_indexed(collection)
+                uniques = self.unique.get(collection, {})
+                seen = {field: set() for field in uniques}
+                for record in records:
+                    for field, normalize in uniques.items():
+                        key = normalize(getattr(record, field, None))
+                        if key in self.unique_index[collection][field] or key in seen[field]:
+                            raise ValueError(f"Duplicate {field} in {collection}: {getattr(record, field, None)}")
+                        seen[field].add(key)
+
+                self.db[collection].extend(records)
+                for record in records:
+                    index[record.id] = record
+                    self._bucket_record(collection, record)
+                    for field, normalize in uniques.items():
+                        self.unique_index[collection][field][normalize(getattr(record, field, None))] = record
+
+            if records:
+                self._sequence(collection).advance_to(max(record.id for record in records))
+            for record in records:
+                self._notify('put', collection, record)
+        return records
+
+    def get(self, collection, record_id):
+        """Look up a record by primary key in O(1), or None if not found"""
+        with self._read(collection):
+            if collection in self.columnar:
+                return self.db[collection].get(record_id)
+            return self.pk_index[collection].get(record_id)
+
+    def get_unique(self, collection, field, value):
+        """Look up a record by a unique field, or None if not found"""
+        normalize = self.unique[collection][field]
+        with self._read(collection):
+            return self.unique_index[collection][field].get(normalize(value))
+
+    def find(self, collection, **criteria):
+        """
+        Find records whose fields match all the given values, using a
+        secondary index when one covers the criteria
+
+        Returns:
+            list: Matching records in insertion order
+        """
+        with self._read(collection):
+            if collection in self.columnar:
+                return self.db[collection].find(**criteria)
+            indexes = self.secondary_index.get(collection, {})
+
+            # Prefer an index on exactly these fields, otherwise the widest index
+            # covering a subset of them, and filter the bucket on the rest
+            best = None
+            for fields in indexes:
+                if set(fields) <= set(criteria) and (best is None or len(fields) > len(best)):
+                    best = fields
+
+            if best is None:
+                candidates = self.db.get(collection, [])
+            else:
+                key = criteria[best[0]] if len(best) == 1 else tuple(criteria[f] for f in best)
+                candidates = indexes[best].get(key, [])
+
+            remaining = [(f, v) for f, v in criteria.items() if best is None or f not in best]
+            if not remaining:
+                return list(candidates)
+            return [r for r in candidates if all(getattr(r, f, None) == v for f, v in remaining)]
+
+    def page(self, collection, limit, before=None, after=None, **criteria):
+        """
+        One page of the records matching the given values, for keyset pagination
+
+        When an index covers exactly these fields, its bucket is searched by ID,
+        so a page costs O(log n + limit). Index buckets are kept in ID order
+        (see _bucket_record).
+
+        Args:
+            limit (int): Records to return at most
+            before (int, optional): Return the last records with a lower ID
+            after (int, optional): Return the first records with a higher ID;
+                the records with the highest IDs are returned if neither is given
+
+        Returns:
+            list: Matching records in ID order
+        """
+        indexes = self.secondary_index.get(collection, {})
+        fields = next((fields for fields in indexes if set(fields) == set(criteria)), None)
+        if collection in self.columnar or fields is None:
+            records = sorted(self.find(collection, **criteria), key=attrgetter('id'))
+        else:
+            with self._read(collection):
+                key = criteria[fields[0]] if len(fields) == 1 else tuple(criteria[f] for f in fields)
+                records = indexes[fields].get(key, [])
+                if after is not None:
+                    start = bisect_right(records, after, key=attrgetter('id'))
+                    return records[start:start + limit]
+                end = len(records) if before is None else bisect_left(records, before, key=attrgetter('id'))
+                return records[max(0, end - limit):end]
+        if after is not None:
+            return [r for r in records if r.id > after][:limit]
+        if before is not None:
+            records = [r for r in records if r.id < before]
+        return records[-limit:] if limit else []
+
+    def all(self, collection):
+        """Return a copy of the record list of a collection, in insertion order"""
+        with self._read(collection):
+            return list(self.db.get(collection, []))
+
+    def scan(self, collection, batch_size=1000):
+        """
+        Iterate over a collection in insertion order without copying it whole;
+        the read lock is only held while each batch is copied
+
+        Yields:
+            Records of the collection
+        """
+        position = 0
+        while True:
+            with self._read(collection):
+                batch = self.db.get(collection, [])[position:position + batch_size]
+            if not batch:
+                return
+            position += len(batch)
+            yield from batch
+
+    def count(self, collection, **criteria):
+        """Count the records in a collection matching the given values"""
+        if collection in self.columnar:
+            with self._read(collection):
+                return self.db[collection].count(**criteria)
+        if not criteria:
+            with self._read(collection):
+                return len(self.db.get(collection, []))
+        return len(self.find(collection, **criteria))
+
+    def count_by(self, collection, field, **criteria):
+        """
+        Count the records matching the given values per value of a field
+
+        Returns:
+            dict: field value -> number of records
+        """
+        if collection in self.columnar:
+            with self._read(collection):
+                return self.db[collection].count_by(field, **criteria)
+        return dict(Counter(getattr(r, field, None) for r in self.find(collection, **criteria)))
+
+    def _save(self, collection, record, changes):
+        """Apply field changes and move the record between index buckets; the caller holds the write lock"""
+        if collection in self.columnar:
+            for field, value in changes.items():
+                setattr(record, field, value)
+            self.db[collection].put(record)
+            self._notify('put', collection, record)
+            return record
+
+        self._ensure_indexed(collection)
+        indexes = self.secondary_index.get(collection, {})
+        old_keys = {fields: _index_key(record, fields) for fields in indexes}
+
+        for field, value in changes.items():
+            setattr(record, field, value)
+
+        for fields, buckets in indexes.items():
+            new_key = _index_key(record, fields)
+            if new_key != old_keys[fields]:
+                # Buckets are kept in ID order (see _bucket_record), so the record
+                # is found and placed again by bisection
+                bucket = buckets.get(old_keys[fields], [])
+                i = bisect_left(bucket, record.id, key=attrgetter('id'))
+                if i < len(bucket) and bucket[i] is record:
+                    del bucket[i]
+                elif record in bucket:
+                    bucket.remove(record)
+                insort(buckets.setdefault(new_key, []), record, key=attrgetter('id'))
+        self._notify('put', collection, record)
+        return record
+
+    def save(self, collection, record, **changes):
+        """
+        Apply field changes to a record and persist it, moving it between
+        index buckets whose keys changed
+
+        Returns:
+            The updated record
+        """
+        with self._lock(collection).write():
+            return self._save(collection, record, changes)
+
+    def update(self, collection, record, update):
+        """
+        Read-modify-write a record atomically: update(record) is called under
+        the collection's write lock and returns the field changes to save
+
+        Returns:
+            The updated record
+        """
+        with self._lock(collection).write():
+            return self._save(collection, record, update(record))
+
+    def clear(self):
+        """Remove every record from every collection"""
+        with self._write_all():
+            for collection in self.db:
+                self.db[collection] = self._empty(collection)
+            self.rebuild_indexes()
+            with self.sequence_lock:
+                self.sequences = {}
+            self._notify('clear', None, None)
+
+
+class SQLiteCollections(Mapping):
+    """Read-only ``db``-style view of a SQLite store: db['patients'] lists all patients"""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getitem__(self, collection):
+        if collection not in self.storage.tables:
+            raise KeyError(collection)
+        return self.storage.all(collection)
+
+    def __iter__(self):
+        return iter(self.storage.tables)
+
+    def __len__(self):
+        return len(self.storage.tables)
+
+
+class SQLiteStorage:
+    """
+    SQLite storage: one table per collection with the pickled record in a
+    ``data`` column and every indexed field copied into its own column, so
+    lookups by id, foreign key or unique field use SQLite indexes.
+
+    Each thread reuses one connection. The database runs in WAL mode so
+    several worker processes can read while one of them writes.
+    """
+    def __init__(self, path, collections, indexes=None, unique=None, unique_where=None):
+        """
+        Args:
+            path (str): Path to the SQLite database file
+            collections (iterable): Names of the collections to create
+            indexes (dict, optional): collection -> list of field tuples to index
+            unique (dict, optional): collection -> {field: normalizer} for unique fields
+            unique_where (dict, optional): collection -> list of (fields, condition)
+                pairs: the fields must be unique together among the rows matching
+                the SQL condition, e.g. (('provider_id', 'date', 'time'), "status != 'cancelled'")
+        """
+        self.path = path
+        self.indexes = indexes or {}
+        self.unique = unique or {}
+        self.unique_where = unique_where or {}
+        self.unfilled = set()  # tables lacking index columns until migrate()
+        self.scanned = set()  # (collection, *fields) of find() calls already warned about
+        self.local = threading.local()
+
+        # Columns to copy out of each record: every indexed and unique field
+        self.tables = {}
+        for collection in collections:
+            columns = []
+            field_groups = (list(self.indexes.get(collection, []))
+                            + [(field,) for field in self.unique.get(collection, {})]
+                            + [fields for fields, _ in self.unique_where.get(collection, [])])
+            for fields in field_groups:
+                for field in fields:
+                    if field not in columns:
+                        columns.append(field)
+            self.tables[collection] = columns
+
+        self._create_schema()
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the writes of a with block in one write transaction. It begins
+        with BEGIN IMMEDIATE, so other processes wait until it commits, and
+        is rolled back if the block raises. Transactions nest; writes made
+        in the block join the outermost one.
+        """
+        conn = self.connection()
+        depth = getattr(self.local, 'depth', 0)
+        if depth:
+            self.local.depth = depth + 1
+            try:
+                yield conn
+            finally:
+                self.local.depth = depth
+            return
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self.local.depth = 1
+            try:
+                yield conn
+            finally:
+                self.local.depth = 0
+
+    def _create_schema(self):
+        """
+        Create tables and indexes that do not exist yet. Tables created by an
+        earlier version that lack index columns are left for migrate().
+        """
+        conn = self.connection()
+        with conn:
+            for collection, columns in self.tables.items():
+                column_defs = ''.join(f', {column}' for column in columns)
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {collection} '
+                             f'(id INTEGER PRIMARY KEY{column_defs}, data BLOB NOT NULL)')
+                if self._missing_columns(conn, collection):
+                    self.unfilled.add(collection)
+                else:
+                    self._create_indexes(conn, collection)
+            # Last ID handed out per collection, shared by every worker process
+            conn.execute('CREATE TABLE IF NOT EXISTS id_sequences '
+                         '(collection TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _missing_columns(self, conn, collection):
+        """Index columns a table created by an earlier version lacks"""
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({collection})')}
+        return [column for column in self.tables[collection] if column not in existing]
+
+    def _create_indexes(self, conn, collection):
+        """Create a collection's indexes that do not exist yet"""
+        for fields in self.indexes.get(collection, []):
+            name = f"idx_{collection}_{'_'.join(fields)}"
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {collection} ({', '.join(fields)})")
+        for field in self.unique.get(collection, {}):
+            conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS uniq_{collection}_{field} '
+                         f'ON {collection} ({field})')
+        for fields, condition in self.unique_where.get(collection, []):
+            name = f"uniq_{collection}_{'_'.join(fields)}"
+            try:
+                conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} "
+                             f"ON {collection} ({', '.join(fields)}) WHERE {condition}")
+            except sqlite3.IntegrityError:
+                logger.error(f"Rows of {collection} already share {', '.join(fields)}; "
+                             f"they are not enforced unique until the duplicates are resolved")
+
+    def migrate(self):
+        """
+        Add the missing index columns to tables created by an earlier version,
+        fill them from each row's record and create their indexes, in one
+        transaction per table. Records are unpickled, so call this once the
+        model classes are defined.
+        """
+        for collection in sorted(self.unfilled):
+            with self.transaction() as conn:
+                # Another worker starting at the same time may have migrated it already
+                missing = self._missing_columns(conn, collection)
+                for column in missing:
+                    conn.execute(f'ALTER TABLE {collection} ADD COLUMN {column}')
+                if missing:
+                    assignments = ', '.join(f'{column} = ?' for column in missing)
+                    rows = conn.execute(f'SELECT id, data FROM {collection}').fetchall()
+                    for record_id, data in rows:
+                        record = pickle.loads(data)
+                        conn.execute(f'UPDATE {collection} SET {assignments} WHERE id = ?',
+                                     [self._column_value(collection, column, record) for column in missing]
+                                     + [record_id])
+                    logger.info(f"Added columns {', '.join(missing)} to {len(rows)} {collection}")
+                self._create_indexes(conn, collection)
+            self.unfilled.discard(collection)
+
+    def collections(self):
+        """Return a read-only mapping of collection name to record list"""
+        return SQLiteCollections(self)
+
+    def _column_value(self, collection, field, record):
+        """Value stored in an index column, normalized for unique fields"""
+        value = getattr(record, field, None)
+        normalize = self.unique.get(collection, {}).get(field)
+        return normalize(value) if normalize else value
+
+    def _row_values(self, collection, record):
+        """Column values for a record, in table column order after id"""
+        values = [self._column_value(collection, f, record) for f in self.tables[collection]]
+        return values + [pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)]
+
+    def _where(self, collection, criteria):
+        """Build a WHERE clause for criteria on indexed columns"""
+        clauses, params = [], []
+        for field, value in criteria.items():
+            if value is None:
+                clauses.append(f'{field} IS NULL')
+            else:
+                clauses.append(f'{field} = ?')
+                normalize = self.unique.get(collection, {}).get(field)
+                params.append(normalize(value) if normalize else value)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def next_id(self, collection):
+        """
+        Reserve the ID for the next record in a collection
+
+        The sequence row is bumped inside a write transaction, so threads and
+        worker processes never receive the same ID. The sequence also never
+        falls behind IDs that were inserted explicitly.
+        """
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO id_sequences (collection, value) VALUES (?, 0)',
+                         (collection,))
+            conn.execute(f'UPDATE id_sequences SET value = '
+                         f'MAX(value, (SELECT COALESCE(MAX(id), 0) FROM {collection})) + 1 '
+                         f'WHERE collection = ?', (collection,))
+            row = conn.execute('SELECT value FROM id_sequences WHERE collection = ?',
+                               (collection,)).fetchone()
+        return row[0]
+
+    def next_ids(self, collection, count):
+        """Reserve IDs for a batch of records; returns a range of count consecutive IDs"""
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO id_sequences (collection, value) VALUES (?, 0)',
+                         (collection,))
+            conn.execute(f'UPDATE id_sequences SET value = '
+                         f'MAX(value, (SELECT COALESCE(MAX(id), 0) FROM {collection})) + ? '
+                         f'WHERE collection = ?', (count, collection))
+            last = conn.execute('SELECT value FROM id_sequences WHERE collection = ?',
+                                (collection,)).fetchone()[0]
+        return range(last - count + 1, last + 1)
+
+    def insert(self, collection, record):
+        """
+        Add a record to a collection
+
+        Raises:
+            ValueError: If the record duplicates a unique field or its ID
+        """
+        columns = ['id'] + self.tables[collection] + ['data']
+        placeholders = ', '.join('?' for _ in columns)
+        try:
+            with self.transaction() as conn:
+                conn.execute(f"INSERT INTO {collection} ({', '.join(columns)}) VALUES ({placeholders})",
+                             [record.id] + self._row_values(collection, record))
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Duplicate record in {collection}: {e}")
+        return record
+
+    def insert_many(self, collection, records):
+        """
+        Add a batch of records in one transaction with a single executemany
+
+        Raises:
+            ValueError: If a record duplicates a unique field or ID; nothing is inserted
+        """
+        records = list(records)
+        columns = ['id'] + self.tables[collection] + ['data']
+        placeholders = ', '.join('?' for _ in columns)
+        try:
+            with self.transaction() as conn:
+                conn.executemany(f"INSERT INTO {collection} ({', '.join(columns)}) VALUES ({placeholders})",
+                                 ([record.id] + self._row_values(collection, record) for record in records))
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Duplicate record in {collection}: {e}")
+        return records
+
+    def get(self, collection, record_id):
+        """Look up a record by primary key, or None if not found"""
+        row = self.connection().execute(f'SELECT data FROM {collection} WHERE id = ?',
+                                        (record_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def get_unique(self, collection, field, value):
+        """Look up a record by a unique field, or None if not found"""
+        records = self.find(collection, **{field: value})
+        return records[0] if records else None
+
+    def _warn_scan(self, collection, criteria):
+        """Log the first find() of a collection by fields without a column, which unpickles every row"""
+        fields = (collection,) + tuple(sorted(criteria))
+        if fields not in self.scanned:
+            self.scanned.add(fields)
+            logger.warning(f"Scanning every row of {collection} to find by {', '.join(sorted(criteria))}; "
+                           f"index one of these fields to avoid it")
+
+    def find(self, collection, **criteria):
+        """
+        Find records whose fields match all the given values. Criteria on
+        indexed columns are evaluated by SQLite; the rest are filtered here.
+
+        Returns:
+            list: Matching records in insertion order
+        """
+        indexed = {f: v for f, v in criteria.items() if f in self.tables[collection]}
+        remaining = [(f, v) for f, v in criteria.items() if f not in indexed]
+        if remaining and not indexed:
+            self._warn_scan(collection, criteria)
+        where, params = self._where(collection, indexed)
+        rows = self.connection().execute(f'SELECT data FROM {collection}{where} ORDER BY id', params)
+        records = [pickle.loads(row[0]) for row in rows]
+        if not remaining:
+            return records
+        return [r for r in records if all(getattr(r, f, None) == v for f, v in remaining)]
+
+    def page(self, collection, limit, before=None, after=None, **criteria):
+        """
+        One page of the records matching the given values, for keyset
+        pagination; SQLite walks the index on the criteria in ID order
+
+        Args:
+            limit (int): Records to return at most
+            before (int, optional): Return the last records with a lower ID
+            after (int, optional): Return the first records with a higher ID;
+                the records with the highest IDs are returned if neither is given
+
+        Returns:
+            list: Matching records in ID order
+        """
+        if not all(f in self.tables[collection] for f in criteria):
+            records = self.find(collection, **criteria)
+            if after is not None:
+                return [r for r in records if r.id > after][:limit]
+            if before is not None:
+                records = [r for r in records if r.id < before]
+            return records[-limit:] if limit else []
+        where, params = self._where(collection, criteria)
+        if after is not None:
+            where += f"{' AND' if where else ' WHERE'} id > ?"
+            params.append(after)
+        elif before is not None:
+            where += f"{' AND' if where else ' WHERE'} id < ?"
+            params.append(before)
+        order = 'ASC' if after is not None else 'DESC'
+        rows = self.connection().execute(
+            f'SELECT data FROM {collection}{where} ORDER BY id {order} LIMIT ?', params + [limit]).fetchall()
+        records = [pickle.loads(row[0]) for row in rows]
+        return records if after is not None else records[::-1]
+
+    def all(self, collection):
+        """Return every record in a collection in insertion order"""
+        return self.find(collection)
+
+    def scan(self, collection, batch_size=1000):
+        """
+        Iterate over a collection in ID order, fetching batch_size rows per query
+
+        Yields:
+            Records of the collection
+        """
+        last_id = 0
+        while True:
+            rows = self.connection().execute(
+                f'SELECT id, data FROM {collection} WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            for _, data in rows:
+                yield pickle.loads(data)
+
+    def count(self, collection, **criteria):
+        """Count the records in a collection matching the given values"""
+        if all(f in self.tables[collection] for f in criteria):
+            where, params = self._where(collection, criteria)
+            return self.connection().execute(f'SELECT COUNT(*) FROM {collection}{where}', params).fetchone()[0]
+        return len(self.find(collection, **criteria))
+
+    def count_by(self, collection, field, **criteria):
+        """
+        Count the records matching the given values per value of a field,
+        grouped by SQLite when the field and criteria are indexed columns
+
+        Returns:
+            dict: field value -> number of records
+        """
+        columns = self.tables[collection]
+        if field in columns and all(f in columns for f in criteria):
+            where, params = self._where(collection, criteria)
+            rows = self.connection().execute(
+                f'SELECT {field}, COUNT(*) FROM {collection}{where} GROUP BY {field}', params)
+            return dict(rows.fetchall())
+        return dict(Counter(getattr(r, field, None) for r in self.find(collection, **criteria)))
+
+    def save(self, collection, record, **changes):
+        """
+        Apply field changes to a record and write it back
+
+        Returns:
+            The updated record
+
+        Raises:
+            ValueError: If the changes break a unique constraint; the record is left unchanged
+        """
+        previous = {field: getattr(record, field, None) for field in changes}
+        for field, value in changes.items():
+            setattr(record, field, value)
+        assignments = ', '.join(f'{column} = ?' for column in self.tables[collection] + ['data'])
+        try:
+            with self.transaction() as conn:
+                conn.execute(f'UPDATE {collection} SET {assignments} WHERE id = ?',
+                             self._row_values(collection, record) + [record.id])
+        except sqlite3.IntegrityError as e:
+            for field, value in previous.items():
+                setattr(record, field, value)
+            raise ValueError(f"Duplicate record in {collection}: {e}")
+        return record
+
+    def update(self, collection, record, update):
+        """
+        Read-modify-write a record atomically: the row is reread inside a
+        write transaction, so concurrent updates from other threads or
+        processes are not lost. update(record) returns the field changes.
+
+        Returns:
+            The updated record
+        """
+        with self.transaction() as conn:
+            row = conn.execute(f'SELECT data FROM {collection} WHERE id = ?', (record.id,)).fetchone()
+            current = pickle.loads(row[0]) if row else record
+            changes = update(current)
+            for field, value in changes.items():
+                setattr(current, field, value)
+                setattr(record, field, value)
+            assignments = ', '.join(f'{column} = ?' for column in self.tables[collection] + ['data'])
+            conn.execute(f'UPDATE {collection} SET {assignments} WHERE id = ?',
+                         self._row_values(collection, current) + [record.id])
+        return record
+
+    def clear(self):
+        """Remove every record from every collection"""
+        with self.transaction() as conn:
+            for collection in self.tables:
+                conn.execute(f'DELETE FROM {collection}')
+            conn.execute('DELETE FROM id_sequences')
+
+
+def create_storage(url, collections, indexes=None, unique=None, columnar=None, unique_where=None):
+    """
+    Create a storage backend from a URL
+
+    Args:
+        url (str): 'memory' or 'sqlite:///path/to/file.db'
+        collections (iterable): Names of the collections to create
+        indexes (dict, optional): collection -> list of field tuples to index
+        unique (dict, optional): collection -> {field: normalizer} for unique fields
+        columnar (dict, optional): collection -> EventTable factory; only used by
+            the memory backend, SQLite keeps every collection in a table
+        unique_where (dict, optional): collection -> list of (fields, SQL condition)
+            pairs unique together among matching rows; only enforced by SQLite,
+            where several processes write, the memory backend is written by one
+
+    Returns:
+        MemoryStorage or SQLiteStorage
+    """
+    if not url or url == 'memory':
+        return MemoryStorage(collections, indexes, unique, columnar)
+    if url.startswith('sqlite:///'):
+        path = url[len('sqlite:///'):]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        logger.info(f"Using SQLite storage at {path}")
+        return SQLiteStorage(path, collections, indexes, unique, unique_where)
+    raise ValueError(f"Unsupported storage URL: {url}")
@@ -0,0 +1,183 @@
+"""
+Background tasks for Tujali Telehealth
+
+Work that a request does not need for its reply (notifying providers,
+recording interactions, AI triage) is handed to a TaskQueue and run by a few
+worker threads, so slow or failing downstream work never holds up a USSD
+gateway that times out after a few seconds. Failed tasks are retried with
+exponential backoff and logged once their attempts run out. A task may run
+more than once after a write that failed halfway, so tasks should be
+idempotent: the USSD handlers reserve record IDs before submitting, and the
+models' create() methods return the stored record when its ID already exists.
+
+The number of workers is set with TUJALI_TASK_WORKERS (default 2); 0 runs
+every task inline, in the submitting request, which is useful when debugging.
+A task run inline gets a single attempt.
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """A call to run in the background and the attempts made at it"""
+    __slots__ = ('func', 'args', 'kwargs', 'attempts')
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+
+    @property
+    def name(self):
+        return getattr(self.func, '__name__', repr(self.func))
+
+
+class TaskQueue:
+    """
+    Bounded queue of tasks run by worker threads
+
+    When the queue is full, submit() makes one attempt at the task in the
+    caller, so the backlog stays bounded and the caller never waits on
+    retries; a task that fails there is logged and counted as failed.
+    """
+    def __init__(self, workers=2, max_attempts=4, retry_delay=0.5, max_pending=10000):
+        """
+        Args:
+            workers (int): Worker threads; 0 runs tasks inline
+            max_attempts (int): Attempts before a task is given up
+            retry_delay (float): Seconds before the first retry, doubled for each further one
+            max_pending (int): Tasks queued before submit() runs tasks inline
+        """
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0  # submitted and not yet finished, including tasks waiting to retry
+        self.submitted = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.inline = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self._run, name=f'task-worker-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+        if workers:
+            atexit.register(self.close)
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the background"""
+        task = Task(func, args, kwargs)
+        with self.lock:
+            self.submitted += 1
+            self.pending += 1
+        if self.workers and not self.closed:
+            try:
+                self.queue.put_nowait(task)
+                return
+            except queue.Full:
+                logger.warning(f"Task queue full, running {task.name} inline")
+        with self.lock:
+            self.inline += 1
+        self._execute(task, last=True)
+
+    def _execute(self, task, last=False):
+        """
+        Make one attempt at a task
+
+        Args:
+            last (bool): Give the task up if this attempt fails
+
+        Returns:
+            bool: True once the task is finished, successfully or not
+        """
+        task.attempts += 1
+        try:
+            task.func(*task.args, **task.kwargs)
+        except Exception as e:
+            if not last and task.attempts < self.max_attempts:
+                logger.warning(f"Task {task.name} failed (attempt {task.attempts}), retrying: {e}")
+                with self.lock:
+                    self.retried += 1
+                return False
+            logger.error(f"Task {task.name} failed after {task.attempts} attempts: {e}")
+            self._finish(failed=True)
+            return True
+        self._finish(failed=False)
+        return True
+
+    def _finish(self, failed):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def _retry_later(self, task):
+        """Queue a failed task again after its backoff delay"""
+        delay = self.retry_delay * 2 ** (task.attempts - 1)
+        timer = threading.Timer(delay, self.queue.put, (task,))
+        timer.daemon = True
+        timer.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if not self._execute(task):
+                self._retry_later(task)
+
+    def join(self, timeout=None):
+        """
+        Wait until every submitted task has finished
+
+        Returns:
+            bool: False if tasks were still pending when the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        """Finish queued tasks, waiting up to timeout seconds, then stop the workers"""
+        if self.closed:
+            return
+        self.join(timeout)
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Worker count and task counters
+        """
+        with self.lock:
+            return {'workers': self.workers, 'pending': self.pending, 'submitted': self.submitted,
+                    'completed': self.completed, 'retried': self.retried, 'failed': self.failed,
+                    'inline': self.inline}
+
+
+# Shared queue for request side effects
+background = TaskQueue(int(os.environ.get('TUJALI_TASK_WORKERS', 2)))
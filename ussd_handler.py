@@ -1,1146 +1,658 @@
+import os
+import zlib
 import logging
-from models import Patient, Provider, Appointment, Message, HealthInfo
+import threading
+from functools import partial, lru_cache
+from models import (Patient, Provider, Appointment, Message, HealthInfo, Prescription, LabTest,
+                    LabResult, Bill, UserInteraction, slots)
 from datetime import datetime, timedelta
-import utils
+from session_store import create_session_store, DEFAULT_TTL
+from catalog import catalog, LANGUAGES
+from ussd_pages import paginate, MORE_OPTION
+from tasks import background
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Session storage for USSD
-# This is used to keep track of user state between USSD requests
-# In production, this should be stored in a database or cache
-sessions = {}
+# Session storage for USSD (see session_store.py): keeps user state between
+# the requests of a session and expires sessions that were abandoned
+sessions = create_session_store(os.environ.get('TUJALI_SESSION_STORE', 'memory'),
+                                float(os.environ.get('TUJALI_SESSION_TTL', DEFAULT_TTL)))
 
-def ussd_callback(session_id, service_code, phone_number, text):
+# The last reply sent in each session, with the text it answered. Gateways
+# retry a hop whose reply was slow; the retry is answered from here instead of
+# being handled again, which would repeat its side effects (a second
+# appointment, a second message). Kept apart from the sessions, which are
+# dropped as soon as they end, so the final hop can be replayed too.
+REPLAY_TTL = 30
+replays = create_session_store(os.environ.get('TUJALI_SESSION_STORE', 'memory'),
+                               float(os.environ.get('TUJALI_REPLAY_TTL', REPLAY_TTL)),
+                               table='ussd_replays')
+
+# Requests of one session are serialized by one of a fixed set of locks, picked
+# by hashing the session ID, so the locks never grow with the number of sessions
+SESSION_LOCK_STRIPES = 256
+session_locks = [threading.Lock() for _ in range(SESSION_LOCK_STRIPES)]
+
+def session_lock(session_id):
+    """Return the lock to hold while handling a request of a session"""
+    return session_locks[zlib.crc32(str(session_id).encode()) % SESSION_LOCK_STRIPES]
+
+# Languages offered at the start of a session, by menu option
+LANGUAGE_OPTIONS = {str(option): language for option, language in enumerate(LANGUAGES, 1)}
+
+GENDER_OPTIONS = {'1': 'Male', '2': 'Female', '3': 'Other'}
+DURATION_OPTIONS = {'1': 'Today only', '2': 'Few days', '3': 'A week or more', '4': 'A month or more'}
+SEVERITY_OPTIONS = {'1': 'Mild', '2': 'Moderate', '3': 'Severe'}
+HEALTH_TOPICS = {'1': 'covid', '2': 'maternal', '3': 'chronic', '4': 'firstaid'}
+
+# Days ahead offered for appointments
+BOOKING_DAYS = 7
+
+# Records listed per screen of the records menu, newest last
+MAX_RECORDS = 5
+
+
+def get_session(session_id, phone_number):
     """
-    Process USSD request and return appropriate response
+    Get the state of a USSD session from the session store, or start a new one
     
     Args:
         session_id (str): Unique session identifier
-        service_code (str): USSD service code
         phone_number (str): User's phone number
-        text (str): Current USSD text/input
     
     Returns:
-        str: USSD response with appropriate prefix
+        dict: Session state; store it back with sessions.put once handled
     """
-    # Initialize session if needed
-    if session_id not in sessions:
-        sessions[session_id] = {
+    session = sessions.get(session_id)
+    if session is None:
+        session = {
+            'session_id': session_id,
             'phone_number': phone_number,
             'state': 'start',
             'language': 'en',  # Default language
             'data': {}
         }
+    return session
+
+def ussd_callback(session_id, service_code, phone_number, text):
+    """
+    Process USSD request and return appropriate response
+    
+    Args:
+        session_id (str): Unique session identifier
+        service_code (str): USSD service code
+        phone_number (str): User's phone number
+        text (str): Current USSD text/input
+    
+    Returns:
+        str: USSD response with appropriate prefix
+    """
+    # Requests of different sessions run in parallel; a retried request of
+    # the same session waits for the one still being handled
+    with session_lock(session_id):
+        replay = replays.get(session_id)
+        if replay is not None and replay[0] == text:
+            logger.info(f"Replaying USSD response to a repeated request in session {session_id}")
+            return replay[1]
+        session = get_session(session_id, phone_number)
+        response = first_page(session, handle_request(session, text))
+        # Ended sessions are dropped at once instead of waiting for their TTL
+        if response.startswith('END'):
+            sessions.delete(session_id)
+        else:
+            session['screen'] = response
+            sessions.put(session_id, session)
+        replays.put(session_id, (text, response))
+        return response
+
+def handle_request(session, text):
+    """
+    Advance a USSD session by one request
+    
+    Args:
+        session (dict): Session state from get_session
+        text (str): Current USSD text/input
+    
+    Returns:
+        str: USSD response with appropriate prefix
+    """
+    # A gateway retry of the handled text or of an earlier hop, e.g. one that
+    # outlived the replay cache, only shows the current screen again: its
+    # input was already applied
+    handled = session.get('handled', '')
+    if text and 'screen' in session and (text == handled or handled.startswith(text + '*')):
+        return session['screen']
     
-    session = sessions[session_id]
+    # Pages left of the previous screen are only offered on the next request
+    pages = session.pop('pages', None)
     
     # Check if we need to start over
     if text == '':
         session['state'] = 'start'
         session['data'] = {}
     
-    # Handle language selection first if not already set
     if session['state'] == 'start':
-        response = "Welcome to Tujali Telehealth\n"
-        response += "Karibu kwenye Tujali Telehealth\n"
-        response += "Bienvenue sur Tujali Telehealth\n"
-        response += "Soo dhawow Tujali Telehealth\n"
-        response += "1. English\n"
-        response += "2. Kiswahili\n"
-        response += "3. Français (French)\n"
-        response += "4. Afaan Oromoo (Oromo)\n"
-        response += "5. Soomaali (Somali)\n"
-        response += "6. Amharic (አማርኛ)"
-        session['state'] = 'select_language'
-        return respond(response)
+        session['handled'] = text
+        return enter(session, 'select_language')
     
-    elif session['state'] == 'select_language':
-        if text == '1' or text.endswith('*1'):
-            session['language'] = 'en'
-            return show_main_menu(session)
-        elif text == '2' or text.endswith('*2'):
-            session['language'] = 'sw'
-            return show_main_menu(session)
-        elif text == '3' or text.endswith('*3'):
-            session['language'] = 'fr'
-            return show_main_menu(session)
-        elif text == '4' or text.endswith('*4'):
-            session['language'] = 'om'
-            return show_main_menu(session)
-        elif text == '5' or text.endswith('*5'):
-            session['language'] = 'so'
-            return show_main_menu(session)
-        elif text == '6' or text.endswith('*6'):
-            session['language'] = 'am'
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
+    selection = new_input(session, text)
+    if pages and selection == MORE_OPTION:
+        return next_page(session, pages)
     
-    # Process based on current state
-    if text.endswith('*0'):  # Return to main menu from anywhere
+    # Return to main menu from states that give 0 no meaning of their own
+    state = STATES.get(session['state'])
+    if selection == '0' and not (state and state.handles_zero):
         return show_main_menu(session)
     
-    # Get the last input from the user
-    parts = text.split('*')
-    last_input = parts[-1] if parts else ''
-    
-    # Route to appropriate handler based on state
     try:
-        if session['state'] == 'main_menu':
-            return handle_main_menu(session, last_input)
-        elif session['state'].startswith('register'):
-            return handle_registration(session, last_input)
-        elif session['state'].startswith('symptom'):
-            return handle_symptoms(session, last_input)
-        elif session['state'].startswith('appointment'):
-            return handle_appointments(session, last_input)
-        elif session['state'].startswith('message'):
-            return handle_messages(session, last_input)
-        elif session['state'].startswith('profile') or session['state'].startswith('update_coordinates') or session['state'].startswith('coordinates_updated'):
-            return handle_messages(session, last_input)
-        elif session['state'].startswith('info'):
-            return handle_health_info(session, last_input)
-        else:
-            # Unknown state, return to main menu
-            return show_main_menu(session)
+        return dispatch(session, selection)
     except Exception as e:
         logger.error(f"Error processing USSD request: {e}")
-        
-        # Provide error messages in all supported languages
-        if session['language'] == 'en':
-            error_msg = "Sorry, an error occurred. Please try again."
-        elif session['language'] == 'sw':
-            error_msg = "Samahani, kuna hitilafu imetokea. Tafadhali jaribu tena."
-        elif session['language'] == 'fr':
-            error_msg = "Désolé, une erreur s'est produite. Veuillez réessayer."
-        elif session['language'] == 'om':
-            error_msg = "Dhiifama, dogoggora uumame. Maaloo irra deebi'ii yaali."
-        elif session['language'] == 'so':
-            error_msg = "Waan xumaatay, khalad ayaa dhacay. Fadlan isku day mar kale."
-        elif session['language'] == 'am':
-            error_msg = "ይቅርታ፣ ስህተት ተከስቷል። እባክዎ እንደገና ይሞክሩ።"
-        else:
-            error_msg = "Sorry, an error occurred. Please try again."
-            
-        return respond(error_msg)
+        return respond(prompt(session, 'error'))
 
-def show_main_menu(session):
-    """Display the main menu based on user's language and registration status"""
-    patient = Patient.get_by_phone(session['phone_number'])
+def new_input(session, text):
+    """
+    Return the input this request adds to the session
     
-    if patient:
-        # User is registered, show main menu
-        if session['language'] == 'en':
-            response = f"Welcome back, {patient.name}\n"
-            response += "1. Report symptoms\n"
-            response += "2. Schedule appointment\n"
-            response += "3. Messages\n"
-            response += "4. Health information\n"
-            response += "5. My profile\n"
-            response += "0. Back to language selection"
-        elif session['language'] == 'sw':
-            response = f"Karibu tena, {patient.name}\n"
-            response += "1. Ripoti dalili\n"
-            response += "2. Panga miadi\n"
-            response += "3. Ujumbe\n"
-            response += "4. Habari za afya\n"
-            response += "5. Wasifu wangu\n"
-            response += "0. Rudi kwa uchaguzi wa lugha"
-        elif session['language'] == 'fr':
-            response = f"Bon retour, {patient.name}\n"
-            response += "1. Signaler des symptômes\n"
-            response += "2. Planifier un rendez-vous\n"
-            response += "3. Messages\n"
-            response += "4. Informations de santé\n"
-            response += "5. Mon profil\n"
-            response += "0. Retour à la sélection de langue"
-        elif session['language'] == 'om':
-            response = f"Baga nagaan dhufte, {patient.name}\n"
-            response += "1. Mallattoo gabaasi\n"
-            response += "2. Qabsoo walhitti dhufeenyaa karoorsii\n"
-            response += "3. Ergaawwan\n"
-            response += "4. Odeeffannoo fayyaa\n"
-            response += "5. Profaayilii koo\n"
-            response += "0. Gara filannoo afaaniitti deebi'i"
-        elif session['language'] == 'so':
-            response = f"Ku soo dhawow, {patient.name}\n"
-            response += "1. Warbixin calaamadaha\n"
-            response += "2. Jadwalka ballanta\n"
-            response += "3. Fariimaha\n"
-            response += "4. Macluumaadka caafimaadka\n"
-            response += "5. Astaantayda\n"
-            response += "0. Ku noqo xulashada luuqadda"
-        elif session['language'] == 'am':
-            response = f"እንደገና እንኳን ደህና መጡ, {patient.name}\n"
-            response += "1. የህመም ምልክቶችን ሪፖርት ያድርጉ\n"
-            response += "2. ቀጠሮ ያስይዙ\n"
-            response += "3. መልዕክቶች\n"
-            response += "4. የጤና መረጃ\n"
-            response += "5. የግል መገለጫዬ\n"
-            response += "0. ወደ ቋንቋ ምርጫ ይመለሱ"
-        else:
-            # Default to English if language code not recognized
-            response = f"Welcome back, {patient.name}\n"
-            response += "1. Report symptoms\n"
-            response += "2. Schedule appointment\n"
-            response += "3. Messages\n"
-            response += "4. Health information\n"
-            response += "5. My profile\n"
-            response += "0. Back to language selection"
-    else:
-        # User is not registered, prompt for registration
-        if session['language'] == 'en':
-            response = "Welcome to Tujali Telehealth\n"
-            response += "1. Register\n"
-            response += "2. Health information\n"
-            response += "0. Back to language selection"
-        elif session['language'] == 'sw':
-            response = "Karibu kwenye Tujali Telehealth\n"
-            response += "1. Jisajili\n"
-            response += "2. Habari za afya\n"
-            response += "0. Rudi kwa uchaguzi wa lugha"
-        elif session['language'] == 'fr':
-            response = "Bienvenue sur Tujali Telehealth\n"
-            response += "1. S'inscrire\n"
-            response += "2. Informations de santé\n"
-            response += "0. Retour à la sélection de langue"
-        elif session['language'] == 'om':
-            response = "Tujali Telehealth dhuferra baga nagaan dhufte\n"
-            response += "1. Galmaa'i\n"
-            response += "2. Odeeffannoo fayyaa\n"
-            response += "0. Gara filannoo afaaniitti deebi'i"
-        elif session['language'] == 'so':
-            response = "Ku soo dhawow Tujali Telehealth\n"
-            response += "1. Isdiiwaangeli\n"
-            response += "2. Macluumaadka caafimaadka\n"
-            response += "0. Ku noqo xulashada luuqadda"
-        elif session['language'] == 'am':
-            response = "ወደ ቱጃሊ ቴሌሄልዝ እንኳን ደህና መጡ\n"
-            response += "1. ይመዝገቡ\n"
-            response += "2. የጤና መረጃ\n"
-            response += "0. ወደ ቋንቋ ምርጫ ይመለሱ"
-        else:
-            # Default to English if language code not recognized
-            response = "Welcome to Tujali Telehealth\n"
-            response += "1. Register\n"
-            response += "2. Health information\n"
-            response += "0. Back to language selection"
+    The gateway resends every input of the session joined by '*'. The session
+    keeps the text it has already handled, so only the new suffix is read:
+    the cost of a step does not grow with the session, and free-text inputs
+    may contain '*' themselves. Repeats of handled text never get here (see
+    handle_request).
     
-    session['state'] = 'main_menu'
-    return respond(response)
+    Args:
+        session (dict): Session state
+        text (str): Current USSD text/input
+    """
+    consumed = len(session.get('handled', ''))
+    session['handled'] = text
+    if consumed == 0:
+        return text
+    if len(text) > consumed and text[consumed] == '*':
+        return text[consumed + 1:]
+    # Not a continuation of the handled text, e.g. a client that only sends
+    # the latest input
+    return text.rsplit('*', 1)[-1]
 
-def handle_main_menu(session, selection):
-    """Process main menu selection"""
-    patient = Patient.get_by_phone(session['phone_number'])
-    
-    if patient:
-        # Registered user menu options
-        if selection == '1':
-            return start_symptoms_report(session)
-        elif selection == '2':
-            return start_appointment_scheduling(session)
-        elif selection == '3':
-            return show_messages(session)
-        elif selection == '4':
-            return show_health_info_menu(session)
-        elif selection == '5':
-            return show_profile(session, patient)
-        elif selection == '0':
-            session['state'] = 'start'
-            return ussd_callback(session['session_id'], '', session['phone_number'], '')
-        else:
-            return respond(get_invalid_option_text(session))
-    else:
-        # Unregistered user menu options
-        if selection == '1':
-            return start_registration(session)
-        elif selection == '2':
-            return show_health_info_menu(session)
-        elif selection == '0':
-            session['state'] = 'start'
-            return ussd_callback(session['session_id'], '', session['phone_number'], '')
-        else:
-            return respond(get_invalid_option_text(session))
-
-def start_registration(session):
-    """Begin patient registration process"""
-    if session['language'] == 'en':
-        response = "Please enter your full name:"
-    elif session['language'] == 'sw':
-        response = "Tafadhali ingiza jina lako kamili:"
-    elif session['language'] == 'fr':
-        response = "Veuillez entrer votre nom complet:"
-    elif session['language'] == 'om':
-        response = "Maaloo maqaa guutuu keessan galchaa:"
-    elif session['language'] == 'so':
-        response = "Fadlan geli magacaaga oo buuxa:"
-    elif session['language'] == 'am':
-        response = "እባክዎ ሙሉ ስምዎን ያስገቡ:"
-    else:
-        response = "Please enter your full name:"
-    
-    session['state'] = 'register_name'
-    return respond(response)
+def first_page(session, response):
+    """
+    Return the first page of a response too long for one USSD page, keeping
+    the other pages in the session for the "More" option
+    """
+    prefix, body = response[:4], response[4:]
+    pages = paginate(body, prompt(session, 'more'))
+    if len(pages) == 1:
+        return response
+    # Only the last page may end the session
+    session['pages'] = [f"CON {page}" for page in pages[1:-1]] + [prefix + pages[-1]]
+    return f"CON {pages[0]}"
 
-def handle_registration(session, input_text):
-    """Process registration steps"""
-    state = session['state']
-    
-    if state == 'register_name':
-        session['data']['name'] = input_text
-        if session['language'] == 'en':
-            response = "Enter your age:"
-        else:
-            response = "Ingiza umri wako:"
-        session['state'] = 'register_age'
-        return respond(response)
-    
-    elif state == 'register_age':
-        try:
-            age = int(input_text)
-            session['data']['age'] = age
-            if session['language'] == 'en':
-                response = "Select your gender:\n"
-                response += "1. Male\n"
-                response += "2. Female\n"
-                response += "3. Other"
-            else:
-                response = "Chagua jinsia yako:\n"
-                response += "1. Mume\n"
-                response += "2. Mke\n"
-                response += "3. Nyingine"
-            session['state'] = 'register_gender'
-            return respond(response)
-        except ValueError:
-            if session['language'] == 'en':
-                return respond("Please enter a valid age (numbers only).")
-            else:
-                return respond("Tafadhali ingiza umri halali (namba tu).")
-    
-    elif state == 'register_gender':
-        if input_text == '1':
-            session['data']['gender'] = 'Male'
-        elif input_text == '2':
-            session['data']['gender'] = 'Female'
-        elif input_text == '3':
-            session['data']['gender'] = 'Other'
-        else:
-            return respond(get_invalid_option_text(session))
-        
-        if session['language'] == 'en':
-            response = "Enter your location (county/city):"
-        else:
-            response = "Ingiza eneo lako (kaunti/mji):"
-        session['state'] = 'register_location'
-        return respond(response)
-    
-    elif state == 'register_location':
-        session['data']['location'] = input_text
-        
-        # Ask if the user wants to provide coordinates for location-based provider matching
-        if session['language'] == 'en':
-            response = "Would you like to provide your location coordinates for better provider matching?\n"
-            response += "1. Yes\n"
-            response += "2. No, complete registration without coordinates"
-        elif session['language'] == 'sw':
-            response = "Je, ungependa kutoa mahali pa eneo lako kwa uwianishaji bora wa mtoa huduma?\n"
-            response += "1. Ndio\n"
-            response += "2. Hapana, kamilisha usajili bila mahali"
-        elif session['language'] == 'fr':
-            response = "Souhaitez-vous fournir vos coordonnées de localisation pour une meilleure correspondance avec les prestataires?\n"
-            response += "1. Oui\n"
-            response += "2. Non, terminer l'inscription sans coordonnées"
-        else:
-            response = "Would you like to provide your location coordinates for better provider matching?\n"
-            response += "1. Yes\n"
-            response += "2. No, complete registration without coordinates"
-        
-        session['state'] = 'register_coordinates_choice'
-        return respond(response)
-        
-    elif state == 'register_coordinates_choice':
-        if input_text == '1':
-            # User wants to provide coordinates
-            if session['language'] == 'en':
-                response = "Please enter your latitude and longitude separated by a comma (e.g., -1.2921,36.8219):"
-            elif session['language'] == 'sw':
-                response = "Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma (mfano, -1.2921,36.8219):"
-            elif session['language'] == 'fr':
-                response = "Veuillez entrer votre latitude et longitude séparées par une virgule (exemple, -1.2921,36.8219):"
-            else:
-                response = "Please enter your latitude and longitude separated by a comma (e.g., -1.2921,36.8219):"
-            
-            session['state'] = 'register_coordinates'
-            return respond(response)
-        elif input_text == '2':
-            # Complete registration without coordinates
-            patient = Patient.create(
-                phone_number=session['phone_number'],
-                name=session['data']['name'],
-                age=session['data']['age'],
-                gender=session['data']['gender'],
-                location=session['data']['location'],
-                language=session['language']
-            )
-            
-            # Show confirmation
-            if session['language'] == 'en':
-                response = f"Registration successful!\n"
-                response += f"Name: {patient.name}\n"
-                response += f"ID: {patient.id}\n"
-                response += "Select 0 to continue to main menu."
-            else:
-                response = f"Usajili umefaulu!\n"
-                response += f"Jina: {patient.name}\n"
-                response += f"Kitambulisho: {patient.id}\n"
-                response += "Chagua 0 kuendelea kwenye menyu kuu."
-            
-            session['state'] = 'registration_complete'
-            return respond(response)
-        else:
-            return respond(get_invalid_option_text(session))
-            
-    elif state == 'register_coordinates':
-        try:
-            # Parse latitude and longitude from input
-            coords = input_text.strip().split(',')
-            if len(coords) != 2:
-                raise ValueError("Invalid format")
-                
-            latitude = float(coords[0].strip())
-            longitude = float(coords[1].strip())
-            
-            # Validate latitude and longitude ranges
-            if latitude < -90 or latitude > 90 or longitude < -180 or longitude > 180:
-                raise ValueError("Coordinates out of range")
-                
-            # Create patient record with coordinates
-            patient = Patient.create(
-                phone_number=session['phone_number'],
-                name=session['data']['name'],
-                age=session['data']['age'],
-                gender=session['data']['gender'],
-                location=session['data']['location'],
-                language=session['language'],
-                coordinates=(latitude, longitude)
-            )
-            
-            # Show confirmation
-            if session['language'] == 'en':
-                response = f"Registration successful!\n"
-                response += f"Name: {patient.name}\n"
-                response += f"Location: {patient.location}\n"
-                response += f"Coordinates saved for location-based provider matching.\n"
-                response += f"ID: {patient.id}\n"
-                response += "Select 0 to continue to main menu."
-            elif session['language'] == 'sw':
-                response = f"Usajili umefaulu!\n"
-                response += f"Jina: {patient.name}\n"
-                response += f"Eneo: {patient.location}\n"
-                response += f"Mahali pamehifadhiwa kwa uwianishaji wa mtoa huduma kulingana na eneo.\n"
-                response += f"Kitambulisho: {patient.id}\n"
-                response += "Chagua 0 kuendelea kwenye menyu kuu."
-            elif session['language'] == 'fr':
-                response = f"Inscription réussie!\n"
-                response += f"Nom: {patient.name}\n"
-                response += f"Emplacement: {patient.location}\n"
-                response += f"Coordonnées enregistrées pour la correspondance des prestataires basée sur la localisation.\n"
-                response += f"ID: {patient.id}\n"
-                response += "Sélectionnez 0 pour continuer vers le menu principal."
-            else:
-                response = f"Registration successful!\n"
-                response += f"Name: {patient.name}\n"
-                response += f"Location: {patient.location}\n"
-                response += f"Coordinates saved for location-based provider matching.\n"
-                response += f"ID: {patient.id}\n"
-                response += "Select 0 to continue to main menu."
-            
-            session['state'] = 'registration_complete'
-            return respond(response)
-        except ValueError as e:
-            # Invalid coordinate format
-            if session['language'] == 'en':
-                response = "Invalid coordinates format. Please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219).\n"
-                response += "Try again or press 0 to cancel and complete registration without coordinates."
-            elif session['language'] == 'sw':
-                response = "Umbali si sahihi. Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma (mfano, -1.2921,36.8219).\n"
-                response += "Jaribu tena au bonyeza 0 kughairi na kukamilisha usajili bila mahali."
-            elif session['language'] == 'fr':
-                response = "Format de coordonnées invalide. Veuillez entrer la latitude et la longitude séparées par une virgule (exemple, -1.2921,36.8219).\n"
-                response += "Réessayez ou appuyez sur 0 pour annuler et terminer l'inscription sans coordonnées."
-            else:
-                response = "Invalid coordinates format. Please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219).\n"
-                response += "Try again or press 0 to cancel and complete registration without coordinates."
-            
-            if input_text == '0':
-                # Create patient record without coordinates
-                patient = Patient.create(
-                    phone_number=session['phone_number'],
-                    name=session['data']['name'],
-                    age=session['data']['age'],
-                    gender=session['data']['gender'],
-                    location=session['data']['location'],
-                    language=session['language']
-                )
-                
-                # Show confirmation
-                if session['language'] == 'en':
-                    response = f"Registration successful!\n"
-                    response += f"Name: {patient.name}\n"
-                    response += f"ID: {patient.id}\n"
-                    response += "Select 0 to continue to main menu."
-                else:
-                    response = f"Usajili umefaulu!\n"
-                    response += f"Jina: {patient.name}\n"
-                    response += f"Kitambulisho: {patient.id}\n"
-                    response += "Chagua 0 kuendelea kwenye menyu kuu."
-                
-                session['state'] = 'registration_complete'
-                return respond(response)
-            else:
-                return respond(response)
-    
-    elif state == 'registration_complete':
-        if input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    else:
-        # Unknown registration state, return to main menu
+def next_page(session, pages):
+    """Show the next page of a paginated response"""
+    if len(pages) > 1:
+        session['pages'] = pages[1:]
+    return pages[0]
+
+def dispatch(session, selection):
+    """Run the current state's handler, or the action its menu maps the selection to"""
+    state = STATES.get(session['state'])
+    if state is None:
+        # Unknown state, return to main menu
         return show_main_menu(session)
+    if state.handler:
+        return state.handler(session, selection)
+    action = state.options.get(selection)
+    if action is None:
+        return respond(prompt(session, 'invalid_option'))
+    return action(session)
 
-def start_symptoms_report(session):
-    """Begin symptom reporting process"""
-    if session['language'] == 'en':
-        response = "Please describe your symptoms:"
-    else:
-        response = "Tafadhali eleza dalili zako:"
+def enter(session, state, screen=None, **values):
+    """
+    Move a session to a state and show its prompt
     
-    session['state'] = 'symptom_description'
-    return respond(response)
+    Args:
+        session (dict): Session state
+        state (str): State to enter
+        screen (str, optional): Prompt to show instead of the state's own
+        **values: Values filled into the prompt
+    """
+    session['state'] = state
+    screen = screen or STATES[state].prompt
+    if not values:
+        return STATIC_SCREENS[screen, session['language']]
+    return respond(prompt(session, screen, **values))
+
+def prompt(session, key, **values):
+    """Return a message from the catalog in the session's language, filled in with values"""
+    return catalog.format(key, session['language'], **values)
 
-def handle_symptoms(session, input_text):
-    """Process symptom reporting steps"""
-    state = session['state']
-    patient = Patient.get_by_phone(session['phone_number'])
+class SessionContext:
+    """
+    Patient and provider references of a USSD session, resolved once
     
-    if state == 'symptom_description':
-        session['data']['symptoms'] = input_text
-        patient.add_symptom(input_text)
-        
-        # Ask about symptom duration
-        if session['language'] == 'en':
-            response = "How long have you had these symptoms?\n"
-            response += "1. Today only\n"
-            response += "2. Few days\n"
-            response += "3. A week or more\n"
-            response += "4. A month or more"
-        else:
-            response = "Umepatwa na dalili hizi kwa muda gani?\n"
-            response += "1. Leo tu\n"
-            response += "2. Siku chache\n"
-            response += "3. Wiki moja au zaidi\n"
-            response += "4. Mwezi mmoja au zaidi"
+    Only IDs are kept, so the context stays small in the session store; the
+    records themselves are fetched by primary key when a screen needs them.
+    Nearby providers are recomputed only when the patient's coordinates
+    change. A phone number found unregistered stays a guest for the rest of
+    the session unless it registers over USSD.
+    """
+    __slots__ = ('phone_number', 'patient_id', 'provider_id', 'providers', 'providers_for')
+    
+    GUEST = 0  # patient_id of a phone number with no patient record
+    
+    def __init__(self, phone_number):
+        self.phone_number = phone_number
+        self.patient_id = None  # None until looked up
+        self.provider_id = None
+        self.providers = None  # ((provider_id, distance in km or None), ...)
+        self.providers_for = None  # coordinates the providers were found for
+    
+    def patient(self):
+        """The session's patient, or None for a guest"""
+        if self.patient_id is None:
+            patient = Patient.get_by_phone(self.phone_number)
+            self.patient_id = patient.id if patient else self.GUEST
+            return patient
+        if self.patient_id == self.GUEST:
+            return None
+        return Patient.get_by_id(self.patient_id)
+    
+    def set_patient(self, patient):
+        """Attach a patient registered during the session"""
+        self.patient_id = patient.id
+        self.invalidate()
+    
+    def invalidate(self):
+        """Forget derived data after the patient's profile or coordinates change"""
+        self.providers = None
+        self.providers_for = None
+    
+    def provider(self):
+        """Provider that patient messages and symptom reports go to"""
+        if self.provider_id is None:
+            self.provider_id = Provider.get_all()[0].id  # For simplicity, the first provider
+        return Provider.get_by_id(self.provider_id)
+    
+    def providers_near(self, patient):
+        """
+        Providers to offer a patient for appointments, nearest first when the
+        patient's coordinates are known
         
-        session['state'] = 'symptom_duration'
-        return respond(response)
-    
-    elif state == 'symptom_duration':
-        if input_text in ['1', '2', '3', '4']:
-            durations = {
-                '1': 'Today only',
-                '2': 'Few days',
-                '3': 'A week or more',
-                '4': 'A month or more'
-            }
-            session['data']['duration'] = durations[input_text]
-            
-            # Ask about symptom severity
-            if session['language'] == 'en':
-                response = "How severe are your symptoms?\n"
-                response += "1. Mild - I can function normally\n"
-                response += "2. Moderate - Affecting daily activities\n"
-                response += "3. Severe - Cannot function normally"
-            else:
-                response = "Dalili zako ni kali kiasi gani?\n"
-                response += "1. Kidogo - Ninaweza kufanya kazi kama kawaida\n"
-                response += "2. Wastani - Zinaathiri shughuli za kila siku\n"
-                response += "3. Kali - Siwezi kufanya kazi kama kawaida"
-            
-            session['state'] = 'symptom_severity'
-            return respond(response)
-        else:
-            return respond(get_invalid_option_text(session))
+        Returns:
+            tuple: (provider_id, distance in km or None) pairs
+        """
+        if self.providers is None or self.providers_for != patient.coordinates:
+            self.providers = tuple((provider.id, getattr(provider, 'distance', None))
+                                   for provider in patient.find_nearby_providers(max_distance=50))
+            self.providers_for = patient.coordinates
+        return self.providers
+
+def context(session):
+    """Return the session's SessionContext, creating it on first use"""
+    ctx = session.get('context')
+    if ctx is None:
+        ctx = session['context'] = SessionContext(session['phone_number'])
+    return ctx
+
+def current_patient(session):
+    """Patient registered with the session's phone number, or None"""
+    return context(session).patient()
+
+def format_date(date, language):
+    """Format a dd-mm-YYYY date with the weekday name in the given language"""
+    day = datetime.strptime(date, '%d-%m-%Y')
+    return f"{WEEKDAYS[language][day.weekday()]} {date}"
+
+@lru_cache(maxsize=64)
+def date_menu(language, today):
+    """
+    Dates that can be booked from a day on, with their menu lines, rendered
+    once per language and day
     
-    elif state == 'symptom_severity':
-        if input_text in ['1', '2', '3']:
-            severities = {
-                '1': 'Mild',
-                '2': 'Moderate',
-                '3': 'Severe'
-            }
-            session['data']['severity'] = severities[input_text]
-            
-            # Record the symptom with enhanced metadata
-            symptom_text = session['data']['symptoms']
-            symptom_severity = session['data']['severity']
-            symptom_duration = session['data']['duration']
-            
-            # Update the symptom text to include duration for better categorization
-            enhanced_symptom_text = f"{symptom_text} for {symptom_duration}"
-            
-            # Add the symptom to patient record with severity
-            patient.add_symptom(enhanced_symptom_text, severity=symptom_severity)
-            
-            # Find an available provider
-            provider = Provider.get_all()[0]  # For simplicity, get the first provider
-            
-            # Create a message for the provider with symptom details
-            message_content = f"Symptoms: {symptom_text}\n"
-            message_content += f"Duration: {symptom_duration}\n"
-            message_content += f"Severity: {symptom_severity}"
-            
-            Message.create(
-                provider_id=provider.id,
-                patient_id=patient.id,
-                content=message_content,
-                sender_type='patient'
-            )
-            
-            # Show confirmation and next steps
-            if session['language'] == 'en':
-                response = "Thank you for reporting your symptoms.\n"
-                response += "A healthcare provider will review your symptoms and respond shortly.\n"
-                response += "1. Schedule an appointment\n"
-                response += "0. Return to main menu"
-            else:
-                response = "Asante kwa kuripoti dalili zako.\n"
-                response += "Mtoa huduma ya afya atakagua dalili zako na kujibu hivi karibuni.\n"
-                response += "1. Panga miadi\n"
-                response += "0. Rudi kwenye menyu kuu"
-            
-            session['state'] = 'symptom_next_steps'
-            return respond(response)
-        else:
-            return respond(get_invalid_option_text(session))
+    Returns:
+        tuple: (dd-mm-YYYY dates, menu text)
+    """
+    dates = tuple((today + timedelta(days=i)).strftime('%d-%m-%Y') for i in range(1, BOOKING_DAYS + 1))
+    return dates, ''.join(f"{i}. {format_date(date, language)}\n" for i, date in enumerate(dates, 1))
+
+@lru_cache(maxsize=256)
+def time_menu(free):
+    """
+    Times of a bitmap of free slots, with their menu lines
     
-    elif state == 'symptom_next_steps':
-        if input_text == '1':
-            return start_appointment_scheduling(session)
-        elif input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
+    Returns:
+        tuple: (times, menu text)
+    """
+    times = slots.times(free)
+    return times, ''.join(f"{i}. {time}\n" for i, time in enumerate(times, 1))
+
+def parse_coordinates(input_text):
+    """
+    Parse 'latitude,longitude' input
     
-    else:
-        # Unknown symptom state, return to main menu
-        return show_main_menu(session)
+    Raises:
+        ValueError: If the input is malformed or out of range
+    """
+    coords = input_text.strip().split(',')
+    if len(coords) != 2:
+        raise ValueError("Invalid format")
+    latitude = float(coords[0].strip())
+    longitude = float(coords[1].strip())
+    if latitude < -90 or latitude > 90 or longitude < -180 or longitude > 180:
+        raise ValueError("Coordinates out of range")
+    return latitude, longitude
+
+# Background work: side effects the reply does not depend on, run by the task
+# queue so a slow write or downstream service never delays the gateway
+
+# Tasks may be retried after a partial write, so each one carries the ID or
+# time it was submitted with and writes its record at most once
+
+def record_symptom(patient_id, symptom, severity, reported_at):
+    """Add a reported symptom to a patient's record"""
+    Patient.get_by_id(patient_id).add_symptom(symptom, severity=severity, reported_at=reported_at)
+
+def track(session, patient_id, description, **metadata):
+    """Record a USSD interaction of a patient in the background"""
+    background.submit(UserInteraction.create, patient_id, 'ussd', description,
+                      {'session_id': session['session_id'], **metadata},
+                      interaction_id=UserInteraction.reserve_id())
+
+# Actions: entered from menus or handlers, they show a screen and move the session on
+
+def show_main_menu(session):
+    """Display the main menu based on user's language and registration status"""
+    patient = current_patient(session)
+    if patient:
+        return enter(session, 'main_menu', name=patient.name)
+    return enter(session, 'guest_menu')
+
+def restart(session):
+    """Go back to language selection"""
+    session['data'] = {}
+    return enter(session, 'select_language')
+
+def start_symptoms_report(session):
+    """Begin symptom reporting process"""
+    return enter(session, 'symptom_description')
 
 def start_appointment_scheduling(session):
     """Begin appointment scheduling process"""
-    # Get available dates (next 7 days)
-    today = datetime.now()
-    dates = [(today + timedelta(days=i)).strftime('%d-%m-%Y') for i in range(1, 8)]
-    
+    return offer_dates(session, 'appointment_date')
+
+def offer_dates(session, message):
+    """Show the dates that can be booked under a message"""
+    dates, menu = date_menu(session['language'], datetime.now().date())
     session['data']['available_dates'] = dates
-    
-    if session['language'] == 'en':
-        response = "Select preferred date:\n"
-    else:
-        response = "Chagua tarehe unayopendelea:\n"
-    
-    # Show dates
-    for i, date in enumerate(dates, 1):
-        # Format the date in a user-friendly way
-        formatted_date = utils.format_date(date, session['language'])
-        response += f"{i}. {formatted_date}\n"
-    
     session['state'] = 'appointment_date'
-    return respond(response)
+    return respond(prompt(session, message) + menu)
 
-def handle_appointments(session, input_text):
-    """Process appointment scheduling steps"""
-    state = session['state']
-    patient = Patient.get_by_phone(session['phone_number'])
-    
-    if state == 'appointment_date':
-        try:
-            selection = int(input_text)
-            if 1 <= selection <= len(session['data']['available_dates']):
-                selected_date = session['data']['available_dates'][selection - 1]
-                session['data']['selected_date'] = selected_date
-                
-                # Get available time slots
-                time_slots = ['09:00', '10:00', '11:00', '14:00', '15:00', '16:00']
-                session['data']['available_times'] = time_slots
-                
-                if session['language'] == 'en':
-                    response = "Select preferred time:\n"
-                else:
-                    response = "Chagua wakati unaopendelea:\n"
-                
-                # Show time slots
-                for i, time in enumerate(time_slots, 1):
-                    response += f"{i}. {time}\n"
-                
-                session['state'] = 'appointment_time'
-                return respond(response)
-            else:
-                return respond(get_invalid_option_text(session))
-        except ValueError:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'appointment_time':
-        try:
-            selection = int(input_text)
-            if 1 <= selection <= len(session['data']['available_times']):
-                selected_time = session['data']['available_times'][selection - 1]
-                session['data']['selected_time'] = selected_time
-                
-                # Get patient object
-                patient = Patient.get_by_phone(session['phone_number'])
-                
-                # Find nearby providers if patient has location data
-                if patient.coordinates:
-                    providers = patient.find_nearby_providers(max_distance=50)
-                    session['data']['using_location'] = True
-                else:
-                    providers = Provider.get_all()
-                    session['data']['using_location'] = False
-                
-                session['data']['available_providers'] = providers
-                
-                if session['language'] == 'en':
-                    if patient.coordinates:
-                        response = "Select healthcare provider (sorted by distance):\n"
-                    else:
-                        response = "Select healthcare provider:\n"
-                elif session['language'] == 'sw':
-                    if patient.coordinates:
-                        response = "Chagua mtoa huduma ya afya (imepangwa kwa umbali):\n"
-                    else:
-                        response = "Chagua mtoa huduma ya afya:\n"
-                elif session['language'] == 'fr':
-                    if patient.coordinates:
-                        response = "Sélectionnez un prestataire de soins de santé (classé par distance):\n"
-                    else:
-                        response = "Sélectionnez un prestataire de soins de santé:\n"
-                else:
-                    if patient.coordinates:
-                        response = "Select healthcare provider (sorted by distance):\n"
-                    else: 
-                        response = "Select healthcare provider:\n"
-                
-                # Show providers with distance information if available
-                for i, provider in enumerate(providers, 1):
-                    if hasattr(provider, 'distance') and provider.distance is not None:
-                        # Show distance to provider rounded to one decimal place
-                        distance_km = round(provider.distance, 1)
-                        response += f"{i}. {provider.name} ({provider.specialization}) - {distance_km} km\n"
-                    else:
-                        response += f"{i}. {provider.name} ({provider.specialization})\n"
-                
-                session['state'] = 'appointment_provider'
-                return respond(response)
-            else:
-                return respond(get_invalid_option_text(session))
-        except ValueError:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'appointment_provider':
-        try:
-            selection = int(input_text)
-            if 1 <= selection <= len(session['data']['available_providers']):
-                selected_provider = session['data']['available_providers'][selection - 1]
-                
-                # Create appointment
-                appointment = Appointment.create(
-                    patient_id=patient.id,
-                    provider_id=selected_provider.id,
-                    date=session['data']['selected_date'],
-                    time=session['data']['selected_time']
-                )
-                
-                # Show confirmation
-                formatted_date = utils.format_date(
-                    session['data']['selected_date'], 
-                    session['language']
-                )
-                
-                if session['language'] == 'en':
-                    response = "Appointment scheduled successfully!\n"
-                    response += f"Date: {formatted_date}\n"
-                    response += f"Time: {session['data']['selected_time']}\n"
-                    response += f"Provider: {selected_provider.name}\n"
-                    response += f"Appointment ID: {appointment.id}\n"
-                    response += "0. Return to main menu"
-                else:
-                    response = "Miadi imepangwa kwa mafanikio!\n"
-                    response += f"Tarehe: {formatted_date}\n"
-                    response += f"Wakati: {session['data']['selected_time']}\n"
-                    response += f"Mtoa huduma: {selected_provider.name}\n"
-                    response += f"Kitambulisho cha miadi: {appointment.id}\n"
-                    response += "0. Rudi kwenye menyu kuu"
-                
-                session['state'] = 'appointment_complete'
-                return respond(response)
-            else:
-                return respond(get_invalid_option_text(session))
-        except ValueError:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'appointment_complete':
-        if input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    else:
-        # Unknown appointment state, return to main menu
-        return show_main_menu(session)
+def offer_times(session, message):
+    """
+    Show the times of the selected date at which any of the patient's
+    providers is free, or the dates again if there are none
+    """
+    patient = current_patient(session)
+    providers = [provider_id for provider_id, _ in context(session).providers_near(patient)]
+    free = slots.free_any(providers, session['data']['selected_date'])
+    if not free:
+        return offer_dates(session, 'no_free_slots')
+    times, menu = time_menu(free)
+    session['data']['available_times'] = times
+    session['state'] = 'appointment_time'
+    return respond(prompt(session, message) + menu)
 
 def show_messages(session):
     """Show messages for the patient"""
-    patient = Patient.get_by_phone(session['phone_number'])
-    provider = Provider.get_all()[0]  # For simplicity, get the first provider
-    
-    # Get conversation
-    messages = Message.get_conversation(provider.id, patient.id)
-    
-    if messages:
-        # Show the last few messages
-        recent_messages = messages[-3:] if len(messages) > 3 else messages
-        
-        if session['language'] == 'en':
-            response = "Recent messages:\n"
-            for i, msg in enumerate(recent_messages, 1):
-                sender = "You" if msg.sender_type == 'patient' else "Doctor"
-                response += f"{i}. {sender}: {msg.content[:30]}...\n"
-            
-            response += "\n1. Send new message\n"
-            response += "0. Return to main menu"
-        else:
-            response = "Ujumbe wa hivi karibuni:\n"
-            for i, msg in enumerate(recent_messages, 1):
-                sender = "Wewe" if msg.sender_type == 'patient' else "Daktari"
-                response += f"{i}. {sender}: {msg.content[:30]}...\n"
-            
-            response += "\n1. Tuma ujumbe mpya\n"
-            response += "0. Rudi kwenye menyu kuu"
-    else:
-        if session['language'] == 'en':
-            response = "You have no messages yet.\n"
-            response += "1. Send new message\n"
-            response += "0. Return to main menu"
-        else:
-            response = "Bado huna ujumbe.\n"
-            response += "1. Tuma ujumbe mpya\n"
-            response += "0. Rudi kwenye menyu kuu"
-    
+    patient = current_patient(session)
+    provider = context(session).provider()
+    messages, _ = Message.get_conversation_page(provider.id, patient.id, limit=3)
+    
+    if not messages:
+        return enter(session, 'message_menu', 'messages_none')
+    
+    # Show the last few messages
+    response = prompt(session, 'messages_recent')
+    for i, msg in enumerate(messages, 1):
+        sender = prompt(session, 'sender_you' if msg.sender_type == 'patient' else 'sender_doctor')
+        response += f"{i}. {sender}: {msg.content[:30]}...\n"
+    response += prompt(session, 'messages_footer')
     session['state'] = 'message_menu'
     return respond(response)
 
-def handle_messages(session, input_text):
-    """Process messaging steps"""
-    state = session['state']
-    patient = Patient.get_by_phone(session['phone_number'])
-    provider = Provider.get_all()[0]  # For simplicity, get the first provider
-    
-    if state == 'message_menu':
-        if input_text == '1':
-            if session['language'] == 'en':
-                response = "Type your message:"
-            else:
-                response = "Andika ujumbe wako:"
-            
-            session['state'] = 'message_compose'
-            return respond(response)
-        elif input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'message_compose':
-        # Create message
-        Message.create(
-            provider_id=provider.id,
-            patient_id=patient.id,
-            content=input_text,
-            sender_type='patient'
-        )
-        
-        if session['language'] == 'en':
-            response = "Message sent successfully.\n"
-            response += "The healthcare provider will respond soon.\n"
-            response += "0. Return to main menu"
-        else:
-            response = "Ujumbe umetumwa kwa mafanikio.\n"
-            response += "Mtoa huduma ya afya atajibu hivi karibuni.\n"
-            response += "0. Rudi kwenye menyu kuu"
-        
-        session['state'] = 'message_sent'
-        return respond(response)
-    
-    elif state == 'message_sent':
-        if input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'profile_view':
-        patient = Patient.get_by_phone(session['phone_number'])
-        
-        if input_text == '1':
-            # Update location coordinates option selected
-            if session['language'] == 'en':
-                response = "To update your location coordinates, please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219):"
-            elif session['language'] == 'sw':
-                response = "Kusasisha mahali pako, tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma (mfano, -1.2921,36.8219):"
-            elif session['language'] == 'fr':
-                response = "Pour mettre à jour vos coordonnées de localisation, veuillez entrer la latitude et la longitude séparées par une virgule (exemple, -1.2921,36.8219):"
-            else:
-                response = "To update your location coordinates, please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219):"
-            
-            session['state'] = 'update_coordinates'
-            return respond(response)
-        elif input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'update_coordinates':
-        try:
-            # Parse latitude and longitude from input
-            coords = input_text.strip().split(',')
-            if len(coords) != 2:
-                raise ValueError("Invalid format")
-                
-            latitude = float(coords[0].strip())
-            longitude = float(coords[1].strip())
-            
-            # Validate latitude and longitude ranges
-            if latitude < -90 or latitude > 90 or longitude < -180 or longitude > 180:
-                raise ValueError("Coordinates out of range")
-                
-            patient = Patient.get_by_phone(session['phone_number'])
-            patient.update_coordinates(latitude, longitude)
-            
-            if session['language'] == 'en':
-                response = "Location coordinates updated successfully!\n"
-                response += "You will now receive location-based provider recommendations.\n"
-                response += "0. Return to main menu"
-            elif session['language'] == 'sw':
-                response = "Mahali pako pamewekwa kwa mafanikio!\n"
-                response += "Sasa utapata mapendekezo ya watoa huduma kulingana na eneo lako.\n"
-                response += "0. Rudi kwenye menyu kuu"
-            elif session['language'] == 'fr':
-                response = "Coordonnées de localisation mises à jour avec succès!\n"
-                response += "Vous recevrez désormais des recommandations de prestataires basées sur la localisation.\n"
-                response += "0. Retour au menu principal"
-            else:
-                response = "Location coordinates updated successfully!\n"
-                response += "You will now receive location-based provider recommendations.\n"
-                response += "0. Return to main menu"
-            
-            session['state'] = 'coordinates_updated'
-            return respond(response)
-        except ValueError as e:
-            # Invalid coordinate format
-            if session['language'] == 'en':
-                response = "Invalid coordinates format. Please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219).\n"
-                response += "Try again or press 0 to cancel."
-            elif session['language'] == 'sw':
-                response = "Umbali si sahihi. Tafadhali ingiza latitudo na longitudo iliyotenganishwa kwa koma (mfano, -1.2921,36.8219).\n"
-                response += "Jaribu tena au bonyeza 0 kughairi."
-            elif session['language'] == 'fr':
-                response = "Format de coordonnées invalide. Veuillez entrer la latitude et la longitude séparées par une virgule (exemple, -1.2921,36.8219).\n"
-                response += "Réessayez ou appuyez sur 0 pour annuler."
-            else:
-                response = "Invalid coordinates format. Please enter latitude and longitude separated by a comma (e.g., -1.2921,36.8219).\n"
-                response += "Try again or press 0 to cancel."
-            
-            if input_text == '0':
-                return show_main_menu(session)
-            else:
-                return respond(response)
-    
-    elif state == 'coordinates_updated':
-        if input_text == '0':
-            return show_main_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    else:
-        # Unknown message state, return to main menu
-        return show_main_menu(session)
+def show_profile(session):
+    """Show patient profile"""
+    patient = current_patient(session)
+    gps = prompt(session, 'gps_available' if patient.coordinates is not None else 'gps_not_set')
+    return enter(session, 'profile_view', name=patient.name, age=patient.age, gender=patient.gender,
+                 location=patient.location, gps=gps, id=patient.id)
 
-def show_health_info_menu(session):
-    """Show health information menu"""
-    if session['language'] == 'en':
-        response = "Health Information:\n"
-        response += "1. COVID-19 Information\n"
-        response += "2. Maternal Health\n"
-        response += "3. Chronic Diseases\n"
-        response += "4. First Aid\n"
-        response += "0. Return to main menu"
-    else:
-        response = "Habari za Afya:\n"
-        response += "1. Habari za COVID-19\n"
-        response += "2. Afya ya Uzazi\n"
-        response += "3. Magonjwa ya Muda Mrefu\n"
-        response += "4. Huduma ya Kwanza\n"
-        response += "0. Rudi kwenye menyu kuu"
-    
-    session['state'] = 'info_menu'
+def show_health_topic(session, topic):
+    """Show health information on a topic"""
+    session['data']['selected_topic'] = topic
+    
+    # Get health info from database based on language and topic
+    health_info_list = HealthInfo.get_by_language(session['language'])
+    
+    # In a real application, you'd filter by topic as well
+    if not health_info_list:
+        return enter(session, 'info_detail', 'info_unavailable')
+    info = health_info_list[0]  # Just get the first one for demo
+    return enter(session, 'info_detail', title=info.title, content=info.content)
+
+def show_records(session, kind):
+    """List the patient's most recent records of a kind from RECORD_LISTS"""
+    load, heading, item, describe = RECORD_LISTS[kind]
+    records = load(current_patient(session))[-MAX_RECORDS:]
+    if not records:
+        return enter(session, 'records_list', f'{kind}_none')
+    
+    response = prompt(session, heading)
+    for i, record in enumerate(records, 1):
+        response += prompt(session, item, n=i, **describe(record)) + "\n"
+    response += prompt(session, 'records_footer')
+    session['state'] = 'records_list'
     return respond(response)
 
-def handle_health_info(session, input_text):
-    """Process health information selection"""
-    state = session['state']
-    
-    if state == 'info_menu':
-        if input_text == '0':
-            return show_main_menu(session)
-        
-        topics = {
-            '1': 'covid',
-            '2': 'maternal',
-            '3': 'chronic',
-            '4': 'firstaid'
-        }
-        
-        if input_text in topics:
-            topic = topics[input_text]
-            session['data']['selected_topic'] = topic
-            
-            # Get health info from database based on language and topic
-            health_info_list = HealthInfo.get_by_language(session['language'])
-            
-            # In a real application, you'd filter by topic as well
-            if health_info_list:
-                info = health_info_list[0]  # Just get the first one for demo
-                
-                if session['language'] == 'en':
-                    response = f"{info.title}:\n"
-                    response += f"{info.content}\n\n"
-                    response += "0. Return to health information menu"
-                else:
-                    response = f"{info.title}:\n"
-                    response += f"{info.content}\n\n"
-                    response += "0. Rudi kwenye menyu ya habari za afya"
-            else:
-                if session['language'] == 'en':
-                    response = "Information not available at this time.\n"
-                    response += "0. Return to health information menu"
-                else:
-                    response = "Habari haipatikani kwa sasa.\n"
-                    response += "0. Rudi kwenye menyu ya habari za afya"
-            
-            session['state'] = 'info_detail'
-            return respond(response)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    elif state == 'info_detail':
-        if input_text == '0':
-            return show_health_info_menu(session)
-        else:
-            return respond(get_invalid_option_text(session))
-    
-    else:
-        # Unknown info state, return to main menu
-        return show_main_menu(session)
+def complete_registration(session, coordinates=None):
+    """Create the patient from the collected registration data"""
+    patient = Patient.create(
+        phone_number=session['phone_number'],
+        name=session['data']['name'],
+        age=session['data']['age'],
+        gender=session['data']['gender'],
+        location=session['data']['location'],
+        language=session['language'],
+        coordinates=coordinates
+    )
+    context(session).set_patient(patient)
+    track(session, patient.id, 'Registered over USSD', language=session['language'])
+    if coordinates:
+        return enter(session, 'registration_complete', 'registration_complete_coordinates',
+                     name=patient.name, location=patient.location, id=patient.id)
+    return enter(session, 'registration_complete', name=patient.name, id=patient.id)
 
-def show_profile(session, patient):
-    """Show patient profile"""
-    has_coordinates = patient.coordinates is not None
-    
-    if session['language'] == 'en':
-        response = f"Your Profile:\n"
-        response += f"Name: {patient.name}\n"
-        response += f"Age: {patient.age}\n"
-        response += f"Gender: {patient.gender}\n"
-        response += f"Location: {patient.location}\n"
-        
-        # Show coordinates if available
-        if has_coordinates:
-            response += f"GPS Location: Available\n"
-        else:
-            response += f"GPS Location: Not set\n"
-            
-        response += f"ID: {patient.id}\n\n"
-        response += "1. Update location coordinates\n"
-        response += "0. Return to main menu"
-    elif session['language'] == 'sw':
-        response = f"Wasifu Wako:\n"
-        response += f"Jina: {patient.name}\n"
-        response += f"Umri: {patient.age}\n"
-        response += f"Jinsia: {patient.gender}\n"
-        response += f"Eneo: {patient.location}\n"
-        
-        # Show coordinates if available
-        if has_coordinates:
-            response += f"Eneo la GPS: Linapatikana\n"
-        else:
-            response += f"Eneo la GPS: Halijawekwa\n"
-            
-        response += f"Kitambulisho: {patient.id}\n\n"
-        response += "1. Sasisha mahali pa eneo\n"
-        response += "0. Rudi kwenye menyu kuu"
-    elif session['language'] == 'fr':
-        response = f"Votre Profil:\n"
-        response += f"Nom: {patient.name}\n"
-        response += f"Âge: {patient.age}\n"
-        response += f"Sexe: {patient.gender}\n"
-        response += f"Emplacement: {patient.location}\n"
-        
-        # Show coordinates if available
-        if has_coordinates:
-            response += f"Localisation GPS: Disponible\n"
-        else:
-            response += f"Localisation GPS: Non définie\n"
-            
-        response += f"ID: {patient.id}\n\n"
-        response += "1. Mettre à jour les coordonnées de localisation\n"
-        response += "0. Retour au menu principal"
-    else:
-        response = f"Your Profile:\n"
-        response += f"Name: {patient.name}\n"
-        response += f"Age: {patient.age}\n"
-        response += f"Gender: {patient.gender}\n"
-        response += f"Location: {patient.location}\n"
-        
-        # Show coordinates if available
-        if has_coordinates:
-            response += f"GPS Location: Available\n"
+# Input handlers: called with the session and the user's latest input
+
+def handle_language_selection(session, selection):
+    """Set the session language from the language menu"""
+    language = LANGUAGE_OPTIONS.get(selection)
+    if language is None:
+        return respond(prompt(session, 'invalid_option'))
+    session['language'] = language
+    return show_main_menu(session)
+
+def handle_register_name(session, input_text):
+    session['data']['name'] = input_text
+    return enter(session, 'register_age')
+
+def handle_register_age(session, input_text):
+    try:
+        session['data']['age'] = int(input_text)
+    except ValueError:
+        return respond(prompt(session, 'invalid_age'))
+    return enter(session, 'register_gender')
+
+def handle_register_gender(session, input_text):
+    gender = GENDER_OPTIONS.get(input_text)
+    if gender is None:
+        return respond(prompt(session, 'invalid_option'))
+    session['data']['gender'] = gender
+    return enter(session, 'register_location')
+
+def handle_register_location(session, input_text):
+    session['data']['location'] = input_text
+    # Ask if the user wants to provide coordinates for location-based provider matching
+    return enter(session, 'register_coordinates_choice')
+
+def handle_register_coordinates(session, input_text):
+    if input_text == '0':
+        return complete_registration(session)
+    try:
+        coordinates = parse_coordinates(input_text)
+    except ValueError:
+        return respond(prompt(session, 'register_coordinates_invalid'))
+    return complete_registration(session, coordinates)
+
+def handle_symptom_description(session, input_text):
+    # Recorded with its duration and severity once the report is complete
+    session['data']['symptoms'] = input_text
+    return enter(session, 'symptom_duration')
+
+def handle_symptom_duration(session, input_text):
+    duration = DURATION_OPTIONS.get(input_text)
+    if duration is None:
+        return respond(prompt(session, 'invalid_option'))
+    session['data']['duration'] = duration
+    return enter(session, 'symptom_severity')
+
+def handle_symptom_severity(session, input_text):
+    severity = SEVERITY_OPTIONS.get(input_text)
+    if severity is None:
+        return respond(prompt(session, 'invalid_option'))
+    session['data']['severity'] = severity
+    patient = current_patient(session)
+    
+    # Record the symptom with its duration for better categorization
+    symptom_text = session['data']['symptoms']
+    symptom_duration = session['data']['duration']
+    background.submit(record_symptom, patient.id, f"{symptom_text} for {symptom_duration}", severity,
+                      datetime.now())
+    
+    # Send the symptom details to a provider
+    provider = context(session).provider()
+    message_content = f"Symptoms: {symptom_text}\n"
+    message_content += f"Duration: {symptom_duration}\n"
+    message_content += f"Severity: {severity}"
+    background.submit(
+        Message.create,
+        provider_id=provider.id,
+        patient_id=patient.id,
+        content=message_content,
+        sender_type='patient',
+        message_id=Message.reserve_id()
+    )
+    track(session, patient.id, 'Reported symptoms over USSD', severity=severity)
+    return enter(session, 'symptom_next_steps')
+
+def _menu_selection(input_text, choices):
+    """Return the 1-based menu choice from input_text, or None if it is not one"""
+    try:
+        selection = int(input_text)
+    except ValueError:
+        return None
+    return choices[selection - 1] if 1 <= selection <= len(choices) else None
+
+def handle_appointment_date(session, input_text):
+    selected_date = _menu_selection(input_text, session['data']['available_dates'])
+    if selected_date is None:
+        return respond(prompt(session, 'invalid_option'))
+    session['data']['selected_date'] = selected_date
+    return offer_times(session, 'appointment_time')
+
+def handle_appointment_time(session, input_text):
+    selected_time = _menu_selection(input_text, session['data']['available_times'])
+    if selected_time is None:
+        return respond(prompt(session, 'invalid_option'))
+    patient = current_patient(session)
+    
+    # Nearby providers if patient has location data, otherwise all of them,
+    # leaving out those already booked at the selected time
+    selected_date = session['data']['selected_date']
+    offered = [(provider_id, distance) for provider_id, distance in context(session).providers_near(patient)
+               if slots.is_free(provider_id, selected_date, selected_time)]
+    if not offered:
+        return offer_times(session, 'slot_taken')
+    session['data']['selected_time'] = selected_time
+    session['data']['available_providers'] = tuple(provider_id for provider_id, _ in offered)
+    response = prompt(session, 'appointment_provider_nearby' if patient.coordinates else 'appointment_provider')
+    
+    # Show providers with distance information if available
+    for i, (provider_id, distance) in enumerate(offered, 1):
+        provider = Provider.get_by_id(provider_id)
+        if distance is not None:
+            response += f"{i}. {provider.name} ({provider.specialization}) - {round(distance, 1)} km\n"
         else:
-            response += f"GPS Location: Not set\n"
-            
-        response += f"ID: {patient.id}\n\n"
-        response += "1. Update location coordinates\n"
-        response += "0. Return to main menu"
-    
-    session['state'] = 'profile_view'
+            response += f"{i}. {provider.name} ({provider.specialization})\n"
+    session['state'] = 'appointment_provider'
     return respond(response)
 
-def get_invalid_option_text(session):
-    """Get invalid option text based on language"""
-    if session['language'] == 'en':
-        return "Invalid option. Please try again."
-    elif session['language'] == 'sw':
-        return "Chaguo batili. Tafadhali jaribu tena."
-    elif session['language'] == 'fr':
-        return "Option invalide. Veuillez réessayer."
-    elif session['language'] == 'om':
-        return "Filannoon sirrii miti. Maaloo irra deebi'ii yaali."
-    elif session['language'] == 'so':
-        return "Doorasho aan shaqeyneyn. Fadlan mar kale isku day."
-    elif session['language'] == 'am':
-        return "ልክ ያልሆነ ምርጫ። እባክዎ እንደገና ይሞክሩ።"
-    else:
-        return "Invalid option. Please try again."
+def handle_appointment_provider(session, input_text):
+    provider_id = _menu_selection(input_text, session['data']['available_providers'])
+    if provider_id is None:
+        return respond(prompt(session, 'invalid_option'))
+    provider = Provider.get_by_id(provider_id)
+    selected_date = session['data']['selected_date']
+    selected_time = session['data']['selected_time']
+    
+    # Another session may have taken the slot since it was offered
+    if not slots.reserve(provider.id, selected_date, selected_time):
+        return offer_times(session, 'slot_taken')
+    try:
+        appointment = Appointment.create(
+            patient_id=current_patient(session).id,
+            provider_id=provider.id,
+            date=selected_date,
+            time=selected_time
+        )
+    except ValueError:
+        # Booked by another worker process meanwhile; the store refuses a second booking
+        slots.release(provider.id, selected_date, selected_time)
+        slots.forget(provider.id, selected_date)
+        return offer_times(session, 'slot_taken')
+    except Exception:
+        slots.release(provider.id, selected_date, selected_time)
+        raise
+    track(session, appointment.patient_id, 'Booked an appointment over USSD', appointment_id=appointment.id)
+    return enter(session, 'appointment_complete',
+                 date=format_date(session['data']['selected_date'], session['language']),
+                 time=session['data']['selected_time'], provider=provider.name, id=appointment.id)
+
+def handle_message_compose(session, input_text):
+    provider = context(session).provider()
+    patient = current_patient(session)
+    background.submit(
+        Message.create,
+        provider_id=provider.id,
+        patient_id=patient.id,
+        content=input_text,
+        sender_type='patient',
+        message_id=Message.reserve_id()
+    )
+    track(session, patient.id, 'Sent a message over USSD')
+    return enter(session, 'message_sent')
+
+def handle_update_coordinates(session, input_text):
+    if input_text == '0':
+        return show_main_menu(session)
+    try:
+        latitude, longitude = parse_coordinates(input_text)
+    except ValueError:
+        return respond(prompt(session, 'update_coordinates_invalid'))
+    current_patient(session).update_coordinates(latitude, longitude)
+    context(session).invalidate()
+    return enter(session, 'coordinates_updated')
 
 def respond(text):
     """Format USSD response with appropriate prefix"""
@@ -1164,3 +676,155 @@ def respond(text):
         prefix = "CON "
     
     return prefix + text
+
+# Finished responses for screens without placeholders, built once rather than
+# per request
+STATIC_SCREENS = {key: respond(template) for key, template in catalog.templates.items()
+                  if key not in catalog.formatters}
+WEEKDAYS = {language: tuple(catalog.get('weekdays', language).split(',')) for language in catalog.languages}
+
+def _describe_lab_test(lab_test):
+    """Result summary for a lab test, or its status until results are recorded"""
+    result = LabResult.get_by_lab_test(lab_test.id)
+    if result and result.results:
+        summary = ', '.join(f"{name} {value}" for name, value in result.results.items())
+    else:
+        summary = lab_test.status.replace('_', ' ')
+    return {'test': lab_test.test_name, 'result': summary}
+
+# Record lists of the records menu: kind -> (loader, heading prompt, item prompt,
+# function returning the item prompt's values). A new list is one entry here,
+# one option in the records_menu state and its prompts.
+RECORD_LISTS = {
+    'prescriptions': (
+        lambda patient: Prescription.get_by_patient(patient.id),
+        'prescriptions_heading', 'prescription_item',
+        lambda p: {'date': p.created_at.strftime('%d-%m-%Y'), 'status': p.status,
+                   'medications': ', '.join(m.get('name', '') for m in p.medications)}),
+    'lab_results': (
+        lambda patient: LabTest.get_by_patient(patient.id),
+        'lab_results_heading', 'lab_result_item', _describe_lab_test),
+    'bills': (
+        lambda patient: Bill.get_by_patient(patient.id),
+        'bills_heading', 'bill_item',
+        lambda b: {'date': b.created_at.strftime('%d-%m-%Y'), 'amount': b.total_amount,
+                   'status': b.status.replace('_', ' ')}),
+}
+
+class State:
+    """
+    A state of the USSD session machine
+    
+    A state either has a handler, called as handler(session, input), or a
+    menu of options mapping an input to an action called as action(session).
+    Its prompt is shown when the session enters it. An input of 0 returns to
+    the main menu unless the state handles it itself: a menu with a 0 option,
+    or a handler marked with handles_zero.
+    """
+    __slots__ = ('name', 'prompt', 'handler', 'options', 'handles_zero')
+    
+    def __init__(self, name, prompt=None, handler=None, options=None, handles_zero=False):
+        self.name = name
+        self.prompt = prompt or name
+        self.handler = handler
+        self.options = options or {}
+        self.handles_zero = handles_zero or '0' in self.options
+
+def compile_states(table):
+    """
+    Build the State objects for a state table, turning option targets that
+    name a state into actions that enter it
+    
+    Raises:
+        ValueError: If an option targets a state that is not in the table
+    """
+    states = {}
+    for name, spec in table.items():
+        options = {}
+        for selection, target in spec.get('options', {}).items():
+            if isinstance(target, str):
+                if target not in table:
+                    raise ValueError(f"USSD state {name} option {selection} targets unknown state {target}")
+                target = partial(enter, state=target)
+            options[selection] = target
+        states[name] = State(name, spec.get('prompt'), spec.get('handler'), options, spec.get('handles_zero', False))
+    return states
+
+# The USSD state machine: session['state'] -> how the next input is handled.
+# Option targets are either the name of a state to enter or an action.
+STATES = compile_states({
+    'select_language': {'prompt': 'language_menu', 'handler': handle_language_selection, 'handles_zero': True},
+    'main_menu': {'options': {
+        '1': start_symptoms_report,
+        '2': start_appointment_scheduling,
+        '3': show_messages,
+        '4': 'info_menu',
+        '5': show_profile,
+        '6': 'records_menu',
+        '0': restart,
+    }},
+    'guest_menu': {'options': {
+        '1': 'register_name',
+        '2': 'info_menu',
+        '0': restart,
+    }},
+    
+    # Registration
+    'register_name': {'handler': handle_register_name},
+    'register_age': {'handler': handle_register_age},
+    'register_gender': {'handler': handle_register_gender},
+    'register_location': {'handler': handle_register_location},
+    'register_coordinates_choice': {'options': {
+        '1': 'register_coordinates',
+        '2': complete_registration,
+    }},
+    'register_coordinates': {'handler': handle_register_coordinates, 'handles_zero': True},
+    'registration_complete': {'options': {'0': show_main_menu}},
+    
+    # Symptoms
+    'symptom_description': {'handler': handle_symptom_description},
+    'symptom_duration': {'handler': handle_symptom_duration},
+    'symptom_severity': {'handler': handle_symptom_severity},
+    'symptom_next_steps': {'options': {
+        '1': start_appointment_scheduling,
+        '0': show_main_menu,
+    }},
+    
+    # Appointments
+    'appointment_date': {'handler': handle_appointment_date},
+    'appointment_time': {'handler': handle_appointment_time},
+    'appointment_provider': {'handler': handle_appointment_provider},
+    'appointment_complete': {'options': {'0': show_main_menu}},
+    
+    # Messages
+    'message_menu': {'prompt': 'messages_none', 'options': {
+        '1': 'message_compose',
+        '0': show_main_menu,
+    }},
+    'message_compose': {'handler': handle_message_compose},
+    'message_sent': {'options': {'0': show_main_menu}},
+    
+    # Profile
+    'profile_view': {'options': {
+        '1': 'update_coordinates',
+        '0': show_main_menu,
+    }},
+    'update_coordinates': {'handler': handle_update_coordinates, 'handles_zero': True},
+    'coordinates_updated': {'options': {'0': show_main_menu}},
+    
+    # Health information
+    'info_menu': {'options': {
+        **{selection: partial(show_health_topic, topic=topic) for selection, topic in HEALTH_TOPICS.items()},
+        '0': show_main_menu,
+    }},
+    'info_detail': {'options': {'0': 'info_menu'}},
+    
+    # Records
+    'records_menu': {'options': {
+        '1': partial(show_records, kind='prescriptions'),
+        '2': partial(show_records, kind='lab_results'),
+        '3': partial(show_records, kind='bills'),
+        '0': show_main_menu,
+    }},
+    'records_list': {'prompt': 'records_footer', 'options': {'0': show_main_menu}},
+})
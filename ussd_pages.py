@@ -0,0 +1,140 @@
+"""
+USSD page budgeting for Tujali Telehealth
+
+A USSD page carries at most 160 octets. Text that fits the GSM 7-bit alphabet
+is packed at 7 bits per character, so a page holds 182 characters (characters
+from the GSM extension table, such as { } [ ] and the euro sign, take two);
+anything else, e.g. Amharic, is sent as UCS-2 at 2 octets per character, so a
+page holds only 80. Gateways truncate or reject longer screens, and the user
+pays for another round trip.
+
+paginate() splits a screen that does not fit into pages that do. Every page but
+the last ends with a "98. More" line, and a trailing "0. ..." navigation line
+is repeated on each page so the user can always leave. Lines are never split
+unless a single line is longer than a page. Paginations are cached, since the
+same screens are rendered over and over.
+"""
+
+from functools import lru_cache
+
+# Octets in one USSD page
+MAX_PAGE_OCTETS = 160
+MAX_GSM7_CHARS = MAX_PAGE_OCTETS * 8 // 7  # 182
+MAX_UCS2_CHARS = MAX_PAGE_OCTETS // 2  # 80
+
+# Option that shows the next page of a paginated screen
+MORE_OPTION = '98'
+
+GSM7_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# Sent as an escape character plus the character, so they count twice
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+
+def is_gsm7(text):
+    """Whether text can be sent in the GSM 7-bit alphabet"""
+    return all(c in GSM7_BASIC or c in GSM7_EXTENDED for c in text)
+
+
+def encoded_length(text, gsm7=None):
+    """
+    Length of text in the units a page is measured in
+
+    Args:
+        text (str): Text to measure
+        gsm7 (bool, optional): Encoding to measure in; detected from text if omitted
+
+    Returns:
+        int: GSM 7-bit characters, or UCS-2 code units
+    """
+    if gsm7 is None:
+        gsm7 = is_gsm7(text)
+    if gsm7:
+        return len(text) + sum(1 for c in text if c in GSM7_EXTENDED)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def page_limit(gsm7):
+    """Characters that fit on one page in an encoding"""
+    return MAX_GSM7_CHARS if gsm7 else MAX_UCS2_CHARS
+
+
+def wrap(line, room, gsm7):
+    """
+    Split a line into parts of at most room encoded characters, at word
+    boundaries where possible
+
+    Args:
+        line (str): Line to split
+        room (int): Encoded characters allowed per part
+        gsm7 (bool): Encoding the parts are measured in
+
+    Returns:
+        list: Parts of the line
+    """
+    parts = []
+    current = ''
+    for word in line.split():
+        candidate = f"{current} {word}" if current else word
+        if encoded_length(candidate, gsm7) <= room:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        # A word longer than a part is cut wherever it reaches the limit
+        current = ''
+        for c in word:
+            if encoded_length(current + c, gsm7) > room:
+                parts.append(current)
+                current = ''
+            current += c
+    if current:
+        parts.append(current)
+    return parts
+
+
+def fits(text):
+    """Whether text fits on one USSD page"""
+    gsm7 = is_gsm7(text)
+    return encoded_length(text, gsm7) <= page_limit(gsm7)
+
+
+@lru_cache(maxsize=4096)
+def paginate(text, more):
+    """
+    Split a screen into pages that each fit on one USSD page
+
+    Args:
+        text (str): Screen text, without the CON/END prefix
+        more (str): Line offering the next page, e.g. "98. More"
+
+    Returns:
+        tuple: Page texts; a single page if the screen fits
+    """
+    if fits(text):
+        return (text,)
+
+    # The whole screen is sent in one encoding, so measure every page in it
+    gsm7 = is_gsm7(text + more)
+    limit = page_limit(gsm7)
+    lines = text.split('\n')
+    footer = [lines.pop()] if len(lines) > 1 and lines[-1].startswith('0.') else []
+    tail = footer + [more]
+    room = limit - encoded_length('\n'.join(tail), gsm7) - 1
+
+    def measure(page_lines):
+        return encoded_length('\n'.join(page_lines + tail), gsm7)
+
+    pages = []
+    current = []
+    for line in lines:
+        # A line longer than a page is wrapped at word boundaries
+        for part in wrap(line, room, gsm7) if encoded_length(line, gsm7) > room else [line]:
+            if current and measure(current + [part]) > limit:
+                pages.append('\n'.join(current + tail))
+                current = []
+            current.append(part)
+    pages.append('\n'.join(current + footer))
+    return tuple(pages)